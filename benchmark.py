@@ -0,0 +1,363 @@
+# Small utility script to measure the hot paths of Hollowserver. Run it with the name of a benchmark, or nothing for all of them.
+# pylint: disable=missing-module-docstring
+
+import os
+import sys
+import json
+import time
+import socket
+import timeit
+import tempfile
+import threading
+import tracemalloc
+from copy import deepcopy
+
+from src.lib.router import Router, split_path
+from src.lib.httpio import StreamCoalescer
+from src.lib.util import fastjson
+from src.lib.memfile import LazyConversation, MemoryFile, write_memory_file
+from src.lib.providers.base import render_startout
+from src.lib.message import OutgoingMessages, to_messages, wire_messages
+from src.lib.context import context_budget, conversation_tokens, select_context
+from src.lib.forks import SharedConversation
+
+
+# Benchmarks
+
+def bench_router():
+    """Compare the old linear `startswith` scan over every registered path with the compiled router,
+    as the amount of registered endpoints grows."""
+
+    print("router: seconds per 10k dispatches of GET /memory/default/3")
+
+    for endpoint_count in (10, 100, 1000):
+
+        # The old way of doing things: {path: [[callback, only_startswith], ...]}
+        linear = {}
+        router = Router()
+
+        for i in range(endpoint_count):
+            linear[f"/endpoint-{i}"] = [[print, True]]
+            router.add(f"/endpoint-{i}/{{conv}}", print, True)
+
+        linear["/memory"] = [[print, True]]
+        router.add("/memory/{conv}/{index:int}", print)
+
+        path = "/memory/default/3"
+
+        def linear_dispatch(linear=linear, path=path):
+            return [
+                callback for registered, callbacks in linear.items() for callback in callbacks
+                if (callback[1] and path.startswith(registered)) or (not callback[1] and path == registered)
+            ]
+
+        def router_dispatch(router=router, path=path):
+            segments, _ = split_path(path)
+            return router.match(segments)
+
+        linear_time = timeit.timeit(linear_dispatch, number=10_000)
+        router_time = timeit.timeit(router_dispatch, number=10_000)
+
+        print(f"    {endpoint_count:>5} endpoints | linear: {linear_time:.4f}s | router: {router_time:.4f}s")
+
+
+
+
+def bench_stream():
+    """Compare writing every token of a streamed completion as its own chunk with coalescing them,
+    over a real (local) socket."""
+
+    print("stream: 20k tokens written to a socket")
+
+    class _CountingFile:
+        def __init__(self, sock):
+            self.sock = sock
+            self.writes = 0
+
+        def write(self, data):
+            self.writes += 1
+            self.sock.sendall(data)
+
+        def flush(self):
+            pass
+
+    class _Request:
+        # Just enough of a request for the streaming helpers.
+        request_version = "HTTP/1.1"
+        _response_chunked = True
+
+        def __init__(self, wfile):
+            self.wfile = wfile
+
+        def start_chunked(self, code, content_type): # pylint: disable=unused-argument
+            self.wfile.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        def write_chunk(self, data):
+            self.wfile.write(b"%x\r\n%b\r\n" % (len(data), data))
+
+        def end_chunked(self, data=b""):
+            self.wfile.write((b"%x\r\n%b\r\n" % (len(data), data) if data else b"") + b"0\r\n\r\n")
+
+    tokens = [json.dumps({"role": "assistant", "content": f" token{i}", "thinking": None}).encode("utf-8") + b"\n"
+              for i in range(20_000)]
+
+    for label, max_bytes, max_ms in (("every token", 0, 0.0), ("4 KiB / 50 ms", 4096, 50.0)):
+        server_side, client_side = socket.socketpair()
+        drainer = threading.Thread(target=lambda sock=client_side: [None for _ in iter(lambda: sock.recv(1 << 16), b"")])
+        drainer.start()
+
+        wfile = _CountingFile(server_side)
+        writer = StreamCoalescer(_Request(wfile), max_bytes, max_ms)
+
+        start_cpu, start_wall = time.process_time(), time.perf_counter()
+
+        for token in tokens:
+            writer.write(token)
+
+        writer.close()
+
+        cpu, wall = time.process_time() - start_cpu, time.perf_counter() - start_wall
+
+        server_side.close()
+        drainer.join()
+        client_side.close()
+
+        print(f"    {label:>13} | writes: {wfile.writes:>6} | cpu: {cpu:.4f}s | wall: {wall:.4f}s")
+
+
+
+
+def bench_json():
+    """Compare the old `json.dumps(...).encode()` with `fastjson.dumps` on a big conversation dump (GET /memory)."""
+
+    encoder = "orjson" if fastjson.orjson_is_available else "json (orjson is not installed)"
+    print(f"json: seconds per 100 dumps of a 2000 message conversation, using {encoder}")
+
+    conversation = [
+        {"role": "user" if i % 2 else "assistant", "content": f"Message number {i}. " * 20, "tool_calls": [], "thinking": None}
+        for i in range(2000)
+    ]
+
+    old_time = timeit.timeit(lambda: json.dumps(conversation).encode("utf-8") + b"\n", number=100)
+    new_time = timeit.timeit(lambda: fastjson.dumps(conversation) + b"\n", number=100)
+
+    print(f"    json.dumps: {old_time:.4f}s | fastjson.dumps: {new_time:.4f}s")
+
+
+
+
+
+
+def bench_memfile():
+    """Compare saving and loading a big conversation as indented JSON (the old /save and /load) with the binary format,
+    and reading the last few messages right after loading."""
+
+    print("memfile: a 50000 message conversation")
+
+    conversation = [
+        {"role": "user" if i % 2 else "assistant", "content": f"Message number {i}. " * 20} for i in range(50_000)
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        json_path = os.path.join(directory, "big.json")
+        binary_path = os.path.join(directory, "big.hfm")
+
+        def save_json():
+            with open(json_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(conversation, indent=4))
+
+        def load_json():
+            with open(json_path, "r", encoding="utf-8") as f:
+                return json.load(f)[-5:]
+
+        save_json_time = timeit.timeit(save_json, number=1)
+        save_binary_time = timeit.timeit(lambda: write_memory_file(binary_path, conversation), number=1)
+        load_json_time = timeit.timeit(load_json, number=5) / 5
+        load_binary_time = timeit.timeit(lambda: LazyConversation(MemoryFile(binary_path))[-5:], number=5) / 5
+
+        print(f"    size | json: {os.path.getsize(json_path):>10} bytes | binary: {os.path.getsize(binary_path):>10} bytes")
+        print(f"    save | json: {save_json_time:.4f}s | binary: {save_binary_time:.4f}s")
+        print(f"    load + last 5 | json: {load_json_time:.4f}s | binary: {load_binary_time:.4f}s")
+
+
+
+
+
+
+def bench_startout():
+    """Compare rendering the startout of every new conversation (deepcopy and replace, as `update_reset_point` used to)
+    with sharing cached renderings, for 1000 conversations with a large system prompt."""
+
+    print("startout: 1000 conversations, 3 message startout with a 20 KB system prompt")
+
+    startout = [
+        {"role": "system", "content": "You are {name}. " + "Follow these rules carefully. " * 700},
+        {"role": "user", "content": "Hi, {name}!"},
+        {"role": "assistant", "content": "Hello there, friend."},
+    ]
+    replacements = {"{name}": "Hollowfire"}
+
+    def old_render():
+        rendered = deepcopy(startout)
+
+        for key, value in replacements.items():
+            for message in rendered:
+                message["content"] = message["content"].replace(key, value)
+
+        return rendered
+
+    def new_render():
+        return list(render_startout(startout, replacements))
+
+    for label, render in (("deepcopy", old_render), ("cached", new_render)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        conversations = [render() for _ in range(1000)]
+        elapsed = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f"    {label:>8} | {elapsed:.4f}s | {memory / (1 << 20):.1f} MiB held by {len(conversations)} conversations")
+
+
+
+
+
+
+def bench_messages():
+    """Compare storing a big conversation as plain dicts with `Message`s: the memory they hold, and the cost of copying
+    them into the payload of a completion (a deepcopy before, fresh wire dicts now)."""
+
+    print("messages: a 50000 message conversation")
+
+    def build():
+        return [
+            json.loads(json.dumps({"role": "user" if i % 2 else "assistant", "content": f"Message number {i}."}))
+            for i in range(50_000)
+        ] # Round-tripped, like everything parsed off a request, so no two messages share their role string.
+
+    for label, store in (("dicts", build), ("messages", lambda: to_messages(build()))):
+        tracemalloc.start()
+        conversation = store()
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        copy = deepcopy if label == "dicts" else wire_messages
+        copy_time = timeit.timeit(lambda: copy(conversation), number=5) / 5 # pylint: disable=cell-var-from-loop
+
+        print(f"    {label:>8} | {memory / (1 << 20):.1f} MiB held | {copy_time:.4f}s per payload copy")
+
+
+
+
+
+def bench_context():
+    """Show the prompt sent for ever longer conversations with a 4096 token context window: everything (as before), or
+    what the "truncate" context policy picks, and how long picking it takes."""
+
+    print("context: prompt tokens and selection time by conversation length, num_ctx 4096")
+
+    budget = context_budget(4096)
+
+    for length in (100, 1000, 10_000, 100_000):
+        conversation = to_messages(
+            {"role": "user" if i % 2 else "assistant", "content": f"Message number {i}. " * 10} for i in range(length)
+        )
+        total = conversation_tokens(conversation)
+
+        selection_time = timeit.timeit(lambda: select_context(conversation, total, budget, 1), number=10) / 10 # pylint: disable=cell-var-from-loop
+        selected, _ = select_context(conversation, total, budget, 1)
+
+        print(f"    {length:>6} messages | everything: {total:>8} tokens | truncated: {conversation_tokens(selected):>5} tokens "
+              f"in {selection_time * 1000:.3f}ms")
+
+
+
+
+
+def bench_fork():
+    """Compare forking a long conversation 100 times by copying its messages (the old GET, then PUT) with sharing them,
+    each fork then adding a reply of its own."""
+
+    print("fork: 100 forks of a 2000 message conversation, one reply each")
+
+    conversation = to_messages(
+        {"role": "user" if i % 2 else "assistant", "content": f"Message number {i}. " * 10} for i in range(2000)
+    )
+
+    def copied(i):
+        fork = to_messages(json.loads(fastjson.dumps(conversation[:1000 + i]))) # What came back from the client.
+        fork.append(to_messages([{"role": "assistant", "content": f"Reply {i}."}])[0])
+        return fork
+
+    def shared(i):
+        fork = SharedConversation(conversation, 1000 + i)
+        fork.append(to_messages([{"role": "assistant", "content": f"Reply {i}."}])[0])
+        return fork
+
+    for label, make_fork in (("copied", copied), ("shared", shared)):
+        tracemalloc.start()
+        started = time.perf_counter()
+        forks = [make_fork(i) for i in range(100)]
+        elapsed = time.perf_counter() - started
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(f"    {label:>6} | {elapsed:.4f}s | {memory / (1 << 20):.1f} MiB held by {len(forks)} forks")
+
+        del forks
+
+
+
+
+
+def bench_payload():
+    """Compare setting up the messages of a completion (with a FAISS context message inserted before the newest one) by
+    deep-copying the conversation, as before, with viewing it."""
+
+    print("payload: completion setup time by conversation length")
+
+    for length in (100, 1000, 10_000, 100_000):
+        dicts = [{"role": "user" if i % 2 else "assistant", "content": f"Message number {i}."} for i in range(length)]
+        conversation = to_messages(dicts)
+        context = {"role": "system", "content": "Relevant context."}
+
+        def copied():
+            messages = deepcopy(dicts) # pylint: disable=cell-var-from-loop
+            messages.insert(-1, context) # pylint: disable=cell-var-from-loop
+            return messages
+
+        def viewed():
+            messages = OutgoingMessages(conversation) # pylint: disable=cell-var-from-loop
+            messages.insert(-1, context) # pylint: disable=cell-var-from-loop
+            return messages
+
+        number = max(1, 100_000 // length)
+        copy_time = timeit.timeit(copied, number=number) / number
+        view_time = timeit.timeit(viewed, number=number) / number
+
+        assert list(viewed()) == copied()
+
+        print(f"    {length:>6} messages | copied: {copy_time * 1000:>9.3f}ms | viewed: {view_time * 1000:.4f}ms")
+
+
+
+BENCHMARKS = {
+    "router": bench_router,
+    "stream": bench_stream,
+    "json": bench_json,
+    "memfile": bench_memfile,
+    "startout": bench_startout,
+    "messages": bench_messages,
+    "context": bench_context,
+    "fork": bench_fork,
+    "payload": bench_payload,
+}
+
+
+if __name__ == "__main__":
+
+    chosen = sys.argv[1:] or list(BENCHMARKS)
+
+    for name in chosen:
+        BENCHMARKS[name]()
@@ -55,6 +55,9 @@ from src.lib.aiclient import Hollowfire                       # AI client class.
 #from src.lib.firepanic import panic                           # Error handling system.
 
 from src.lib.server import HollowCoreCustomHTTP               # The HTTP server.
+from src.lib.models import parse_keep_alive                   # Used to check --keep-alive.
+from src.lib.context import NUM_CTX_BUCKETS                   # The default --num-ctx-buckets.
+from src.lib.completioncache import CompletionCache           # Deterministic completions are replayed.
 
 
 
@@ -64,6 +67,7 @@ ROOTDIR = os.path.abspath(os.path.join(HOMEDIR, "..", "..")) # root/...
 LOGDIR = os.path.join(ROOTDIR, "logs")
 CONFIG = os.path.join(ROOTDIR, "configuration")
 MEMORIES = os.path.join(ROOTDIR, "memories")
+JOURNALS = os.path.join(MEMORIES, "journal")
 PROFILES = os.path.join(ROOTDIR, "profiles")
 TOOLS = os.path.join(ROOTDIR, "tools")
 APIS = os.path.join(ROOTDIR, "apis.json")
@@ -174,11 +178,41 @@ def main(args,
             log_console,
             logger_close,
             args,
-            ROOTDIR
-        )
+            ROOTDIR,
+            concurrency=args.concurrency,
+            max_workers=args.workers,
+            keepalive_timeout=args.keepalive_timeout,
+            stream_flush_bytes=args.stream_flush_bytes,
+            stream_flush_ms=args.stream_flush_ms,
+            max_body_size=args.max_body_size,
+            max_history_size=args.max_history_size,
+            compression_threshold=args.compression_threshold
+        ),
+        max_active_completions=args.max_active_completions,
+        max_queued_completions=args.max_queued_completions,
+        max_queued_per_conversation=args.max_queued_per_conversation,
+        journal_dir=args.journal_dir or None,
+        journal_fsync=args.journal_fsync,
+        autosave_interval=args.autosave_interval / 1000,
+        max_resident_conversations=args.max_resident_conversations,
+        max_resident_bytes=args.max_resident_bytes,
+        completion_cache=CompletionCache(
+            logger,
+            args.completion_cache_ttl,
+            args.completion_cache_bytes,
+            args.completion_cache_dir or None,
+            args.completion_cache_disk_bytes
+        ) if args.completion_cache else None
     )
 
 
+    # Warm up: load the models now, in the background, instead of on the first completion. The server starts meanwhile.
+    if args.warmup is not None:
+        warmup = list(dict.fromkeys([args.model, *args.pin, *args.warmup]))
+        logger.info(f"Warming up model(s): {', '.join(warmup)}")
+        ai_client.models.warmup(warmup)
+
+
     # AI client will handle the callbacks.
     ai_client.hollowserver.run_server()
 
@@ -215,6 +249,7 @@ if __name__ == "__main__":
 
     provider_ops = parser.add_argument_group("Provider Options", description="Options for the AI provider to use.")
     ai_ops = parser.add_argument_group("General AI Options", description="General options for inference itself.")
+    server_ops = parser.add_argument_group("Server Options", description="Options for Hollowserver itself.")
 
 
     # PROVIDER
@@ -227,6 +262,20 @@ if __name__ == "__main__":
         default="ollama"
     )
 
+    provider_ops.add_argument("-m", "--model", type=str, help="The model new conversations use.", default="qwen3")
+
+    provider_ops.add_argument("--warmup", type=str, nargs="*", metavar="MODEL", help="Models to load at startup, besides the "
+                              "default and pinned ones, so the first completion doesn't wait for them.", default=[])
+
+    provider_ops.add_argument("--no-warmup", action="store_const", const=None, dest="warmup", help="Don't load any models at "
+                              "startup; they're loaded by the first completion that uses them.")
+
+    provider_ops.add_argument("--keep-alive", type=str, help="How long the backend keeps a model loaded once it's unused: a "
+                              "number of seconds, or a duration like \"5m\". -1 keeps models loaded forever.", default="5m")
+
+    provider_ops.add_argument("--pin", type=str, nargs="*", metavar="MODEL", help="Models that are never unloaded, until "
+                              "they're unpinned with POST /unpin/<model>.", default=[])
+
     provider_ops.add_argument("-k", "--key", type=str, help="The environment variable that contains the API key"
                               "for the chosen service (unnecessary if using ollama).", default=None)
 
@@ -243,6 +292,89 @@ if __name__ == "__main__":
     ai_ops.add_argument("-sC", "--startout-config", type=int, help="The configuration to use for the startout.",
                         default=0)
 
+    ai_ops.add_argument("--context-policy", type=str, help="What's sent of a conversation that no longer fits the context "
+                        "window. \"truncate\" leaves out the middle, \"summarize\" replaces it with a short recap, \"none\" "
+                        "sends everything anyway. The startout and the newest messages are always sent.",
+                        choices=["truncate", "summarize", "none"], default="truncate")
+
+    ai_ops.add_argument("--num-ctx-buckets", type=int, nargs="*", metavar="NUM_CTX", help="The context window sizes "
+                        "conversations may use. A requested num_ctx is snapped up to the smallest one it fits in (or down to "
+                        "the largest), since the backend reloads the model for every size it's asked for. Pass none to send "
+                        "every num_ctx as requested.", default=list(NUM_CTX_BUCKETS))
+
+
+    # SERVER
+    server_ops.add_argument("-c", "--concurrency", type=str, help="How Hollowserver handles requests. \"single\" handles one request "
+                            "at a time, \"threadpool\" serves them in parallel on a pool of worker threads, and \"asyncio\" serves "
+                            "every connection as a coroutine on one event loop, using the providers' async clients. Requests against the "
+                            "same conversation always run in the order they were received.",
+                            choices=["single", "threadpool", "asyncio"], default="threadpool")
+
+    server_ops.add_argument("-w", "--workers", type=int, help="The maximum amount of worker threads in threadpool mode.",
+                            default=16)
+
+    server_ops.add_argument("--keepalive-timeout", type=float, help="How long an idle keep-alive connection is held open, in seconds. "
+                            "Idle connections don't occupy a worker in threadpool mode.", default=5.0)
+
+    server_ops.add_argument("--stream-flush-bytes", type=int, help="Streamed completions are written out once this many bytes are "
+                            "buffered. 0 writes every token as it comes in. Clients can override this with \"stream_flush\".",
+                            default=4096)
+
+    server_ops.add_argument("--stream-flush-ms", type=float, help="Streamed completions are written out once the oldest buffered "
+                            "token has waited this many milliseconds. The first token is never held back.", default=50.0)
+
+    server_ops.add_argument("--max-body-size", type=int, help="The largest request body accepted, in bytes. Larger ones are "
+                            "turned away with a 413 before they're read.", default=8 * 1024 * 1024)
+
+    server_ops.add_argument("--max-history-size", type=int, help="The largest whole conversation accepted by PUT /memory, in bytes.",
+                            default=64 * 1024 * 1024)
+
+    server_ops.add_argument("--compression-threshold", type=int, help="Responses at least this many bytes large are compressed "
+                            "(zstd, gzip or deflate) for clients that accept it. Streams are always compressed for them. "
+                            "-1 disables compression.", default=1024)
+
+    server_ops.add_argument("--max-active-completions", type=int, help="The maximum amount of completions generating at once. "
+                            "Match this to how many requests your backend serves in parallel (OLLAMA_NUM_PARALLEL).", default=4)
+
+    server_ops.add_argument("--max-queued-completions", type=int, help="The maximum amount of completions waiting for their turn. "
+                            "Beyond this, completions are turned away with a 429.", default=32)
+
+    server_ops.add_argument("--max-queued-per-conversation", type=int, help="The maximum amount of completions pending for a "
+                            "single conversation, including the one generating.", default=4)
+
+    server_ops.add_argument("--journal-dir", type=str, help="Where every change to every conversation is journaled as it "
+                            "happens, so conversations survive restarts and crashes. An empty string disables it.", default=JOURNALS)
+
+    server_ops.add_argument("--journal-fsync", action="store_true", help="Fsync every journaled change, so it survives "
+                            "power loss as well. Much slower.")
+
+    server_ops.add_argument("--autosave-interval", type=float, help="How long changes to conversations are collected before "
+                            "they're written out to the journal, in milliseconds. Changes made in the meantime are lost on a crash.",
+                            default=200.0)
+
+    server_ops.add_argument("--max-resident-conversations", type=int, help="The most conversations kept in memory. The least "
+                            "recently used idle ones are spilled to disk beyond that, and brought back when needed. 0 for no limit.",
+                            default=256)
+
+    server_ops.add_argument("--max-resident-bytes", type=int, help="The most (estimated) bytes of messages kept in memory, "
+                            "across all conversations. 0 for no limit.", default=512 << 20)
+
+    server_ops.add_argument("--completion-cache", action="store_true", help="Cache deterministic completions (a temperature of 0, "
+                            "or a fixed seed) and replay them for the same prompt, model and options, instead of generating them "
+                            "again. Clients can skip the cache with \"cache\": false.")
+
+    server_ops.add_argument("--completion-cache-ttl", type=float, help="How long a cached completion is kept, in seconds. 0 keeps "
+                            "them until they're evicted.", default=3600.0)
+
+    server_ops.add_argument("--completion-cache-bytes", type=int, help="The most (estimated) bytes of cached completions kept in "
+                            "memory. The least recently used ones are evicted beyond that.", default=64 << 20)
+
+    server_ops.add_argument("--completion-cache-dir", type=str, help="Where cached completions are also written to, so they "
+                            "survive restarts. An empty string keeps them in memory only.", default="")
+
+    server_ops.add_argument("--completion-cache-disk-bytes", type=int, help="The most bytes of cached completions kept in "
+                            "--completion-cache-dir. The oldest ones are deleted beyond that.", default=256 << 20)
+
     args = parser.parse_args()
 
     # Args further handling
@@ -264,6 +396,18 @@ if __name__ == "__main__":
         sys.exit(1)
 
 
+    if any(bucket <= 0 for bucket in args.num_ctx_buckets):
+        print(f"{FM.error} Every --num-ctx-buckets size must be positive. Aborting.")
+        sys.exit(1)
+
+    try:
+        args.keep_alive = parse_keep_alive(args.keep_alive)
+
+    except ValueError as error:
+        print(f"{FM.error} {error} Aborting.")
+        sys.exit(1)
+
+
     main(
         args,
         logger,
@@ -10,15 +10,29 @@
 
 
 # Imports: Built-in/Standard
-import json
+import os
 import traceback
 import asyncio
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 
 # Imports: Local/source
 from src.lib.providers.base import BaseAIProvider
 from src.lib.server import HollowCoreCustomHTTP, NoSuchConversation
 from src.lib.providers.ollamaprovider import OllamaAIProvider
+from src.lib.util.concurrency import KeyedLocks
+from src.lib.session import ConversationSession
+from src.lib.scheduler import CompletionScheduler, CompletionTicket, SchedulerFull
+from src.lib.journal import ConversationJournal, journaled_conversations
+from src.lib.persistence import PersistenceWorker, AUTOSAVE_INTERVAL
+from src.lib.convcache import ConversationCache
+from src.lib.httpio import BodyError
+from src.lib.batch import BATCH_WORKERS, MAX_BATCH_OPERATIONS, batch_result, group_operations, run_operation
+from src.lib.models import ModelKeeper, DEFAULT_KEEP_ALIVE, DEFAULT_NUM_CTX
+from src.lib.context import NUM_CTX_BUCKETS, snap_num_ctx
+from src.lib.completioncache import CompletionCache
 
 
 # Imports: Third-party
@@ -49,7 +63,16 @@ class Hollowfire:
                  profiles_module,
                  cli_args,
                  startout_configuration: int = 0,
-                 hollowserver: HollowCoreCustomHTTP = None
+                 hollowserver: HollowCoreCustomHTTP = None,
+                 max_active_completions: int = 4,
+                 max_queued_completions: int = 32,
+                 max_queued_per_conversation: int = 4,
+                 journal_dir: str = None,
+                 journal_fsync: bool = False,
+                 autosave_interval: float = AUTOSAVE_INTERVAL,
+                 max_resident_conversations: int = 0,
+                 max_resident_bytes: int = 0,
+                 completion_cache: CompletionCache = None
                  ):
 
         """The main AI client class.
@@ -71,27 +94,22 @@ class Hollowfire:
             cli_args (Namespace): The command line arguments.
             startout_configuration (int, optional): The startout configuration to use.
             hollowserver (HollowCoreCustomHTTP, optional): The Hollowcore server to use.
+            max_active_completions (int, optional): The maximum amount of completions generating at once. Defaults to 4.
+            max_queued_completions (int, optional): The maximum amount of completions waiting to generate. Defaults to 32.
+            max_queued_per_conversation (int, optional): The maximum amount of completions pending per conversation. Defaults to 4.
+            journal_dir (str, optional): Where conversations are journaled to, so they survive restarts and crashes.
+            Defaults to None (not persisted).
+            journal_fsync (bool, optional): Whether journal writes are fsynced, to survive power loss as well. Defaults to False.
+            autosave_interval (float, optional): How long changes are collected before they're written out to the journal,
+            in seconds. Defaults to 0.2.
+            max_resident_conversations (int, optional): The most conversations kept in memory; the least recently used idle
+            ones are spilled to disk beyond that. Defaults to 0 (no limit).
+            max_resident_bytes (int, optional): The most (estimated) bytes of messages kept in memory. Defaults to 0 (no limit).
+            completion_cache (CompletionCache, optional): Where deterministic completions are cached, and replayed from.
+            Defaults to None (not cached).
         """
 
         self.conversation_class = conversation_class
-        self.conversations = {
-            "default": self.conversation_class(
-                logger,
-                logger_exit,
-                stream_handler,
-                root_dir,
-                system_replacements,
-                reset_point,
-                memory_dir,
-                profile_dir,
-                startouts_module,
-                tools_module,
-                main_module_name,
-                cli_args,
-                "default",
-                startout_configuration,
-            )
-        }
         self.logger = logger
         self.logger_exit = logger_exit
         self.stream_handler = stream_handler
@@ -106,6 +124,60 @@ class Hollowfire:
         self.profiles_module = profiles_module
         self.cli_args = cli_args
         self.startout_configuration = startout_configuration
+        self.journal_dir = journal_dir
+        self.journal_fsync = journal_fsync
+        self.completion_cache = completion_cache
+
+        # Journals are written out in the background, so requests never wait on the disk.
+        self.persistence = PersistenceWorker(logger, autosave_interval) if journal_dir else None
+
+        # Models are loaded ahead of time, and kept loaded (or not) per model. Warm them up with `self.models.warmup`.
+        # They're loaded with the context window new conversations use, so their first completion doesn't reload them.
+        self.models = ModelKeeper(
+            logger,
+            lambda model, keep_alive, num_ctx: self.conversation_class.load_model(model, keep_alive, num_ctx),
+            getattr(cli_args, "keep_alive", None) or DEFAULT_KEEP_ALIVE,
+            getattr(cli_args, "pin", None),
+            snap_num_ctx(DEFAULT_NUM_CTX, tuple(sorted(set(getattr(cli_args, "num_ctx_buckets", NUM_CTX_BUCKETS))))),
+        )
+
+        # Requests against the same conversation must run one at a time, in the order they came in.
+        # Different conversations are free to run in parallel.
+        self.conversation_locks = KeyedLocks()
+        self.conversation_async_locks = KeyedLocks(asyncio.Lock) # Same thing, for the asyncio backend.
+
+        # Idle conversations beyond these limits are spilled to disk, and brought back when they're needed.
+        # Take conversations out with `self.conversations.use(conv_id)`, so they aren't spilled while in use.
+        self.conversations = ConversationCache(
+            self.new_conversation,
+            journal_dir or os.path.join(memory_dir, "spill"),
+            logger,
+            max_resident_conversations,
+            max_resident_bytes,
+            on_evict=self.forget_conversation,
+        )
+
+        # Every conversation journaled in a previous run is brought back, once it's asked for.
+        journaled = journaled_conversations(self.journal_dir) if self.journal_dir else []
+
+        for conv_id in journaled:
+            self.conversations.add_spilled(conv_id)
+
+        if "default" not in journaled:
+            self.conversations.create("default")
+
+        if journaled:
+            self.logger.info(f"Found {len(journaled)} journaled conversation(s) in \'{self.journal_dir}\'.")
+
+        # Coroutine callbacks from the threaded backends run here, instead of spinning up a new event loop per request.
+        self.event_loop: asyncio.AbstractEventLoop = None
+        self.event_loop_lock = threading.Lock()
+
+        # Completions beyond these limits are turned away with a 429, instead of piling up on the backend.
+        self.scheduler = CompletionScheduler(max_active_completions, max_queued_completions, max_queued_per_conversation)
+
+        # Works on the conversations of a batch (POST /batch) in parallel, on the threaded backends.
+        self.batch_executor = ThreadPoolExecutor(BATCH_WORKERS, thread_name_prefix="Hollowfire-Batch")
 
         if hollowserver:
             self.hollowserver = hollowserver
@@ -120,240 +192,660 @@ class Hollowfire:
                 root_dir
             )
 
-        self.hollowserver.request_callback('POST', '/completion', lambda req: self.call_on_behalf(req, "completion_request"), True)
+        # Requests take their turn on their conversation as they arrive, not once a worker gets to them.
+        self.hollowserver.order_requests("conv", self.conversation_locks)
+
+        self.hollowserver.on_shutdown(self.models.stop)
+        self.hollowserver.on_shutdown(self.batch_executor.shutdown)
+
+        if self.persistence: # After the batch executor, so whatever it changed last is written out too.
+            self.hollowserver.on_shutdown(self.persistence.stop)
+
+        self.hollowserver.request_callback('POST', '/completion/{conv}', self.scheduled_completion)
+
+        for method in ('GET', 'POST', 'DELETE', 'PATCH', 'PUT'):
+            self.hollowserver.request_callback(method, '/memory/{conv}', lambda req: self.call_on_behalf(req, "memory_update"),
+                                               max_body_size=self.hollowserver.max_history_size if method == 'PUT' else None)
+            self.hollowserver.request_callback(method, '/memory/{conv}/{index:int}', lambda req: self.call_on_behalf(req, "memory_update"))
+
+        self.hollowserver.request_callback('GET', '/save/{conv}/{file:path}', lambda req: self.call_on_behalf(req, "save"))
+        self.hollowserver.request_callback('GET', '/load/{conv}/{file:path}', lambda req: self.call_on_behalf(req, "load"))
+
+        self.hollowserver.request_callback('GET', '/reset/{conv}', lambda req: self.call_on_behalf(req, "reset"))
 
-        self.hollowserver.request_callback('GET', '/memory', lambda req: self.call_on_behalf(req, "memory_update"), True)
-        self.hollowserver.request_callback('POST', '/memory', lambda req: self.call_on_behalf(req, "memory_update"), True)
-        self.hollowserver.request_callback('DELETE', '/memory', lambda req: self.call_on_behalf(req, "memory_update"), True)
-        self.hollowserver.request_callback('PATCH', '/memory', lambda req: self.call_on_behalf(req, "memory_update"), True)
-        self.hollowserver.request_callback('PUT', '/memory', lambda req: self.call_on_behalf(req, "memory_update"), True)
+        self.hollowserver.request_callback('GET', '/search_set_startout/{conv}/{startout}', lambda req: self.call_on_behalf(req, "search_set_startout"))
+        self.hollowserver.request_callback('POST', '/search_set_startout/{conv}/{startout}', lambda req: self.call_on_behalf(req, "search_set_startout"))
 
-        self.hollowserver.request_callback('GET', '/save', lambda req: self.call_on_behalf(req, "save"), True)
-        self.hollowserver.request_callback('GET', '/load', lambda req: self.call_on_behalf(req, "load"), True)
+        self.hollowserver.request_callback('GET', '/change_startout_configuration/{conv}/{configuration}',
+                                           lambda req: self.call_on_behalf(req, "change_startout_configuration"))
 
-        self.hollowserver.request_callback('GET', '/reset', lambda req: self.call_on_behalf(req, "reset"), True)
+        self.hollowserver.request_callback('GET', '/save-persona/{conv}/{file:path}', lambda req: self.call_on_behalf(req, "save_persona"))
+        self.hollowserver.request_callback('GET', '/load-persona/{conv}/{file:path}', lambda req: self.call_on_behalf(req, "load_persona"))
 
-        self.hollowserver.request_callback('GET', '/search_set_startout', lambda req: self.call_on_behalf(req, "search_set_startout"), True)
-        self.hollowserver.request_callback('POST', '/search_set_startout', lambda req: self.call_on_behalf(req, "search_set_startout"), True)
+        self.hollowserver.request_callback('GET', '/ensure-exist/{conv}', self.ensure_conv_exists)
 
-        self.hollowserver.request_callback('GET', '/change_startout_configuration', lambda req: self.call_on_behalf(req, "change_startout_configuration"), True)
+        self.hollowserver.request_callback('GET', '/change-provider/{provider}', self.change_provider)
+        self.hollowserver.request_callback('POST', '/setup-provider/{conv}', self.setup_provider)
 
-        self.hollowserver.request_callback('GET', '/save-persona', lambda req: self.call_on_behalf(req, "save_persona"), True)
-        self.hollowserver.request_callback('GET', '/load-persona', lambda req: self.call_on_behalf(req, "load_persona"), True)
+        self.hollowserver.request_callback('POST', '/set-default/{conv}', lambda req: self.call_on_behalf(req, "set_default"))
 
-        self.hollowserver.request_callback('GET', '/ensure-exist', self.ensure_conv_exists, True)
+        self.hollowserver.request_callback('GET', '/session/{conv}', self.conversation_session)
 
-        self.hollowserver.request_callback('GET', '/change-provider', self.change_provider, True)
-        self.hollowserver.request_callback('POST', '/setup-provider', self.setup_provider, True)
+        self.hollowserver.request_callback('POST', '/batch', self.batch)
 
-        self.hollowserver.request_callback('POST', '/set-default', lambda req: self.call_on_behalf(req, "set_default"), True)
+        self.hollowserver.request_callback('POST', '/fork/{conv}/{target}', self.fork_conversation)
 
+        self.hollowserver.request_callback('GET', '/models', self.model_stats)
+        self.hollowserver.request_callback('POST', '/pin/{model:path}', self.pin_model)
+        self.hollowserver.request_callback('POST', '/unpin/{model:path}', self.unpin_model)
 
+        self.hollowserver.request_callback('GET', '/stats', self.stats)
 
 
-    def call_on_behalf(self, request, fn: str):
+
+
+    def call_on_behalf(self, request, fn: str, ticket: CompletionTicket = None):
         """Call the conversation functions on behalf of the callback.
+        The conversation is taken from the `conv` parameter of the route.
 
         Args:
             request: The request.
             fn (str): The function to call.
+            ticket (CompletionTicket, optional): A scheduler ticket to wait on once the conversation is ours.
         """
 
         try:
-            split = request.path.split("/")
+            conv_id = request.params.get("conv")
 
-            while "" in split:
-                split.remove("")
+            if conv_id is None:
+                request.send_error_json(400, "Incomplete path for this request.")
+                return
 
-            if len(split) < 2:
-                request.send_response(400)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Incomplete path for this request."}).encode("utf-8") + b"\n"
-                )
 
-            conv = split[1]
+            if request.is_async:
+                return self.acall_on_behalf(request, conv_id, fn, ticket)
 
-            split.remove(split[1])
-            path_without = "/" + "/".join(split)
-            #print(path_without)
+            with self.conversations.use(conv_id) as conv:
+                if not conv:
+                    raise NoSuchConversation
 
-            request.path = path_without
+                with self.conversation_locks.hold(conv_id, request.take_turn(conv_id)), ticket or contextlib.nullcontext():
+                    if not asyncio.iscoroutinefunction(getattr(conv, fn)):
+                        getattr(conv, fn)(request)
+                    else:
+                        self.run_coroutine(getattr(conv, fn)(request))
 
 
-            conv = self.conversations.get(conv)
+        except NoSuchConversation:
+            request.send_error_json(404, "Conversation not found.")
 
-            if not conv:
-                raise NoSuchConversation
 
-            if not asyncio.iscoroutinefunction(getattr(conv, fn)):
-                getattr(conv, fn)(request)
-            else:
-                asyncio.run(getattr(conv, fn)(request))
+        except AttributeError:
+            self.logger.error("Invalid request callback registered.")
+            self.logger.debug(traceback.format_exc())
+            request.send_error_json(500, "Invalid request callback registered.")
 
 
-        except NoSuchConversation:
-            request.send_response(404)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Conversation not found."}).encode("utf-8") + b"\n"
-            )
 
 
+
+    async def acall_on_behalf(self, request, conv_id: str, fn: str, ticket: CompletionTicket = None):
+        """The asyncio counterpart of `call_on_behalf`. Prefers the provider's async variant of the function (`a<fn>`)
+        if it has one; anything else is cheap enough to run right on the event loop.
+
+        Args:
+            request (AsyncHollowRequest): The request.
+            conv_id (str): The ID of the conversation.
+            fn (str): The function to call.
+            ticket (CompletionTicket, optional): A scheduler ticket to wait on once the conversation is ours.
+        """
+
+        # Rehydrating and spilling touch the disk; keep that off the event loop.
+        conv = await asyncio.to_thread(self.conversations.take, conv_id)
+
+        if not conv:
+            request.send_error_json(404, "Conversation not found.")
+            return
+
+        try:
+            target = getattr(conv, f"a{fn}", None)
+
+            if not asyncio.iscoroutinefunction(target):
+                target = getattr(conv, fn)
+
+            async with self.conversation_async_locks.hold(conv_id), ticket or contextlib.nullcontext():
+                result = target(request)
+
+                if asyncio.iscoroutine(result):
+                    await result
+
         except AttributeError:
             self.logger.error("Invalid request callback registered.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Invalid request callback registered."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(500, "Invalid request callback registered.")
 
+        finally:
+            await asyncio.to_thread(self.conversations.give_back, conv_id)
 
 
 
 
-    def call_on_behalf_noreq(self, path: str, fn: str, *args, lensplit: int=1, request=None, **kwargs):
-        """Call the conversation functions on behalf of the callback.
+
+    def scheduled_completion(self, request):
+        """Admit a completion request through the scheduler, then run it on behalf of the conversation.
+        Turned away with a 429 and a Retry-After if there's no room.
 
         Args:
-            path (str): The path.
-            fn (str): The function to call.
-            lensplit (int, optional): The length minimum of the split path. Does nothing without request. Defaults to 1.
-            request: The request if applicable.
+            request: The request.
         """
 
+        conv_id = request.params["conv"]
+
         try:
-            split = path.split("/")
+            ticket = self.scheduler.admit(conv_id)
+
+        except SchedulerFull as full:
+            self.logger.warning(f"Turned away a completion for \'{conv_id}\': {full.reason}")
+            request.send_json({"error": full.reason, "retry_after": full.retry_after}, 429, headers={"Retry-After": str(full.retry_after)})
+            return None
 
-            while "" in split:
-                split.remove("")
+        if request.is_async:
+            return self._ascheduled_completion(request, ticket)
+
+        try:
+            self.call_on_behalf(request, "completion_request", ticket)
+
+        finally:
+            ticket.release()
+
+        return None
+
+
+
+
+
+    async def _ascheduled_completion(self, request, ticket: CompletionTicket):
+        """The asyncio counterpart of `scheduled_completion`, once admitted.
+
+        Args:
+            request (AsyncHollowRequest): The request.
+            ticket (CompletionTicket): The scheduler ticket.
+        """
 
-            if len(split) < lensplit and request is not None:
-                request.send_response(400)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Incomplete path for this request."}).encode("utf-8") + b"\n"
-                )
+        try:
+            result = self.call_on_behalf(request, "completion_request", ticket)
+
+            if asyncio.iscoroutine(result):
+                await result
+
+        finally:
+            ticket.release()
+
+
+
+
+
+    def batch(self, request):
+        """Run a batch of operations across many conversations. See src/lib/batch.py for the format.
+
+        Args:
+            request: The request.
+        """
+
+        operations = request.read_json()
+
+        if not isinstance(operations, list):
+            raise BodyError(400, "Batch must be a JSON array of operations.")
+
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            raise BodyError(400, f"Batch has more than {MAX_BATCH_OPERATIONS} operations.")
+
+        groups, results = group_operations(operations)
+
+        if request.is_async:
+            return self._abatch(request, operations, groups, results)
+
+        if len(groups) == 1: # Nothing to parallelize.
+            for conv_id, group in groups.items():
+                self._run_batch_group(conv_id, group, results)
+
+        else:
+            futures = [self.batch_executor.submit(self._run_batch_group, conv_id, group, results) for conv_id, group in groups.items()]
 
-            conv = split[1]
+            for future in futures:
+                future.result()
 
-            split.remove(split[1])
-            path_without = "/" + "/".join(split)
-            #print(path_without)
+        request.send_json({"results": [results[index] for index in range(len(operations))]})
 
-            path = path_without
+        return None
 
 
-            conv = self.conversations.get(conv)
 
+
+
+    def _run_batch_group(self, conv_id: str, group: list[tuple[int, dict]], results: dict[int, dict]):
+        """Run the operations of a batch on a single conversation, in order, holding its lock throughout.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+            group (list[tuple[int, dict]]): The operations, with their indices in the batch.
+            results (dict[int, dict]): Where the results go, by index.
+        """
+
+        with contextlib.ExitStack() as stack:
+            conv = None
+
+            for index, operation in group:
+                if operation["op"] == "ensure":
+                    results[index] = batch_result(operation, 200, created=self.conversations.create(conv_id))
+                    continue
+
+                if conv is None:
+                    conv = stack.enter_context(self.conversations.use(conv_id))
+
+                    if conv is None:
+                        results[index] = batch_result(operation, 404, error="Conversation not found.")
+                        continue
+
+                    stack.enter_context(self.conversation_locks.hold(conv_id))
+
+                results[index] = run_operation(conv, operation, self.logger)
+
+
+
+
+
+    async def _abatch(self, request, operations: list, groups: dict[str, list[tuple[int, dict]]], results: dict[int, dict]):
+        """The asyncio counterpart of `batch`, once the batch is checked. Conversations are worked on concurrently.
+
+        Args:
+            request (AsyncHollowRequest): The request.
+            operations (list): The operations.
+            groups (dict[str, list[tuple[int, dict]]]): The valid operations, by conversation ID.
+            results (dict[int, dict]): The results of the invalid operations, by index. The rest go here too.
+        """
+
+        async def run_group(conv_id: str, group: list[tuple[int, dict]]):
+            conv = None
+
+            try:
+                async with contextlib.AsyncExitStack() as stack:
+                    for index, operation in group:
+                        if operation["op"] == "ensure": # Creating one may spill another to disk.
+                            results[index] = batch_result(operation, 200,
+                                                          created=await asyncio.to_thread(self.conversations.create, conv_id))
+                            continue
+
+                        if conv is None:
+                            conv = await asyncio.to_thread(self.conversations.take, conv_id)
+
+                            if conv is None:
+                                results[index] = batch_result(operation, 404, error="Conversation not found.")
+                                continue
+
+                            await stack.enter_async_context(self.conversation_async_locks.hold(conv_id))
+
+                        results[index] = run_operation(conv, operation, self.logger)
+
+            finally:
+                if conv is not None:
+                    await asyncio.to_thread(self.conversations.give_back, conv_id)
+
+        await asyncio.gather(*(run_group(conv_id, group) for conv_id, group in groups.items()))
+
+        request.send_json({"results": [results[index] for index in range(len(operations))]})
+
+
+
+
+
+    def fork_conversation(self, request):
+        """Fork a conversation into a new one, which shares its messages (all of them, or the first `?at=` of them) instead
+        of copying them, along with its configuration. See src/lib/forks.py.
+
+        Args:
+            request: The request.
+        """
+
+        if request.is_async:
+            return self._afork_conversation(request)
+
+        conv_id = request.params["conv"]
+
+        with self.conversations.use(conv_id) as conv:
             if not conv:
-                raise NoSuchConversation
+                request.send_error_json(404, "Conversation not found.")
+                return None
+
+            with self.conversation_locks.hold(conv_id, request.take_turn(conv_id)):
+                fork = self._share_for_fork(conv, request)
 
+        if fork is not None:
+            self._send_fork(request, fork, self._create_fork(*fork))
+
+        return None
+
+
+
+
+
+    async def _afork_conversation(self, request):
+        """The asyncio counterpart of `fork_conversation`.
+
+        Args:
+            request (AsyncHollowRequest): The request.
+        """
+
+        conv_id = request.params["conv"]
+        conv = await asyncio.to_thread(self.conversations.take, conv_id)
+
+        if not conv:
+            request.send_error_json(404, "Conversation not found.")
+            return
+
+        try:
+            async with self.conversation_async_locks.hold(conv_id):
+                fork = self._share_for_fork(conv, request)
+
+        finally:
+            await asyncio.to_thread(self.conversations.give_back, conv_id)
+
+        if fork is not None:
+            self._send_fork(request, fork, await asyncio.to_thread(self._create_fork, *fork)) # May spill another one.
+
+
+
+
+
+    def _share_for_fork(self, conv: BaseAIProvider, request) -> tuple:
+        """Check a fork request, and share the messages of the conversation being forked. Call it with its lock held.
+
+        Args:
+            conv (BaseAIProvider): The conversation being forked.
+            request: The request. Answered if it's no good.
+
+        Returns:
+            tuple: (ID of the fork, its messages, its state), or None if the request was answered.
+        """
+
+        target = request.params["target"]
+
+        try:
+            at = int(request.query["at"]) if request.query.get("at") else None
+
+        except ValueError:
+            request.send_error_json(400, "Invalid fork point.")
+            return None
+
+        if target in self.conversations:
+            request.send_error_json(409, "Conversation already exists.")
+            return None
+
+        length = slice(None, at).indices(len(conv.conversation))[1] # Negative points count from the end, like slices.
+
+        state = {key: value for key, value in conv.export_state().items() if key not in ("version", "version_epoch")}
+
+        return target, conv.share_messages(length), state
+
+
+
+
+
+    def _create_fork(self, target: str, messages, state: dict) -> str:
+        """Create a fork, from what `_share_for_fork` gave.
+
+        Returns:
+            str: The ETag of the fork, or None if a conversation by that ID was created in the meantime.
+        """
 
-            if not asyncio.iscoroutinefunction(getattr(conv, fn)):
-                getattr(conv, fn)(*args, **kwargs)
-            else:
-                asyncio.run(getattr(conv, fn)(*args, **kwargs))
+        etag = None
+
+        def setup(fork: BaseAIProvider):
+            nonlocal etag
+            fork.import_state(state)
+            fork.conversation = messages
+            etag = fork.etag
+
+        if not self.conversations.create(target, setup):
+            return None
+
+        self.logger.info(f"Forked '{target}' off with {len(messages)} shared message(s).")
+
+        return etag
+
+
+
+
+
+    def _send_fork(self, request, fork: tuple, etag: str):
+        """Answer a fork request.
+
+        Args:
+            request: The request.
+            fork (tuple): What `_share_for_fork` gave.
+            etag (str): What `_create_fork` gave.
+        """
+
+        if etag is None:
+            request.send_error_json(409, "Conversation already exists.")
+            return
+
+        request.send_json({"created": True, "length": len(fork[1])}, headers={"ETag": etag})
+
+
+
+
+
+    def stats(self, request):
+        """Report the live state of the server.
+
+        Args:
+            request: The request.
+        """
+
+        stats = {"completions": self.scheduler.stats()}
+
+        if self.persistence:
+            stats["persistence"] = self.persistence.stats()
+
+        stats["conversations"] = self.conversations.stats()
+        stats["models"] = self.models.stats()
+
+        if self.completion_cache:
+            stats["completion_cache"] = self.completion_cache.stats()
+
+        request.send_json(stats)
+
+
+
+
+
+    def model_stats(self, request):
+        """Report the models we know of: whether they're loaded, pinned, and their keep_alive.
+
+        Args:
+            request: The request.
+        """
+
+        request.send_json(self.models.stats())
+
+
+
+
+
+    def pin_model(self, request):
+        """Keep a model loaded until it's unpinned. It's loaded in the background, if it isn't already.
+
+        Args:
+            request: The request.
+        """
+
+        request.send_json(self.models.pin(request.params["model"]))
+
+
+
+
+
+    def unpin_model(self, request):
+        """Let a pinned model be unloaded again, once it's been unused for the default keep_alive.
+
+        Args:
+            request: The request.
+        """
+
+        stats = self.models.unpin(request.params["model"])
+
+        if stats is None:
+            request.send_error_json(404, "Model is not pinned.")
+            return
+
+        request.send_json(stats)
+
+
+
+
+
+    def run_coroutine(self, coroutine):
+        """Run a coroutine to completion on the shared background event loop, starting the loop if needed.
+
+        Args:
+            coroutine: The coroutine.
+
+        Returns:
+            Whatever the coroutine returned.
+        """
+
+        with self.event_loop_lock:
+            if self.event_loop is None:
+                self.event_loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.event_loop.run_forever,
+                    name="Hollowfire-EventLoop",
+                    daemon=True
+                ).start()
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.event_loop).result()
+
+
+
+
+
+    def call_on_behalf_noreq(self, conv_id: str, fn: str, *args, request=None, **kwargs):
+        """Call the conversation functions on behalf of the callback.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+            fn (str): The function to call.
+            request: The request if applicable. Used to report errors.
+
+        Returns:
+            bool: Whether the function was called successfully.
+        """
+
+        try:
+            with self.conversations.use(conv_id) as conv:
+                if not conv:
+                    raise NoSuchConversation
+
+
+                with self.conversation_locks.hold(conv_id, request.take_turn(conv_id) if request is not None else None):
+                    if not asyncio.iscoroutinefunction(getattr(conv, fn)):
+                        getattr(conv, fn)(*args, **kwargs)
+                    else:
+                        self.run_coroutine(getattr(conv, fn)(*args, **kwargs))
+
+            return True
 
 
         except NoSuchConversation:
             if request is not None:
-                request.send_response(404)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Conversation not found."}).encode("utf-8") + b"\n"
-                )
+                request.send_error_json(404, "Conversation not found.")
 
 
         except AttributeError:
             self.logger.error("Invalid request callback registered.")
             self.logger.debug(traceback.format_exc())
             if request is not None:
-                request.send_response(500)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Invalid request callback registered."}).encode("utf-8") + b"\n"
-                )
+                request.send_error_json(500, "Invalid request callback registered.")
 
+        return False
 
 
 
 
-    def ensure_conv_exists(self, request):
-        """Ensure the conversation exists. If not found, create it.
+
+    def new_conversation(self, conv_id: str) -> BaseAIProvider:
+        """Construct a conversation, restoring it from its journal if it has one.
 
         Args:
-            request: The request.
+            conv_id (str): The ID of the conversation.
+
+        Returns:
+            BaseAIProvider: The conversation.
         """
 
-        did_not_exist = True
+        conv = self.conversation_class(
+            self.logger,
+            self.logger_exit,
+            self.stream_handler,
+            self.root_dir,
+            self.system_replacements,
+            self.reset_point,
+            self.memory_dir,
+            self.profile_dir,
+            self.startouts_module,
+            self.tools_module,
+            self.main_module_name,
+            self.cli_args,
+            conv_id,
+            self.startout_configuration,
+        )
 
-        try:
-            path = request.path.removeprefix("/ensure-exists/")
-            path = path.split("/")
+        conv.models = self.models
+        conv.completion_cache = self.completion_cache
 
-            while "" in path:
-                path.remove("")
+        if self.journal_dir:
+            conv.attach_journal(ConversationJournal(self.journal_dir, conv_id, self.logger, self.journal_fsync, worker=self.persistence))
 
-            if len(path) < 1:
-                request.send_response(400)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Incomplete path for this request."}).encode("utf-8") + b"\n"
-                )
+        return conv
 
-            path = "/".join(path)
 
-            conv = self.conversations.get(path)
 
-            if not conv:
-                self.conversations[path] = self.conversation_class(
-                    self.logger,
-                    self.logger_exit,
-                    self.stream_handler,
-                    self.root_dir,
-                    self.system_replacements,
-                    self.reset_point,
-                    self.memory_dir,
-                    self.profile_dir,
-                    self.startouts_module,
-                    self.tools_module,
-                    self.main_module_name,
-                    self.cli_args,
-                    path,
-                    self.startout_configuration,
-                )
-                #print(self.conversations)
-
-            else:
-                did_not_exist = False
+
+
+    def forget_conversation(self, conv_id: str):
+        """Drop what's kept of a conversation that was spilled besides the conversation itself (its locks, and where its
+        model was loaded), so none of it piles up either.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+        """
+
+        self.conversation_locks.discard(conv_id)
+        self.conversation_async_locks.discard(conv_id)
+        self.models.forget(conv_id)
+
+
+
+
+
+    def ensure_conv_exists(self, request):
+        """Ensure the conversation exists. If not found, create it.
+
+        Args:
+            request: The request.
+        """
+
+        try:
+            did_not_exist = self.conversations.create(request.params["conv"])
 
         except: # pylint: disable=bare-except
             self.logger.error("Failed to ensure conversation exists.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to ensure conversation exists."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(500, "Failed to ensure conversation exists.")
             return
 
-        request.send_response(200)
-        request.send_header("Content-Type", "application/json")
-        request.end_headers()
-
-        request.wfile.write(
-            json.dumps({"created": did_not_exist}).encode("utf-8") + b"\n"
-        )
+        request.send_json({"created": did_not_exist})
 
 
 
@@ -366,21 +858,16 @@ class Hollowfire:
             request: The request.
         """
 
-        try:
-            provider = request.path.removeprefix("/change-provider/")
+        provider = {"ollama": OllamaAIProvider}.get(request.params["provider"])
 
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to change provider: Bad path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Bad path."}).encode("utf-8") + b"\n"
-            )
+        if provider is None:
+            self.logger.error(f"Failed to change provider: Unknown provider \'{request.params['provider']}\'.")
+            request.send_error_json(404, "Unknown provider.")
             return
 
-        self.conversation_class = {"ollama": OllamaAIProvider}.get(provider, provider) # Set or ignore.
+        self.conversation_class = provider
+
+        request.send_empty()
 
 
 
@@ -393,58 +880,71 @@ class Hollowfire:
             request: The request.
         """
 
-        try:
-            request.path = request.path.removeprefix("/setup-provider/")
+        data = request.read_json()
 
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to setup provider: Bad path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Bad path."}).encode("utf-8") + b"\n"
-            )
-            return
+        if self.call_on_behalf_noreq(request.params["conv"], "do_setup", data, request=request):
+            request.send_empty()
 
-        data = None
 
-        try:
-            data = request.rfile.read(int(request.headers["Content-Length"])).decode("utf-8")
 
-        except ValueError:
-            # 411, content length required
-            request.send_response(411)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Content length is required."}).encode("utf-8") + b"\n"
-            )
+
+
+    def conversation_session(self, request):
+        """Upgrade the request to a WebSocket session bound to a conversation. See src/lib/session.py for the protocol.
+        The session is served on a thread of its own, so it doesn't hold on to a worker.
+
+        Args:
+            request: The request.
+        """
+
+        if request.is_async:
+            request.send_error_json(501, "WebSocket sessions are not available on the asyncio backend.")
             return
 
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to setup provider: Bad request.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Bad request."}).encode("utf-8") + b"\n"
-            )
+        if request.server.concurrency == "single": # It would keep every other request waiting for as long as it's open.
+            request.send_error_json(501, "WebSocket sessions are not available in single mode.")
             return
 
-        try:
-            data = json.loads(data)
+        conv_id = request.params["conv"]
+        conv = self.conversations.take(conv_id) # Not spilled for as long as the session is open.
 
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to setup provider: Bad request.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Bad request."}).encode("utf-8") + b"\n"
-            )
+        if not conv:
+            request.send_error_json(404, "Conversation not found.")
             return
 
-        self.call_on_behalf_noreq(request.path, "do_setup", data, request=request)
+        detached = False
+
+        try:
+            with self.conversation_locks.hold(conv_id, request.take_turn(conv_id)): # After the requests that came in before it.
+                websocket = request.upgrade_websocket()
+
+            if websocket is None:
+                return
+
+            session = ConversationSession(websocket, conv, self.conversation_locks.get(conv_id), self.logger, self.scheduler)
+            detached = request.detach(lambda: self._run_session(conv_id, session), f"Hollowserver-Session-{conv_id}")
+
+        finally:
+            if not detached:
+                self.conversations.give_back(conv_id)
+
+
+
+
+
+    def _run_session(self, conv_id: str, session: ConversationSession):
+        """Serve a session until it's closed, then give its conversation back. Ran on the session's own thread.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+            session (ConversationSession): The session.
+        """
+
+        self.logger.info(f"Session opened for conversation \'{conv_id}\'.")
+
+        try:
+            session.run()
+
+        finally:
+            self.conversations.give_back(conv_id)
+            self.logger.info(f"Session closed for conversation \'{conv_id}\'.")
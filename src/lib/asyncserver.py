@@ -0,0 +1,445 @@
+# asyncserver.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""The asyncio backend of Hollowserver. Every connection is a coroutine on one event loop instead of an OS thread,
+which keeps idle streaming connections cheap."""
+
+# pylint: disable=wrong-import-position
+
+
+
+# Imports: Built-in/Standard
+import io                      # Used for the request body.
+import time                    # Used for the Date header.
+import asyncio                 # Used for the event loop and streams.
+import inspect                 # Used to tell whether a callback handed us a coroutine.
+import http.client             # Used for the header class.
+import email.parser            # Used to parse headers.
+import email.utils             # Used for the Date header.
+from http import HTTPStatus    # Used for status line phrases.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.server import HollowCoreCustomHTTP, NoSuchConversation # The HTTP server itself.
+from src.lib.httpio import HollowRequestMixin, BodyError             # HTTP/1.1 framing and request bodies.
+from src.lib.httpio import MAX_CHUNK_LINE                            # Used for chunked request bodies.
+
+
+
+# Constants
+
+MAX_HEADER_BYTES = 65536 # The largest request line + header block we're willing to buffer.
+SERVER_VERSION = "Hollowserver-asyncio"
+BODY_READ_SIZE = 1 << 16 # How much of a request body we read at a time.
+
+
+
+# Classes
+
+
+
+class _AsyncWriteFile:
+    """A file-like object that writes straight into an asyncio transport.
+
+    Writes are buffered by the transport and never block; callers that produce a lot of output (streaming completions)
+    should `await request.drain()` every now and then.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+
+
+    def write(self, data: bytes) -> int:
+        """Queue data for writing."""
+
+        self.writer.write(data)
+        return len(data)
+
+
+    def flush(self):
+        """Nothing to do; the transport sends as soon as it can."""
+
+
+
+
+
+class _AsyncRequestBase:
+    """The raw request/response primitives of an asyncio request, the equivalent of `http.server.BaseHTTPRequestHandler`."""
+
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self,
+                 server: HollowCoreCustomHTTP,
+                 reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter,
+                 client_address):
+        """An asyncio request.
+
+        Args:
+            server (HollowCoreCustomHTTP): The server this request belongs to.
+            reader (asyncio.StreamReader): The connection's reader.
+            writer (asyncio.StreamWriter): The connection's writer.
+            client_address: The address of the client.
+        """
+
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = client_address
+
+        self.command = ""
+        self.path = ""
+        self.request_version = "HTTP/1.0"
+        self.headers: http.client.HTTPMessage = http.client.HTTPMessage()
+        self.rfile = io.BytesIO()
+        self.wfile = _AsyncWriteFile(writer)
+        self.close_connection = True
+
+        self.match = None # Found by `read`.
+        self.params = {}
+        self.query = {}
+        self.route_rest = []
+
+        self._headers_buffer = []
+        self._body_timeout: float = None # See `read`.
+
+
+    async def read(self, idle_timeout: float = None) -> bool:
+        """Read the request line, headers and body from the connection.
+
+        Args:
+            idle_timeout (float, optional): How long to wait for the request to start, and for every piece of its body once
+            it has. A client that stalls for longer is answered with a 408. Defaults to forever.
+
+        Returns:
+            bool: Whether a request was read. False means the client went away, idled out, or sent garbage (already answered).
+        """
+
+        try:
+            head = await asyncio.wait_for(self.reader.readuntil(b"\r\n\r\n"), idle_timeout)
+
+        except (asyncio.IncompleteReadError, TimeoutError):
+            return False
+
+        except asyncio.LimitOverrunError:
+            self.reject(431, "Request header fields too large.")
+            return False
+
+        request_line, _, header_block = head.decode("iso-8859-1").partition("\r\n")
+        words = request_line.split()
+
+        if len(words) != 3 or not words[2].startswith("HTTP/"):
+            self.reject(400, "Bad request line.")
+            return False
+
+        self.command, self.path, self.request_version = words
+        self.headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(header_block)
+
+        connection = self.headers.get("Connection", "").lower()
+
+        if self.request_version >= "HTTP/1.1":
+            self.close_connection = connection == "close"
+
+        else:
+            self.close_connection = connection != "keep-alive"
+
+        # The body is read ahead of time, so callbacks never block the loop. Route first, so it's bounded by the limit of
+        # the route it's for, before a single byte of it is read.
+        self.match, self.query = self.server.route(self.command, self.path)
+        limit = self.server.body_limit(self.command, self.match)
+        transfer_encoding = self.headers.get("Transfer-Encoding")
+        content_length = self.headers.get("Content-Length")
+
+        self._body_timeout = idle_timeout
+
+        try:
+            if transfer_encoding is not None and transfer_encoding.lower().rsplit(",", 1)[-1].strip() == "chunked":
+                body = await self._read_chunked(limit)
+
+                # From here on, it's just a body with a length.
+                del self.headers["Transfer-Encoding"]
+                del self.headers["Content-Length"]
+                self.headers["Content-Length"] = str(len(body))
+                self.rfile = io.BytesIO(body)
+
+            elif content_length is not None:
+                length = int(content_length)
+
+                if length > limit:
+                    raise BodyError(413, "Request body too large.")
+
+                self.rfile = io.BytesIO(await self._read_exactly(length))
+
+        except TimeoutError:
+            self.reject(408, "Timed out reading the request body.")
+            return False
+
+        except BodyError as error:
+            self.reject(error.code, error.message)
+            return False
+
+        except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            self.reject(400, "Bad request body.")
+            return False
+
+        return True
+
+
+    async def _read_exactly(self, length: int) -> bytes:
+        """Read exactly `length` bytes of the body, a piece at a time, giving up if any piece takes too long.
+
+        Raises:
+            TimeoutError: If the client stalled for longer than the timeout given to `read`.
+            asyncio.IncompleteReadError: If the client went away first.
+        """
+
+        pieces = []
+        remaining = length
+
+        while remaining:
+            piece = await asyncio.wait_for(self.reader.read(min(remaining, BODY_READ_SIZE)), self._body_timeout)
+
+            if not piece:
+                raise asyncio.IncompleteReadError(b"".join(pieces), length)
+
+            pieces.append(piece)
+            remaining -= len(piece)
+
+        return b"".join(pieces)
+
+
+    async def _read_chunked(self, limit: int) -> bytes:
+        """Read and decode a chunked request body.
+
+        Args:
+            limit (int): The largest body to accept.
+
+        Returns:
+            bytes: The body.
+        """
+
+        pieces = []
+        size = 0
+
+        while True:
+            line = await asyncio.wait_for(self.reader.readuntil(b"\n"), self._body_timeout)
+
+            if len(line) > MAX_CHUNK_LINE:
+                raise BodyError(400, "Bad chunked request body.")
+
+            chunk_size = int(line.split(b";", 1)[0].strip(), 16)
+
+            if not chunk_size:
+                while (line := await asyncio.wait_for(self.reader.readuntil(b"\n"), self._body_timeout)) not in (b"\r\n", b"\n"):
+                    pass # Trailers, which we ignore.
+
+                return b"".join(pieces)
+
+            size += chunk_size
+
+            if size > limit:
+                raise BodyError(413, "Request body too large.")
+
+            pieces.append(await self._read_exactly(chunk_size))
+
+            if await self._read_exactly(2) != b"\r\n":
+                raise BodyError(400, "Bad chunked request body.")
+
+
+    def send_response(self, code: int, message: str = None):
+        """Queue the status line and the default headers.
+
+        Args:
+            code (int): The status code.
+            message (str, optional): The reason phrase. Defaults to the standard one.
+        """
+
+        self.server.logger.debug(f"{self.client_address[0]} \"{self.command} {self.path} {self.request_version}\" {code}")
+
+        if message is None:
+            try:
+                message = HTTPStatus(code).phrase
+
+            except ValueError:
+                message = ""
+
+        self._headers_buffer.append(f"{self.protocol_version} {code} {message}\r\n".encode("latin-1", "strict"))
+        self.send_header("Server", SERVER_VERSION)
+        self.send_header("Date", email.utils.formatdate(time.time(), usegmt=True))
+
+
+    def send_header(self, keyword: str, value: str):
+        """Queue a header.
+
+        Args:
+            keyword (str): The header name.
+            value (str): The header value.
+        """
+
+        self._headers_buffer.append(f"{keyword}: {value}\r\n".encode("latin-1", "strict"))
+
+        if keyword.lower() == "connection" and value.lower() == "close":
+            self.close_connection = True
+
+
+    def end_headers(self):
+        """Finish the header block and send it on its way."""
+
+        self._headers_buffer.append(b"\r\n")
+        self.writer.write(b"".join(self._headers_buffer))
+        self._headers_buffer = []
+
+
+    def reject(self, code: int, message: str):
+        """Answer a request we couldn't even parse, and give up on the connection.
+
+        Args:
+            code (int): The status code.
+            message (str): The error message.
+        """
+
+        self.close_connection = True
+        self.send_error_json(code, message)
+        self.finish_response()
+
+
+    async def drain(self):
+        """Wait until the transport's write buffer has room again."""
+
+        await self.writer.drain()
+
+
+    def take_turn(self, key: str): # pylint: disable=unused-argument
+        """No turns are reserved ahead of time here; see `HollowserverRequestHandler.take_turn`. Always None."""
+
+        return None
+
+
+
+
+
+class AsyncHollowRequest(HollowRequestMixin, _AsyncRequestBase):
+    """Quacks like `HollowCoreCustomHTTP.HollowserverRequestHandler`, so callbacks and providers can be shared between
+    backends. The body is read ahead of time, so `rfile` never blocks the event loop."""
+
+    is_async = True
+
+
+    async def dispatch(self):
+        """Route the request to its callbacks. Callbacks may return a coroutine, which is awaited."""
+
+        method = self.command
+
+        self.begin_request()
+
+        try:
+            match = self.match
+
+            if match is None:
+                self.send_error_json(404, "Path/endpoint not found (or wrong method)")
+                return
+
+            self.params = match.params
+            self.route_rest = match.rest
+
+            for callback in match.callbacks:
+                result = callback(self)
+
+                if inspect.isawaitable(result):
+                    await result
+
+        except NoSuchConversation:
+            pass
+
+        except BodyError as error:
+            self.server.logger.warning(f"Rejected {method} request body: {error.message}")
+
+            if self.response_started:
+                self.close_connection = True
+
+            else:
+                self.send_error_json(error.code, error.message)
+
+        except: # pylint: disable=bare-except
+            self.server.logger.error(f"Failed to process {method} request.", exc_info=True)
+
+            if self.response_started:
+                self.close_connection = True
+
+            else:
+                self.send_error_json(500, f"Failed to process {method} request.")
+
+        finally:
+            self.end_request()
+
+
+
+# Functions
+
+
+
+async def handle_connection(server: HollowCoreCustomHTTP, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Serve a single connection.
+
+    Args:
+        server (HollowCoreCustomHTTP): The server.
+        reader (asyncio.StreamReader): The connection's reader.
+        writer (asyncio.StreamWriter): The connection's writer.
+    """
+
+    client_address = writer.get_extra_info("peername") or ("?", 0)
+
+    try:
+        while True:
+            request = AsyncHollowRequest(server, reader, writer, client_address)
+
+            if not await request.read(server.keepalive_timeout):
+                break
+
+            await request.dispatch()
+            await writer.drain()
+
+            if request.close_connection:
+                break
+
+        await writer.drain()
+
+    except (ConnectionError, asyncio.IncompleteReadError):
+        server.logger.debug("Client went away mid-request.")
+
+    finally:
+        writer.close()
+
+        try:
+            await writer.wait_closed()
+
+        except ConnectionError:
+            pass
+
+
+
+
+
+async def serve_async(server: HollowCoreCustomHTTP):
+    """Serve on the server's already-bound listening socket until cancelled.
+
+    Args:
+        server (HollowCoreCustomHTTP): The server.
+    """
+
+    async_server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(server, reader, writer),
+        sock=server.socket,
+        limit=MAX_HEADER_BYTES,
+    )
+
+    server.logger.info("Serving requests on the asyncio backend.")
+
+    async with async_server:
+        await async_server.serve_forever()
@@ -0,0 +1,184 @@
+# batch.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Batches of operations across many conversations, in a single request (POST /batch).
+
+The body is a JSON array of operations. Every operation is an object with an "op" and the "conv" it applies to, and
+optionally an "id" (echoed back) and an "if_match" ETag (answered with a 412 if the conversation has changed since):
+
+>>> {"op": "ensure", "conv": "npc-1"}                                        # Like GET /ensure-exist.
+>>> {"op": "append", "conv": "npc-1", "message": {"role": "user", ...}}      # Like POST /memory.
+>>> {"op": "put", "conv": "npc-1", "messages": [...]}                        # Like PUT /memory.
+>>> {"op": "set", "conv": "npc-1", "index": 3, "message": {...}}             # Like PATCH /memory/<index>.
+>>> {"op": "delete", "conv": "npc-1", "index": 3}                            # Like DELETE /memory/<index>.
+>>> {"op": "get", "conv": "npc-1"}                                           # Like GET /memory.
+>>> {"op": "reset", "conv": "npc-1"}                                         # Like GET /reset.
+>>> {"op": "set_default", "conv": "npc-1", "values": {"temperature": 0.3}}   # Like POST /set-default.
+
+The answer is {"results": [...]}, one result per operation, in the same order. Every result has an HTTP-like "status",
+and either what the operation returns or an "error". Operations on the same conversation run in order; different
+conversations run in parallel. Completions aren't batchable; they go through the scheduler as usual.
+"""
+
+
+
+# Imports: Built-in/Standard
+import logging   # Used for logging.
+import traceback # Used to get information about exceptions.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.httpio import etag_matches # Used for "if_match".
+
+
+
+# Constants
+
+MAX_BATCH_OPERATIONS = 1000 # The most operations in a single batch.
+BATCH_WORKERS = 8           # How many conversations of a batch are worked on at once, on the threaded backends.
+
+BATCH_OPS = ("ensure", "append", "put", "set", "delete", "get", "reset", "set_default")
+
+
+
+# Functions
+
+def batch_result(operation, status: int, **fields) -> dict:
+    """Build the result of an operation.
+
+    Args:
+        operation: The operation.
+        status (int): The HTTP-like status.
+
+    Returns:
+        dict: The result, with the operation's "id", if it has one.
+    """
+
+    result = {"status": status}
+
+    if isinstance(operation, dict) and "id" in operation:
+        result["id"] = operation["id"]
+
+    return result | fields
+
+
+
+
+
+def group_operations(operations: list) -> tuple[dict[str, list[tuple[int, dict]]], dict[int, dict]]:
+    """Check the operations of a batch, and group them by conversation.
+
+    Args:
+        operations (list): The operations.
+
+    Returns:
+        tuple[dict[str, list[tuple[int, dict]]], dict[int, dict]]: The valid operations with their indices, by
+        conversation ID, in order; and the results of the invalid ones, by index.
+    """
+
+    groups: dict[str, list[tuple[int, dict]]] = {}
+    invalid: dict[int, dict] = {}
+
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict):
+            invalid[index] = batch_result(operation, 400, error="Operation was not a JSON object.")
+
+        elif operation.get("op") not in BATCH_OPS:
+            invalid[index] = batch_result(operation, 400, error=f"Unknown op \'{operation.get('op')}\'.")
+
+        elif not isinstance(operation.get("conv"), str) or not operation["conv"]:
+            invalid[index] = batch_result(operation, 400, error="Operation did not have a valid \"conv\".")
+
+        else:
+            groups.setdefault(operation["conv"], []).append((index, operation))
+
+    return groups, invalid
+
+
+
+
+
+def _index(conv, operation: dict) -> int:
+    """The "index" of an operation, checked against the conversation. None if it isn't valid."""
+
+    index = operation.get("index")
+
+    if not isinstance(index, int) or isinstance(index, bool) or not -len(conv.conversation) <= index < len(conv.conversation):
+        return None
+
+    return index
+
+
+
+
+
+def run_operation(conv, operation: dict, logger: logging.Logger) -> dict:
+    """Run a single operation of a batch against its conversation. Call it with the conversation's lock held.
+    "ensure" is handled by the caller, as it doesn't need the conversation.
+
+    Args:
+        conv (BaseAIProvider): The conversation.
+        operation (dict): The operation.
+        logger (logging.Logger): The logger to use.
+
+    Returns:
+        dict: The result.
+    """
+
+    if "if_match" in operation and not etag_matches(operation["if_match"], conv.etag):
+        return batch_result(operation, 412, error="Conversation changed since it was last read.", etag=conv.etag)
+
+    try:
+        match operation["op"]:
+
+            case "append":
+                conv.append_message(operation.get("message"))
+
+            case "put":
+                if not isinstance(operation.get("messages"), list):
+                    return batch_result(operation, 400, error="\"messages\" must be a list.")
+
+                conv.conversation = operation["messages"]
+
+            case "set":
+                index = _index(conv, operation)
+
+                if index is None:
+                    return batch_result(operation, 400, error="Operation did not have a valid index.")
+
+                conv.set_message(index, operation.get("message"))
+
+            case "delete":
+                index = _index(conv, operation)
+
+                if index is None:
+                    return batch_result(operation, 400, error="Operation did not have a valid index.")
+
+                conv.delete_message(index)
+
+            case "get":
+                # Sent once the whole batch is done, when the lock is long gone; messages are immutable, the list isn't.
+                return batch_result(operation, 200, etag=conv.etag, messages=conv.conversation.copy())
+
+            case "reset":
+                conv.reset_conversation()
+
+            case "set_default":
+                try:
+                    conv.update_defaults(operation.get("values"))
+
+                except ValueError as error:
+                    return batch_result(operation, 400, error=str(error))
+
+    except: # pylint: disable=bare-except
+        logger.error(f"Batch operation \'{operation['op']}\' on \'{operation['conv']}\' failed.")
+        logger.debug(traceback.format_exc())
+        return batch_result(operation, 500, error="Operation failed.")
+
+    return batch_result(operation, 200, etag=conv.etag, length=len(conv.conversation))
@@ -0,0 +1,449 @@
+# completioncache.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""An opt-in cache of deterministic completions. A completion is deterministic if it's sent with a temperature of 0 or a
+fixed seed: the same payload (messages, model, options...) then always gets the same response, so there's no need to ask
+the model again. Templated NPC barks and test harnesses send the same prompts over and over.
+
+Entries are keyed by a hash of the payload (`payload_key`), kept in memory in LRU order within a byte budget, expire
+after a while, and can be written through to a directory, so they survive restarts. A cached completion is replayed
+chunk by chunk, exactly as it was generated, so streamed and non-streamed requests both get what they would have.
+Completions that called tools are never cached; their tools would not be called again.
+"""
+
+
+
+# Imports: Built-in/Standard
+import os                           # Used for the disk tier.
+import asyncio                      # Used to keep the disk off the event loop.
+import json                         # Used to hash payloads, and for the disk tier.
+import time                         # Used to expire entries.
+import types                        # Used for replayed chunks.
+import hashlib                      # Used to hash payloads.
+import logging                      # Used for logging.
+import threading                    # Used to guard the cache.
+import traceback                    # Used to get information about exceptions.
+from collections import OrderedDict # Used to keep entries in LRU order.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+# ...
+
+
+
+# Constants
+
+DEFAULT_TTL = 3600.0                # Seconds an entry is kept.
+DEFAULT_MAX_BYTES = 64 << 20        # The most (estimated) bytes of entries kept in memory.
+DEFAULT_MAX_DISK_BYTES = 256 << 20  # The most bytes of entries kept on disk.
+
+CHUNK_OVERHEAD = 64 # Rough bytes of a cached chunk besides its text.
+ENTRY_OVERHEAD = 256 # The same, for an entry: its key, the list, the LRU bookkeeping...
+
+UNKEYED = ("stream", "keep_alive") # Parts of the payload that don't change the response.
+SUFFIX = ".json"
+
+
+
+# Functions
+
+def _encode(value):
+    """Encode what `json` can't on its own: conversations (any sequence of messages) and tools (functions)."""
+
+    if callable(value):
+        return f"{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}"
+
+    try:
+        return list(value)
+
+    except TypeError:
+        return repr(value)
+
+
+
+
+
+def is_deterministic(payload: dict) -> bool:
+    """Whether a completion always gets the same response: a temperature of 0, or a fixed seed.
+
+    Args:
+        payload (dict): The arguments of the completion.
+
+    Returns:
+        bool: Whether it is.
+    """
+
+    options = payload.get("options")
+
+    return isinstance(options, dict) and (options.get("temperature") == 0 or options.get("seed") is not None)
+
+
+
+
+
+def payload_key(payload: dict) -> str:
+    """Hash the arguments of a completion, for a key that's the same for the same payload, on any run.
+
+    Args:
+        payload (dict): The arguments. Every message is read, so this takes longer the longer the prompt is.
+
+    Returns:
+        str: The key (hex).
+    """
+
+    keyed = {key: value for key, value in payload.items() if key not in UNKEYED}
+    encoded = json.dumps(keyed, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=_encode)
+
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+
+
+
+def replay(chunks: list):
+    """Replay a cached completion, as if it was being generated.
+
+    Args:
+        chunks (list): The cached chunks.
+
+    Yields:
+        The chunks, shaped like the ones the model sends.
+    """
+
+    for index, (content, thinking) in enumerate(chunks):
+        message = types.SimpleNamespace(content=content, thinking=thinking, tool_calls=None)
+        yield types.SimpleNamespace(message=message, done=index == len(chunks) - 1)
+
+
+
+
+
+async def areplay(chunks: list):
+    """The async counterpart of `replay`."""
+
+    for chunk in replay(chunks):
+        yield chunk
+
+
+
+# Classes
+
+
+
+class CompletionCache:
+    """Deterministic completions, by the key of their payload. Thread-safe; shared by every conversation."""
+
+    def __init__(self,
+                 logger: logging.Logger,
+                 ttl: float = DEFAULT_TTL,
+                 max_bytes: int = DEFAULT_MAX_BYTES,
+                 directory: str = None,
+                 max_disk_bytes: int = DEFAULT_MAX_DISK_BYTES,
+                 ):
+        """A completion cache.
+
+        Args:
+            logger (logging.Logger): The logger to use.
+            ttl (float, optional): Seconds an entry is kept. 0 or less keeps them until they're evicted. Defaults to 3600.
+            max_bytes (int, optional): The most (estimated) bytes of entries kept in memory. Defaults to 64 MiB.
+            directory (str, optional): Where entries are written through to, and looked up when they're not in memory.
+            Defaults to None (memory only).
+            max_disk_bytes (int, optional): The most bytes of entries kept in `directory`. Defaults to 256 MiB.
+        """
+
+        self.logger = logger
+        self.ttl = ttl
+        self.max_bytes = max(0, max_bytes)
+        self.directory = directory
+        self.max_disk_bytes = max(0, max_disk_bytes)
+
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[float, int, list]] = OrderedDict() # Key -> (created, size, chunks), oldest first.
+        self.bytes = 0
+        self.disk_entries: OrderedDict[str, int] = OrderedDict() # Key -> file size, oldest first.
+        self.disk_bytes = 0
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        if directory:
+            self._scan()
+
+
+    def _scan(self):
+        """Find the entries a previous run left on disk."""
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            found = [(entry.stat().st_mtime, entry.name[:-len(SUFFIX)], entry.stat().st_size)
+                     for entry in os.scandir(self.directory) if entry.name.endswith(SUFFIX) and entry.is_file()]
+
+        except: # pylint: disable=bare-except
+            self.logger.error(f"Failed to read the completion cache in \'{self.directory}\'; not using it.")
+            self.logger.debug(traceback.format_exc())
+            self.directory = None
+            return
+
+        for _, key, size in sorted(found):
+            self.disk_entries[key] = size
+            self.disk_bytes += size
+
+        if found:
+            self.logger.info(f"Found {len(found)} cached completion(s) in \'{self.directory}\'.")
+
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + SUFFIX)
+
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+
+    def get(self, key: str) -> list:
+        """Look up a completion, in memory, then on disk.
+
+        Args:
+            key (str): The key of its payload. See `payload_key`.
+
+        Returns:
+            list: The cached chunks (don't change them), or None if there are none, or they expired.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+
+                self._drop(key)
+                self.expirations += 1
+
+            on_disk = key in self.disk_entries
+            expired = entry is not None # The copy on disk is just as old.
+
+        if on_disk and expired:
+            self._delete(key)
+
+        entry = self._read(key) if on_disk and not expired else None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.disk_hits += 1
+            self._insert(key, entry[0], entry[1])
+
+        return entry[1]
+
+
+    def _read(self, key: str) -> tuple[float, list]:
+        """Read an entry off disk. None if it's gone, unreadable, or expired (it's deleted then)."""
+
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+
+            created, chunks = entry["created"], [tuple(chunk) for chunk in entry["chunks"]]
+
+        except: # pylint: disable=bare-except
+            self.logger.warning(f"Failed to read cached completion \'{key}\'; dropping it.")
+            self.logger.debug(traceback.format_exc())
+            self._delete(key)
+            return None
+
+        if self._expired(created):
+            self._delete(key)
+
+            with self.lock:
+                self.expirations += 1
+
+            return None
+
+        return created, chunks
+
+
+    def put(self, key: str, chunks: list):
+        """Cache a completion, replacing whatever was cached for the same payload.
+
+        Args:
+            key (str): The key of its payload. See `payload_key`.
+            chunks (list): The (content, thinking) of every chunk, in order.
+        """
+
+        created = time.time()
+
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+
+            if not self._insert(key, created, chunks):
+                return
+
+            self.stores += 1
+
+        if self.directory:
+            self._write(key, created, chunks)
+
+
+    def _insert(self, key: str, created: float, chunks: list) -> bool:
+        """Add an entry to memory, evicting the least recently used ones to make room. Call it with the lock held.
+
+        Returns:
+            bool: Whether it fit at all.
+        """
+
+        size = ENTRY_OVERHEAD + sum(CHUNK_OVERHEAD + len(content or "") + len(thinking or "") for content, thinking in chunks)
+
+        if size > self.max_bytes:
+            return False
+
+        while self.bytes + size > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+        self.entries[key] = (created, size, chunks)
+        self.bytes += size
+
+        return True
+
+
+    def _drop(self, key: str):
+        """Drop an entry from memory. Call it with the lock held."""
+
+        self.bytes -= self.entries.pop(key)[1]
+
+
+    def _write(self, key: str, created: float, chunks: list):
+        """Write an entry through to disk, deleting the oldest ones beyond the disk budget."""
+
+        path = self._path(key)
+        temporary_path = path + ".tmp"
+
+        try:
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                json.dump({"created": created, "chunks": chunks}, f, ensure_ascii=False)
+
+            os.replace(temporary_path, path)
+            size = os.path.getsize(path)
+
+        except: # pylint: disable=bare-except
+            self.logger.warning(f"Failed to write cached completion \'{key}\' to disk.")
+            self.logger.debug(traceback.format_exc())
+            return
+
+        with self.lock:
+            self.disk_bytes += size - self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = size
+
+            oldest = []
+
+            while self.disk_bytes > self.max_disk_bytes and len(self.disk_entries) > 1:
+                old_key, old_size = self.disk_entries.popitem(last=False)
+                self.disk_bytes -= old_size
+                oldest.append(old_key)
+
+        for old_key in oldest:
+            self._delete(old_key, forget=False)
+
+
+    def _delete(self, key: str, forget: bool = True):
+        """Delete an entry from disk."""
+
+        if forget:
+            with self.lock:
+                self.disk_bytes -= self.disk_entries.pop(key, 0)
+
+        try:
+            os.remove(self._path(key))
+
+        except FileNotFoundError:
+            pass
+
+
+    def record(self, key: str, stream):
+        """Pass a completion through as it's generated, and cache it once it's done. Nothing is cached if it called tools,
+        or wasn't read to the end.
+
+        Args:
+            key (str): The key of its payload. See `payload_key`.
+            stream: The chunks, as the model sends them.
+
+        Yields:
+            The same chunks.
+        """
+
+        chunks = []
+        cacheable = True
+
+        for chunk in stream:
+            cacheable = cacheable and self._keep(chunk, chunks)
+            yield chunk
+
+        if cacheable and chunks:
+            self.put(key, chunks)
+
+
+    async def arecord(self, key: str, stream):
+        """The async counterpart of `record`. Writing the entry to disk is kept off the event loop."""
+
+        chunks = []
+        cacheable = True
+
+        async for chunk in stream:
+            cacheable = cacheable and self._keep(chunk, chunks)
+            yield chunk
+
+        if cacheable and chunks:
+            await asyncio.to_thread(self.put, key, chunks)
+
+
+    def _keep(self, chunk, chunks: list) -> bool:
+        """Keep what's replayed of a chunk. Returns False if it called tools."""
+
+        message = getattr(chunk, "message", None)
+
+        if getattr(message, "tool_calls", None):
+            return False
+
+        chunks.append((getattr(message, "content", None), getattr(message, "thinking", None)))
+
+        return True
+
+
+    def stats(self) -> dict:
+        """The live state of the cache.
+
+        Returns:
+            dict: Counters, and what's held in memory and on disk.
+        """
+
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "disk_entries": len(self.disk_entries),
+                "disk_bytes": self.disk_bytes,
+                "limits": {"ttl": self.ttl, "max_bytes": self.max_bytes, "max_disk_bytes": self.max_disk_bytes},
+            }
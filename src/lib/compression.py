@@ -0,0 +1,174 @@
+# compression.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Response compression for Hollowserver: Accept-Encoding negotiation, whole-body compression and streaming compressors
+for chunked responses. gzip and deflate are always available; zstd is used if the `zstandard` package is installed."""
+
+
+
+# Imports: Built-in/Standard
+import zlib # gzip and deflate.
+
+
+# Imports: Third-party
+
+# pylint: disable=invalid-name
+zstd_is_available = False
+try:
+    import zstandard
+    zstd_is_available = True
+except ImportError:
+    pass
+# pylint: enable=invalid-name
+
+
+# Imports: Local/source
+# ...
+
+
+
+# Constants
+
+COMPRESSION_THRESHOLD = 1024 # Bodies smaller than this aren't worth compressing.
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# In order of preference, when the client is equally happy with several.
+ENCODINGS = (("zstd",) if zstd_is_available else ()) + ("gzip", "deflate")
+
+
+
+# Functions
+
+def negotiate(accept_encoding: str) -> str:
+    """Pick the encoding to use for a response.
+
+    Args:
+        accept_encoding (str): The request's Accept-Encoding header, if any.
+
+    Returns:
+        str: "zstd", "gzip" or "deflate", or None for no compression.
+    """
+
+    if not accept_encoding:
+        return None
+
+    weights = {}
+
+    for entry in accept_encoding.lower().split(","):
+        name, _, parameters = entry.partition(";")
+        weight = 1.0
+
+        parameters = parameters.strip()
+
+        if parameters.startswith("q="):
+            try:
+                weight = float(parameters[2:])
+
+            except ValueError:
+                weight = 0.0
+
+        weights[name.strip()] = weight
+
+    wildcard = weights.get("*", 0.0)
+    best, best_weight = None, 0.0
+
+    for encoding in ENCODINGS:
+        weight = weights.get(encoding, wildcard)
+
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+
+    return best
+
+
+
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress a whole body.
+
+    Args:
+        data (bytes): The body.
+        encoding (str): "zstd", "gzip" or "deflate".
+
+    Returns:
+        bytes: The compressed body.
+    """
+
+    match encoding:
+
+        case "zstd":
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+        case "gzip":
+            compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return compressor.compress(data) + compressor.flush()
+
+        case "deflate":
+            return zlib.compress(data, ZLIB_LEVEL)
+
+    raise ValueError(f"Unknown encoding \'{encoding}\'.")
+
+
+
+# Classes
+
+
+
+class StreamCompressor:
+    """Compresses a streamed response piece by piece. Every piece is flushed, so the client can decode it right away."""
+
+    def __init__(self, encoding: str):
+        """A streaming compressor.
+
+        Args:
+            encoding (str): "zstd", "gzip" or "deflate".
+        """
+
+        self.encoding = encoding
+
+        match encoding:
+
+            case "zstd":
+                self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+            case "gzip":
+                self.compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+            case "deflate":
+                self.compressor = zlib.compressobj(ZLIB_LEVEL)
+
+            case _:
+                raise ValueError(f"Unknown encoding \'{encoding}\'.")
+
+
+    def compress(self, data: bytes) -> bytes:
+        """Compress a piece, flushing it through.
+
+        Args:
+            data (bytes): The piece.
+
+        Returns:
+            bytes: Everything that can be sent so far.
+        """
+
+        if self.encoding == "zstd":
+            return self.compressor.compress(data) + self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+    def finish(self, data: bytes = b"") -> bytes:
+        """Compress a last piece and end the stream.
+
+        Args:
+            data (bytes, optional): The last piece.
+
+        Returns:
+            bytes: The rest of the stream.
+        """
+
+        return self.compressor.compress(data) + self.compressor.flush()
@@ -0,0 +1,274 @@
+# context.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Context window management. Conversations keep a running estimate of how many tokens they take up, and once one no
+longer fits the model's context window, a context policy picks the messages that are sent:
+
+>>> "truncate"  # The startout, then as many of the newest messages as fit. The middle is left out.
+>>> "summarize" # The same, with a short recap of what was left out in its place.
+>>> "none"      # Everything, and let the model deal with it.
+
+Token counts are estimates (about 4 characters per token); we don't have the model's tokenizer, and don't need to be
+exact, only to keep the prompt from growing without bound.
+
+The context window itself (`num_ctx`) is snapped to one of a few sizes (`snap_num_ctx`). The backend reloads a model
+whenever it's asked for a different `num_ctx` than it was loaded with, so conversations that each picked their own size
+would keep reloading it; snapped, conversations share a handful of sizes, and most of them share the default.
+"""
+
+
+
+# Imports: Built-in/Standard
+# ...
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.message import Message # Messages are what's counted.
+
+
+
+# Constants
+
+CHARS_PER_TOKEN = 4        # A rough average for English text with the usual tokenizers.
+MESSAGE_TOKEN_OVERHEAD = 4 # The tokens the chat template adds around every message.
+
+CONTEXT_POLICIES = ("truncate", "summarize", "none")
+DEFAULT_CONTEXT_POLICY = "truncate"
+RESPONSE_RESERVE = 512     # Tokens of the context window left free for the response, unless `num_predict` says otherwise.
+
+NUM_CTX_BUCKETS = (2048, 4096, 8192, 16384, 32768) # The context window sizes conversations are snapped to.
+
+SUMMARY_TOKENS = 256       # The most tokens a recap of left out messages takes up.
+SUMMARY_LINE_CHARS = 120   # How much of each left out message makes it into the recap.
+
+
+
+# Functions
+
+def _field(message, key: str):
+    """Read a key of a message, whether it's a `Message` or a dict. None if it's neither, or doesn't have it."""
+
+    return message.get(key) if isinstance(message, (Message, dict)) else None
+
+
+
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate how many tokens a piece of text is.
+
+    Args:
+        text (str): The text.
+
+    Returns:
+        int: The estimate.
+    """
+
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+
+
+
+def message_tokens(message) -> int:
+    """Estimate how many tokens a message takes up in the prompt.
+
+    Args:
+        message: The message. Usually a `Message`; anything else that isn't a dict only counts its overhead.
+
+    Returns:
+        int: The estimate.
+    """
+
+    if type(message) is Message: # pylint: disable=unidiomatic-typecheck
+        tokens = MESSAGE_TOKEN_OVERHEAD + estimate_tokens(message.content)
+
+        for _, value in message.extra:
+            if isinstance(value, str):
+                tokens += estimate_tokens(value)
+
+        return tokens
+
+    if not isinstance(message, dict):
+        return MESSAGE_TOKEN_OVERHEAD
+
+    return MESSAGE_TOKEN_OVERHEAD + sum(
+        estimate_tokens(value) for key, value in message.items() if key != "role" and isinstance(value, str)
+    ) # The role is part of the overhead, like for a `Message`.
+
+
+
+
+
+def conversation_tokens(messages) -> int:
+    """Estimate how many tokens a whole conversation takes up in the prompt.
+
+    Args:
+        messages: The conversation.
+
+    Returns:
+        int: The estimate.
+    """
+
+    return sum(map(message_tokens, messages))
+
+
+
+
+
+def context_budget(num_ctx: int, num_predict: int = None) -> int:
+    """Work out how many tokens of a context window the prompt may take up.
+
+    Args:
+        num_ctx (int): The size of the context window.
+        num_predict (int, optional): The most tokens the response may be, if it's limited. Defaults to None.
+
+    Returns:
+        int: The budget. Never less than a quarter of the window.
+    """
+
+    reserve = num_predict if isinstance(num_predict, int) and num_predict > 0 else RESPONSE_RESERVE
+
+    return max(num_ctx - reserve, num_ctx // 4)
+
+
+
+
+
+def snap_num_ctx(num_ctx: int, buckets: tuple[int, ...] = NUM_CTX_BUCKETS) -> int:
+    """Snap a context window size to the smallest bucket it fits in.
+
+    Args:
+        num_ctx (int): The requested size.
+        buckets (tuple[int, ...], optional): The buckets, smallest first. Empty to leave sizes alone. Defaults to
+        `NUM_CTX_BUCKETS`.
+
+    Returns:
+        int: The bucket. The largest one if the request is larger than that; the context policy makes the prompt fit.
+        Anything that isn't a positive integer is returned as it is.
+    """
+
+    if not buckets or not isinstance(num_ctx, int) or isinstance(num_ctx, bool) or num_ctx <= 0:
+        return num_ctx
+
+    for bucket in buckets:
+        if num_ctx <= bucket:
+            return bucket
+
+    return buckets[-1]
+
+
+
+
+
+def summarize(messages, start: int, end: int, budget: int) -> Message:
+    """Build a recap of messages that were left out of the prompt: the start of each, newest last, within a budget.
+    This is extractive (no model is asked), so it's free, and the same messages always give the same recap.
+
+    Args:
+        messages: The conversation.
+        start (int): The index of the first message left out.
+        end (int): The index after the last message left out.
+        budget (int): The most tokens the recap may take up.
+
+    Returns:
+        Message: The recap, as a system message. None if not even one line of it fits.
+    """
+
+    header = f"{end - start} earlier message(s) were left out to fit the context window. They began:"
+    tokens = MESSAGE_TOKEN_OVERHEAD + estimate_tokens(header)
+    lines = []
+
+    for index in range(end - 1, start - 1, -1): # The newest are the most relevant; keep those if they don't all fit.
+        message = messages[index]
+        role, content = _field(message, "role"), _field(message, "content")
+
+        if not isinstance(content, str) or not content.strip():
+            continue
+
+        text = " ".join(content.split())
+        line = f"- {role}: {text[:SUMMARY_LINE_CHARS]}{'...' if len(text) > SUMMARY_LINE_CHARS else ''}"
+        line_tokens = estimate_tokens(line) + 1
+
+        if tokens + line_tokens > budget:
+            break
+
+        lines.append(line)
+        tokens += line_tokens
+
+    if not lines:
+        return None
+
+    return Message("system", "\n".join([header, *reversed(lines)]))
+
+
+
+
+
+def select_context(messages,
+                   total_tokens: int,
+                   budget: int,
+                   pinned: int,
+                   policy: str = DEFAULT_CONTEXT_POLICY,
+                   ) -> tuple[list, int]:
+    """Pick the messages of a conversation to send, so that the prompt fits a budget.
+
+    The first `pinned` messages (the startout) are always sent, and so is the newest message, even if that alone goes over
+    the budget; the newest messages are then added for as long as they fit. A kept run of messages never starts with a
+    tool result, since it would be missing the call it answers.
+
+    Args:
+        messages: The conversation.
+        total_tokens (int): The estimated tokens of the whole conversation (see `conversation_tokens`).
+        budget (int): The most tokens the prompt may take up (see `context_budget`).
+        pinned (int): How many messages at the start are always sent.
+        policy (str, optional): The context policy. See `CONTEXT_POLICIES`. Defaults to "truncate".
+
+    Returns:
+        tuple[list, int]: The messages to send (the conversation itself, if it all fits), and how many were left out.
+    """
+
+    if policy == "none" or total_tokens <= budget or len(messages) <= pinned + 1:
+        return messages, 0
+
+    head = messages[:pinned]
+    remaining = budget - conversation_tokens(head)
+
+    if policy == "summarize":
+        remaining -= SUMMARY_TOKENS
+
+    start = len(messages) - 1 # The newest message goes out no matter what.
+    remaining -= message_tokens(messages[start])
+
+    while start - 1 >= pinned:
+        cost = message_tokens(messages[start - 1])
+
+        if cost > remaining:
+            break
+
+        remaining -= cost
+        start -= 1
+
+    while start < len(messages) - 1 and _field(messages[start], "role") == "tool":
+        start += 1
+
+    if start == pinned:
+        return messages, 0
+
+    selected = list(head)
+
+    if policy == "summarize":
+        recap = summarize(messages, pinned, start, SUMMARY_TOKENS)
+
+        if recap is not None:
+            selected.append(recap)
+
+    selected.extend(messages[start:])
+
+    return selected, start - pinned
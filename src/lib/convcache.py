@@ -0,0 +1,459 @@
+# convcache.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""A memory-bounded cache of conversations. Once there are too many resident conversations, or they hold too many bytes,
+the least recently used idle ones are written out to disk and dropped, and brought back the next time they're asked for.
+
+A spilled conversation leaves behind its settings (`<id>.state.json`) and, unless it's journaled anyway, its messages
+(`<id>.hfm`, see src/lib/memfile.py), which are mapped back in lazily when it's rehydrated.
+"""
+
+
+
+# Imports: Built-in/Standard
+import os                               # Used for file manipulation.
+import json                             # Used for state files.
+import logging                          # Used for logging.
+import threading                        # Used to guard the cache.
+import traceback                        # Used to get information about exceptions.
+import contextlib                       # Used for `use`.
+from collections import OrderedDict     # Used to keep conversations in LRU order.
+from urllib.parse import quote          # Used to turn conversation IDs into file names.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.memfile import LazyConversation, MemoryFile, write_memory_file # Spilled messages.
+from src.lib.message import Message                                         # Used to size messages.
+from src.lib.forks import SharedConversation                                # Shared messages are counted once.
+
+
+
+# Constants
+
+MESSAGE_OVERHEAD = 256 # Rough bytes of a message besides its text: the dict, its keys, object headers...
+COMPACT_MESSAGE_OVERHEAD = 112 # The same, for a `Message`: its slots and the header of its text.
+
+STATE_SUFFIX = ".state.json"
+MESSAGES_SUFFIX = ".hfm"
+
+
+
+# Functions
+
+def message_size(message) -> int:
+    """Estimate how much memory a message takes up.
+
+    Args:
+        message: The message. Usually a `Message`; a dict of strings if it wasn't in the usual format.
+
+    Returns:
+        int: The estimate, in bytes.
+    """
+
+    if type(message) is Message: # pylint: disable=unidiomatic-typecheck
+        return COMPACT_MESSAGE_OVERHEAD + len(message.content) + sum(len(value) for _, value in message.extra if isinstance(value, str))
+
+    if not isinstance(message, dict):
+        return MESSAGE_OVERHEAD
+
+    return MESSAGE_OVERHEAD + sum(len(value) for value in message.values() if isinstance(value, str))
+
+
+
+
+
+def conversation_size(messages) -> int:
+    """Estimate how much memory a conversation takes up. A lazy conversation that hasn't been decoded only counts its map,
+    and a shared one only what it doesn't share (see src/lib/forks.py).
+
+    Args:
+        messages: The conversation.
+
+    Returns:
+        int: The estimate, in bytes.
+    """
+
+    if isinstance(messages, LazyConversation) and messages.items is None:
+        return len(messages.file.map)
+
+    if isinstance(messages, SharedConversation) and messages.items is None:
+        return sum(map(message_size, messages.tail))
+
+    return sum(map(message_size, messages))
+
+
+
+# Classes
+
+
+
+class ConversationCache:
+    """Conversations by ID, at most `max_conversations` and `max_bytes` of them resident at once (0 for no limit).
+
+    Conversations must be taken out with `use`, which keeps them from being spilled while they're being used. Spilling
+    happens when a conversation is handed back, so on the thread of a request that has already been answered.
+    """
+
+    def __init__(self,
+                 factory: callable,
+                 spill_dir: str,
+                 logger: logging.Logger,
+                 max_conversations: int = 0,
+                 max_bytes: int = 0,
+                 on_evict: callable = None,
+                 ):
+        """A conversation cache.
+
+        Args:
+            factory (callable): Constructs a fresh conversation from its ID (restoring it from its journal, if it has one).
+            spill_dir (str): Where spilled conversations go. Created if needed.
+            logger (logging.Logger): The logger to use.
+            max_conversations (int, optional): The most conversations resident at once. Defaults to 0 (no limit).
+            max_bytes (int, optional): The most (estimated) bytes of messages resident at once. Defaults to 0 (no limit).
+            on_evict (callable, optional): Called with the ID of every conversation spilled, e.g. to drop its locks.
+        """
+
+        self.factory = factory
+        self.spill_dir = spill_dir
+        self.logger = logger
+        self.max_conversations = max(0, max_conversations)
+        self.max_bytes = max(0, max_bytes)
+        self.on_evict = on_evict
+
+        self.lock = threading.Lock()
+        self.resident: OrderedDict[str, object] = OrderedDict() # Least recently used first.
+        self.pins: dict[str, int] = {}                          # Conversation ID -> users right now.
+        self.spilled: set[str] = set()                          # On disk only.
+        self.evicting: dict[str, threading.Event] = {}          # Being written out; set once they're on disk.
+        self.loading: dict[str, threading.Event] = {}           # Being created or rehydrated; set once they're resident.
+        self.clean_versions: dict[str, int] = {}                # Version of a rehydrated conversation's spilled messages.
+
+        self.evictions = 0
+        self.rehydrations = 0
+
+
+    def _paths(self, conv_id: str) -> tuple[str, str]:
+        name = quote(conv_id, safe="")
+        return os.path.join(self.spill_dir, name + STATE_SUFFIX), os.path.join(self.spill_dir, name + MESSAGES_SUFFIX)
+
+
+    def __contains__(self, conv_id: str) -> bool:
+        with self.lock:
+            return conv_id in self.resident or conv_id in self.spilled or conv_id in self.evicting or conv_id in self.loading
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.resident) + len(self.spilled) + len(self.evicting)
+
+
+    def add(self, conv_id: str, conv):
+        """Add a conversation, as resident.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+            conv (BaseAIProvider): The conversation.
+        """
+
+        with self.lock:
+            self.resident[conv_id] = conv
+
+        self._evict_if_needed()
+
+
+    def add_spilled(self, conv_id: str):
+        """Make a conversation that's already on disk (e.g. journaled in a previous run) known, without loading it.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+        """
+
+        with self.lock:
+            if conv_id not in self.resident:
+                self.spilled.add(conv_id)
+
+
+    def create(self, conv_id: str, setup: callable = None) -> bool:
+        """Create a conversation if it doesn't exist yet.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+            setup (callable, optional): Called with the new conversation before anyone else can get to it. Only requests
+            for this conversation wait on it.
+
+        Returns:
+            bool: Whether it was created.
+        """
+
+        while True:
+            with self.lock:
+                loading = self.loading.get(conv_id)
+
+                if loading is None:
+                    if conv_id in self.resident or conv_id in self.spilled or conv_id in self.evicting:
+                        return False
+
+                    self.loading[conv_id] = threading.Event()
+                    break
+
+            loading.wait() # Somebody else is creating it right now; it exists once they're done, unless they failed.
+
+        try:
+            conv = self.factory(conv_id) # Outside the lock; it may replay a journal.
+
+            if setup is not None:
+                setup(conv)
+
+        except: # pylint: disable=bare-except
+            self._loaded(conv_id)
+            raise
+
+        self._loaded(conv_id, conv)
+        self._evict_if_needed()
+
+        return True
+
+
+    def take(self, conv_id: str):
+        """Pin a conversation, rehydrating it if it was spilled. Prefer `use`; every `take` needs a `give_back`.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+
+        Returns:
+            BaseAIProvider: The conversation, or None if there's no such conversation.
+        """
+
+        while True:
+            with self.lock:
+                busy = self.evicting.get(conv_id) or self.loading.get(conv_id)
+
+                if busy is None:
+                    conv = self.resident.get(conv_id)
+
+                    if conv is not None:
+                        self.resident.move_to_end(conv_id)
+                        self.pins[conv_id] = self.pins.get(conv_id, 0) + 1
+
+                        return conv
+
+                    if conv_id not in self.spilled:
+                        return None
+
+                    self.loading[conv_id] = threading.Event()
+                    break
+
+            busy.wait() # Let it get to disk first, then bring it right back; or let whoever is loading it finish.
+
+        return self._rehydrate(conv_id)
+
+
+    def give_back(self, conv_id: str):
+        """Unpin a conversation taken with `take`, and spill whatever is over budget.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+        """
+
+        with self.lock:
+            self.pins[conv_id] -= 1
+
+            if not self.pins[conv_id]:
+                del self.pins[conv_id]
+
+        self._evict_if_needed()
+
+
+    @contextlib.contextmanager
+    def use(self, conv_id: str):
+        """Use a conversation. It won't be spilled until the block is left.
+
+        >>> with conversations.use("default") as conv:
+        >>>     if conv is None: ... # No such conversation.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+
+        Yields:
+            BaseAIProvider: The conversation, or None if there's no such conversation.
+        """
+
+        conv = self.take(conv_id)
+
+        try:
+            yield conv
+
+        finally:
+            if conv is not None:
+                self.give_back(conv_id)
+
+
+    def _rehydrate(self, conv_id: str):
+        """Bring a spilled conversation back, pinned. Called without the lock held, once it's marked as loading; requests
+        for other conversations go on in the meantime.
+
+        Returns:
+            BaseAIProvider: The conversation.
+        """
+
+        state_path, messages_path = self._paths(conv_id)
+
+        try:
+            conv = self.factory(conv_id) # Replays its journal, if it has one.
+
+            if conv.journal is None and os.path.exists(messages_path):
+                conv.conversation = LazyConversation(MemoryFile(messages_path))
+
+            if os.path.exists(state_path):
+                with open(state_path, "r", encoding="utf-8") as f:
+                    conv.import_state(json.load(f))
+
+                # It's only good until the conversation changes again. If we crash before it's spilled next, its journal
+                # will have moved on, and the restored version must not match ETags handed out before.
+                os.remove(state_path)
+
+        except: # pylint: disable=bare-except
+            self._loaded(conv_id) # Still spilled; the next request tries again.
+            raise
+
+        self._loaded(conv_id, conv, rehydrated=True)
+
+        self.logger.debug(f"Rehydrated conversation \'{conv_id}\'.")
+
+        return conv
+
+
+    def _loaded(self, conv_id: str, conv=None, rehydrated: bool = False):
+        """Publish a conversation that was being created or rehydrated, and wake up whoever waited on it.
+
+        Args:
+            conv_id (str): The ID of the conversation.
+            conv (BaseAIProvider, optional): The conversation. Defaults to None (loading it failed).
+            rehydrated (bool, optional): Whether it was rehydrated (it's pinned for whoever took it), not created.
+        """
+
+        with self.lock:
+            if conv is not None:
+                if rehydrated:
+                    if conv.journal is None:
+                        self.clean_versions[conv_id] = conv.version # No need to write the messages out again, unless they change.
+
+                    self.spilled.discard(conv_id)
+                    self.pins[conv_id] = self.pins.get(conv_id, 0) + 1
+                    self.rehydrations += 1
+
+                self.resident[conv_id] = conv
+
+            self.loading.pop(conv_id).set()
+
+
+    def _resident_bytes(self) -> int:
+        return sum(conv.message_bytes for conv in self.resident.values())
+
+
+    def _evict_if_needed(self):
+        """Spill the least recently used idle conversations until we're within budget."""
+
+        if not self.max_conversations and not self.max_bytes:
+            return
+
+        victims = []
+
+        with self.lock:
+            count = len(self.resident)
+            size = self._resident_bytes() if self.max_bytes else 0
+
+            for conv_id, conv in self.resident.items():
+                if (not self.max_conversations or count <= self.max_conversations) and (not self.max_bytes or size <= self.max_bytes):
+                    break
+
+                if conv_id in self.pins:
+                    continue
+
+                victims.append((conv_id, conv))
+                count -= 1
+                size -= conv.message_bytes
+
+            for conv_id, _ in victims:
+                del self.resident[conv_id]
+                self.evicting[conv_id] = threading.Event()
+
+        for conv_id, conv in victims:
+            self._spill(conv_id, conv)
+
+
+    def _spill(self, conv_id: str, conv):
+        """Write a conversation out, and drop it. If that fails, it's kept resident."""
+
+        state_path, messages_path = self._paths(conv_id)
+        spilled = False
+
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+            if conv.journal is not None:
+                conv.journal.flush() # The journal has the messages.
+
+            elif self.clean_versions.get(conv_id) != conv.version:
+                write_memory_file(messages_path, conv.conversation)
+
+            temporary_path = state_path + ".tmp"
+
+            with open(temporary_path, "w", encoding="utf-8") as f:
+                json.dump(conv.export_state(), f)
+
+            os.replace(temporary_path, state_path)
+
+            if conv.journal is not None:
+                conv.journal.close()
+
+            spilled = True
+
+        except: # pylint: disable=bare-except
+            self.logger.error(f"Failed to spill conversation \'{conv_id}\'; keeping it in memory.")
+            self.logger.debug(traceback.format_exc())
+
+        with self.lock:
+            if spilled:
+                self.spilled.add(conv_id)
+                self.clean_versions.pop(conv_id, None)
+                self.evictions += 1
+
+            else:
+                self.resident[conv_id] = conv
+                self.resident.move_to_end(conv_id, last=False)
+
+            self.evicting.pop(conv_id).set()
+
+        if spilled:
+            self.logger.debug(f"Spilled conversation \'{conv_id}\' to disk.")
+
+            if self.on_evict:
+                self.on_evict(conv_id)
+
+
+    def stats(self) -> dict:
+        """The live state of the cache.
+
+        Returns:
+            dict: Counts, the estimated resident bytes and the limits.
+        """
+
+        with self.lock:
+            return {
+                "resident": len(self.resident),
+                "spilled": len(self.spilled),
+                "resident_bytes": self._resident_bytes(),
+                "evictions": self.evictions,
+                "rehydrations": self.rehydrations,
+                "limits": {
+                    "max_conversations": self.max_conversations,
+                    "max_bytes": self.max_bytes,
+                },
+            }
@@ -0,0 +1,198 @@
+# forks.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Conversations that share their messages, so forking one costs next to nothing.
+
+A fork doesn't copy its parent's messages. Both become `SharedConversation`s: views of the parent's old message list
+(now frozen; nobody changes it anymore), each with a tail of its own that new messages are appended to. Only a change to
+a shared message makes a conversation copy what it shares, into a plain list of its own:
+
+>>> parent: [m0 m1 m2 m3] + []      # After forking the child off at 2.
+>>> child:  [m0 m1]       + []
+>>> parent: [m0 m1 m2 m3] + [m4]    # Appending never copies anything.
+>>> child:  [m0 m1]       + [c2]
+"""
+
+
+
+# Imports: Built-in/Standard
+import itertools                            # Used to read the shared part.
+from copy import deepcopy                   # Used to copy shared conversations.
+from collections.abc import MutableSequence # Shared conversations are list-like.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.util.fastjson import register_type # Shared conversations are encoded like lists.
+
+
+
+# Constants
+
+MAX_SHARING_DEPTH = 8 # How many views deep a shared conversation may read through before it copies what it shares.
+
+
+
+# Classes
+
+
+
+class SharedConversation(MutableSequence):
+    """The first `length` messages of a frozen conversation (the base), followed by messages of its own (the tail).
+    The first change to the shared part copies it into a plain list, which is used from then on."""
+
+    def __init__(self, base, length: int):
+        """A shared conversation, with nothing of its own yet.
+
+        Args:
+            base: The frozen conversation. A list, or any other conversation (even another shared one). Must never change.
+            length (int): How many of its messages are shared.
+        """
+
+        self.base = base
+        self.length = length
+        self.tail: list = []
+        self.items: list = None # Set once it stops sharing.
+
+        if isinstance(base, SharedConversation) and base.items is None:
+            self.depth = base.depth + 1
+
+            if self.depth > MAX_SHARING_DEPTH: # Reads would get slow; flatten it, once.
+                self.base, self.depth = list(itertools.islice(base, length)), 0
+
+        else:
+            self.depth = 0
+
+
+    def fork(self, length: int) -> "SharedConversation":
+        """Share the first messages of this conversation, if they're all in the frozen part.
+
+        Args:
+            length (int): How many messages to share.
+
+        Returns:
+            SharedConversation: The fork, or None if it would have to share messages of the tail.
+        """
+
+        if self.items is not None or length > self.length:
+            return None
+
+        return SharedConversation(self.base, length)
+
+
+    def materialize(self) -> list:
+        """Copy the shared messages into a plain list of our own, if that wasn't done yet.
+
+        Returns:
+            list: The messages.
+        """
+
+        if self.items is None:
+            self.items = list(itertools.islice(self.base, self.length))
+            self.items.extend(self.tail)
+            self.base, self.tail = None, None
+
+        return self.items
+
+
+    def __len__(self) -> int:
+        return len(self.items) if self.items is not None else self.length + len(self.tail)
+
+
+    def __getitem__(self, index):
+        if self.items is not None:
+            return self.items[index]
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+
+            stop = max(start, stop)
+            shared = self.base[start:min(stop, self.length)] if start < self.length else []
+
+            return list(shared) + self.tail[max(start - self.length, 0):max(stop - self.length, 0)]
+
+        index = range(len(self))[index]
+
+        return self.base[index] if index < self.length else self.tail[index - self.length]
+
+
+    def __iter__(self):
+        if self.items is not None:
+            yield from self.items
+            return
+
+        yield from itertools.islice(self.base, self.length)
+        yield from self.tail
+
+
+    def __setitem__(self, index, value):
+        if self.items is None and isinstance(index, int) and range(len(self))[index] >= self.length:
+            self.tail[range(len(self))[index] - self.length] = value
+            return
+
+        self.materialize()[index] = value
+
+
+    def __delitem__(self, index):
+        if self.items is None and isinstance(index, int) and range(len(self))[index] >= self.length:
+            del self.tail[range(len(self))[index] - self.length]
+            return
+
+        del self.materialize()[index]
+
+
+    def insert(self, index, value):
+        if self.items is None and index >= self.length:
+            self.tail.insert(index - self.length, value)
+            return
+
+        self.materialize().insert(index, value)
+
+
+    def append(self, value):
+        if self.items is None:
+            self.tail.append(value)
+            return
+
+        self.items.append(value)
+
+
+    def copy(self):
+        """A shallow copy. Only copies the tail while it's still sharing."""
+
+        if self.items is not None:
+            return list(self.items)
+
+        shared = SharedConversation(self.base, self.length)
+        shared.tail = list(self.tail)
+
+        return shared
+
+
+    def __deepcopy__(self, memo) -> list:
+        return deepcopy(list(self), memo)
+
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+
+    def __repr__(self) -> str:
+        if self.items is not None:
+            return repr(self.items)
+
+        return f"<SharedConversation of {self.length} shared and {len(self.tail)} own message(s)>"
+
+
+
+
+
+register_type(SharedConversation, list)
@@ -0,0 +1,1009 @@
+# httpio.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""HTTP/1.1 plumbing shared by both Hollowserver backends: response framing, request body bounds and chunked streaming.
+Connections are kept alive, so every response must be properly framed and every request body fully consumed."""
+
+
+
+# Imports: Built-in/Standard
+import io        # Used to hold response bodies until their length is known.
+import json      # Used to parse request bodies and send errors.
+import time      # Used to time flushes of streamed responses.
+import codecs    # Used to decode request bodies as they come in.
+import asyncio   # Used to flush streamed responses on time on the asyncio backend.
+import threading # Used to flush streamed responses on time on the threaded backends.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.util.fastjson import dumps, error_body                 # Response encoding.
+from src.lib.compression import StreamCompressor, compress, negotiate # Response compression.
+
+
+
+# Constants
+
+MAX_BODY_DISCARD = 1 << 16 # The most unread request body we'll throw away to keep a connection alive. Beyond this, just close.
+MAX_BODY_SIZE = 8 << 20     # The default largest request body we'll accept...
+MAX_HISTORY_SIZE = 64 << 20 # ...except for whole conversations, which can get big.
+MAX_CHUNK_LINE = 1024       # The longest chunk size line (with extensions) of a chunked request body.
+JSON_READ_SIZE = 1 << 16    # How much of a streamed JSON body we read at a time.
+
+STREAM_FLUSH_BYTES = 4096    # By default, streamed responses are flushed once this much is buffered...
+STREAM_FLUSH_MS = 50.0       # ...or once the oldest buffered piece has waited this long.
+MAX_STREAM_FLUSH_BYTES = 1 << 16
+MAX_STREAM_FLUSH_MS = 1000.0
+FLUSHER_IDLE_TIMEOUT = 5.0   # Seconds a stream's flusher thread waits for something to be buffered before it's let go.
+
+
+
+# Functions
+
+def flush_policy(options, default_bytes: int = STREAM_FLUSH_BYTES, default_ms: float = STREAM_FLUSH_MS) -> tuple[int, float]:
+    """Work out a flush policy for a streamed response from a client's "stream_flush" option.
+
+    Args:
+        options: The option. A dict of "bytes" and/or "ms", or False/0 to flush every piece as soon as it's written.
+        Anything else (including None) means the defaults.
+        default_bytes (int, optional): The default byte threshold.
+        default_ms (float, optional): The default time threshold, in milliseconds.
+
+    Returns:
+        tuple[int, float]: The byte threshold and the time threshold in milliseconds, clamped to sane bounds.
+    """
+
+    max_bytes, max_ms = default_bytes, default_ms
+
+    if options is False or options == 0:
+        return 0, 0.0
+
+    if isinstance(options, dict):
+        try:
+            max_bytes = int(options.get("bytes", max_bytes))
+            max_ms = float(options.get("ms", max_ms))
+
+        except (TypeError, ValueError):
+            max_bytes, max_ms = default_bytes, default_ms
+
+    return min(max(0, max_bytes), MAX_STREAM_FLUSH_BYTES), min(max(0.0, max_ms), MAX_STREAM_FLUSH_MS)
+
+
+
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """Check an If-Match/If-None-Match header against an ETag. Weak and strong tags are compared alike, so the weak
+    tags compressed responses carry (see `weak_etag`) match too.
+
+    Args:
+        header (str): The header, if any.
+        etag (str): The current ETag.
+
+    Returns:
+        bool: Whether the header matches. A missing header never matches; "*" always does.
+    """
+
+    if header is None:
+        return False
+
+    if header.strip() == "*":
+        return True
+
+    etag = etag.removeprefix("W/")
+
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+
+def weak_etag(etag: str) -> str:
+    """Make an ETag weak. A compressed representation mustn't share a strong ETag with the identity one (RFC 9110
+    §8.8.3), but a weak one says no more than "same content", which holds.
+
+    Args:
+        etag (str): The ETag.
+
+    Returns:
+        str: The weak ETag.
+    """
+
+    return etag if etag.startswith("W/") else "W/" + etag
+
+
+
+
+
+def iter_json_array(read, read_size: int = JSON_READ_SIZE):
+    """Parse a JSON array one element at a time, reading only as much as needed. Only the element being parsed (and
+    whatever was read past it) is ever held in memory, never the whole document.
+
+    Args:
+        read (callable): Reads up to n bytes; returns b"" at the end.
+        read_size (int, optional): How many bytes to read at a time. Defaults to 64 KiB.
+
+    Yields:
+        The elements of the array.
+
+    Raises:
+        ValueError: If the document isn't a single, valid JSON array.
+    """
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def fill():
+        nonlocal buffer, position, eof
+
+        buffer = buffer[position:] # Drop what was already parsed.
+        position = 0
+
+        data = read(read_size)
+        eof = not data
+        buffer += text_decoder.decode(data, final=eof)
+
+    def peek() -> str:
+        nonlocal position
+
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+
+            if position < len(buffer):
+                return buffer[position]
+
+            if eof:
+                return ""
+
+            fill()
+
+    if peek() != "[":
+        raise ValueError("Expected a JSON array.")
+
+    position += 1
+
+    if peek() == "]":
+        position += 1
+
+    else:
+        while True:
+            peek()
+
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+
+                    # A number at the very end of what we have so far might not be finished.
+                    if end < len(buffer) or eof:
+                        break
+
+                except ValueError:
+                    if eof:
+                        raise
+
+                fill()
+
+            position = end
+            yield item
+
+            separator = peek()
+            position += 1
+
+            if separator == "]":
+                break
+
+            if separator != ",":
+                raise ValueError("Expected \",\" or \"]\" in JSON array.")
+
+    if peek() != "":
+        raise ValueError("Unexpected data after JSON array.")
+
+
+
+# Classes
+
+
+
+class BodyError(Exception):
+    """Thrown when a request body can't be accepted. The request is answered with the code and message."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+
+
+
+class BodyReader:
+    """Wraps the connection's input so callbacks can never read past the end of the request body.
+    Whatever they leave behind is discarded before the next request on the connection."""
+
+    def __init__(self, raw, length: int):
+        """A request body reader.
+
+        Args:
+            raw: The connection's real input file.
+            length (int): The Content-Length of the request.
+        """
+
+        self.raw = raw
+        self.remaining = length
+        self.length = length
+
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes of the body, or all of what's left.
+
+        Args:
+            size (int, optional): The amount of bytes to read. Defaults to everything.
+
+        Returns:
+            bytes: The data.
+        """
+
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        if size == 0:
+            return b""
+
+        data = self.raw.read(size)
+        self.remaining -= len(data)
+
+        return data
+
+
+    def discard(self, limit: int = MAX_BODY_DISCARD) -> bool:
+        """Throw away whatever is left of the body.
+
+        Args:
+            limit (int, optional): The most bytes we're willing to read just to throw them away.
+
+        Returns:
+            bool: Whether the body was fully consumed. If not, the connection can't be reused.
+        """
+
+        if self.remaining > limit:
+            return False
+
+        try:
+            while self.remaining:
+                if not self.read(min(self.remaining, 8192)):
+                    return False
+
+        except OSError: # E.g. a rejected body that never came, and timed out.
+            return False
+
+        return True
+
+
+
+
+
+class ChunkedBodyReader:
+    """Decodes a chunked (Transfer-Encoding: chunked) request body as it's read, so it can be consumed just like a body
+    with a Content-Length. The body is cut off with a 413 as soon as it grows past the limit."""
+
+    def __init__(self, raw, limit: int):
+        """A chunked request body reader.
+
+        Args:
+            raw: The connection's real input file.
+            limit (int): The largest body we'll accept.
+        """
+
+        self.raw = raw
+        self.limit = limit
+        self.size = 0
+        self.chunk_remaining = 0
+        self.done = False
+
+
+    def _next_chunk(self):
+        """Read the next chunk's size line, and the trailers if it was the last one."""
+
+        line = self.raw.readline(MAX_CHUNK_LINE)
+
+        if not line.endswith(b"\n"):
+            raise BodyError(400, "Bad chunked request body.")
+
+        try:
+            size = int(line.split(b";", 1)[0].strip(), 16)
+
+        except ValueError as exc:
+            raise BodyError(400, "Bad chunked request body.") from exc
+
+        if size == 0:
+            # Trailers (which we ignore) up to an empty line.
+            while (line := self.raw.readline(MAX_CHUNK_LINE)) not in (b"\r\n", b"\n"):
+                if not line.endswith(b"\n"):
+                    raise BodyError(400, "Bad chunked request body.")
+
+            self.done = True
+            return
+
+        self.size += size
+
+        if self.size > self.limit:
+            raise BodyError(413, "Request body too large.")
+
+        self.chunk_remaining = size
+
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes of the decoded body, or all of what's left.
+
+        Args:
+            size (int, optional): The amount of bytes to read. Defaults to everything.
+
+        Returns:
+            bytes: The data.
+        """
+
+        pieces = []
+        wanted = -1 if size is None or size < 0 else size
+
+        while wanted != 0 and not self.done:
+            if not self.chunk_remaining:
+                self._next_chunk()
+                continue
+
+            amount = self.chunk_remaining if wanted < 0 else min(wanted, self.chunk_remaining)
+            data = self.raw.read(amount)
+
+            if not data:
+                raise BodyError(400, "Chunked request body ended early.")
+
+            pieces.append(data)
+            self.chunk_remaining -= len(data)
+
+            if wanted > 0:
+                wanted -= len(data)
+
+            if not self.chunk_remaining and self.raw.read(2) != b"\r\n": # The CRLF after every chunk.
+                raise BodyError(400, "Bad chunked request body.")
+
+        return b"".join(pieces)
+
+
+    def discard(self, limit: int = MAX_BODY_DISCARD) -> bool:
+        """Throw away whatever is left of the body.
+
+        Args:
+            limit (int, optional): The most bytes we're willing to read just to throw them away.
+
+        Returns:
+            bool: Whether the body was fully consumed. If not, the connection can't be reused.
+        """
+
+        try:
+            while not self.done and limit > 0:
+                limit -= len(self.read(min(limit, 8192))) or 1
+
+        except (BodyError, OSError):
+            return False
+
+        return self.done
+
+
+
+
+
+class HollowRequestMixin:
+    """HTTP/1.1 response framing, mixed into both request classes in front of their raw `send_response`/`send_header`/
+    `end_headers`.
+
+    Callbacks keep writing responses the way they always have. Responses that declare neither a Content-Length nor a
+    Transfer-Encoding have their body held back until the callback is done, so the Content-Length can be filled in.
+    Streaming responses should use `start_chunked`/`write_chunk`/`end_chunked`, which also handle HTTP/1.0 clients.
+    """
+
+    _response_state = "idle" # idle -> headers -> (deferred | streaming) -> done
+    _body_declared = False
+    _response_framed = False
+    _response_chunked = False
+    _real_wfile = None
+    _stream_compressor: StreamCompressor = None
+
+
+    def begin_request(self):
+        """Reset the per-request state. Called before routing."""
+
+        self._response_state = "idle"
+        self._response_framed = False
+        self._response_chunked = False
+        self._stream_compressor = None
+
+        transfer_encoding = self.headers.get("Transfer-Encoding")
+        self._body_declared = transfer_encoding is not None or "Content-Length" in self.headers
+
+        if transfer_encoding is not None:
+            if transfer_encoding.lower().rsplit(",", 1)[-1].strip() == "chunked":
+                self.rfile = ChunkedBodyReader(self.rfile, max(self.server.max_body_size, self.server.max_history_size))
+                return
+
+            # We can't tell where this body ends, so this connection can't be reused.
+            self.close_connection = True
+            length = 0
+
+        else:
+            try:
+                length = max(0, int(self.headers.get("Content-Length", 0)))
+
+            except ValueError:
+                self.close_connection = True
+                length = 0
+
+        self.rfile = BodyReader(self.rfile, length)
+
+
+    def request_body(self, limit: int = None, required: bool = True):
+        """Get the request body, after making sure it's acceptable. Nothing is read yet.
+
+        Args:
+            limit (int, optional): The largest body to accept. Defaults to the server's `max_body_size`.
+            required (bool, optional): Whether a body must have been sent. Defaults to True.
+
+        Returns:
+            BodyReader | ChunkedBodyReader: The body, to be read from.
+
+        Raises:
+            BodyError: 411 if a required body wasn't declared, 413 if it's larger than the limit.
+        """
+
+        limit = self.server.max_body_size if limit is None else limit
+
+        if not self._body_declared and required:
+            raise BodyError(411, "Content length is required.")
+
+        if isinstance(self.rfile, ChunkedBodyReader):
+            self.rfile.limit = limit
+
+        elif self.rfile.length > limit:
+            # Rejected before reading a single byte of it.
+            raise BodyError(413, "Request body too large.")
+
+        return self.rfile
+
+
+    def read_body(self, limit: int = None, required: bool = True) -> bytes:
+        """Read the whole request body. See `request_body`.
+
+        Args:
+            limit (int, optional): The largest body to accept. Defaults to the server's `max_body_size`.
+            required (bool, optional): Whether a body must have been sent. Defaults to True.
+
+        Returns:
+            bytes: The body.
+        """
+
+        return self.request_body(limit, required).read()
+
+
+    def read_json(self, limit: int = None, required: bool = True):
+        """Read the request body as JSON. See `request_body`.
+
+        Args:
+            limit (int, optional): The largest body to accept. Defaults to the server's `max_body_size`.
+            required (bool, optional): Whether a body must have been sent. Defaults to True.
+
+        Returns:
+            The parsed body, or None if there's no body and it wasn't required.
+
+        Raises:
+            BodyError: See `request_body`; also 400 if the body isn't valid JSON.
+        """
+
+        body = self.read_body(limit, required)
+
+        if not body and not required:
+            return None
+
+        try:
+            return json.loads(body)
+
+        except ValueError as exc: # Also UnicodeDecodeError.
+            raise BodyError(400, "Request body is not valid JSON.") from exc
+
+
+    def iter_json_array(self, limit: int = None):
+        """Parse the request body as a JSON array, element by element, straight off the connection. See `request_body`.
+
+        Args:
+            limit (int, optional): The largest body to accept. Defaults to the server's `max_history_size`.
+
+        Yields:
+            The elements of the array.
+
+        Raises:
+            BodyError: See `request_body`; also 400 if the body isn't a valid JSON array.
+        """
+
+        body = self.request_body(self.server.max_history_size if limit is None else limit)
+
+        try:
+            yield from iter_json_array(body.read)
+
+        except ValueError as exc:
+            raise BodyError(400, "Request body is not a valid JSON array.") from exc
+
+
+    def end_request(self):
+        """Make sure the response is complete and the request body is consumed. Called after the callbacks are done."""
+
+        try:
+            self.finish_response()
+
+        finally:
+            if isinstance(self.rfile, (BodyReader, ChunkedBodyReader)):
+                if not self.rfile.discard():
+                    self.close_connection = True
+
+                self.rfile = self.rfile.raw
+
+
+    def send_response(self, code: int, message: str = None):
+        """Start a response. See `http.server.BaseHTTPRequestHandler.send_response`.
+
+        Args:
+            code (int): The status code.
+            message (str, optional): The reason phrase.
+        """
+
+        if self._response_state == "deferred":
+            self.finish_response()
+
+        if self._response_state != "idle":
+            # Somebody already answered. Whatever comes next can't be framed properly, so don't reuse the connection.
+            self.server.logger.warning(f"More than one response sent for \"{self.command} {self.path}\".")
+            self.close_connection = True
+            self._response_state = "raw"
+
+        else:
+            self._response_state = "headers"
+            self._response_framed = code < 200 or code in (204, 304)
+
+        super().send_response(code, message)
+
+
+    def send_header(self, keyword: str, value: str):
+        """Add a header to the response, taking note of how the response is framed.
+
+        Args:
+            keyword (str): The header name.
+            value (str): The header value.
+        """
+
+        lowered = keyword.lower()
+
+        if lowered == "content-length":
+            self._response_framed = True
+
+        elif lowered == "transfer-encoding":
+            self._response_framed = True
+            self._response_chunked = "chunked" in value.lower()
+
+        super().send_header(keyword, value)
+
+
+    def end_headers(self):
+        """End the header block. Unframed responses are held back until `finish_response`."""
+
+        if self._response_state != "headers":
+            super().end_headers()
+            return
+
+        if self._response_framed:
+            self._response_state = "streaming"
+            super().end_headers()
+            return
+
+        self._response_state = "deferred"
+        self._real_wfile = self.wfile
+        self.wfile = io.BytesIO()
+
+
+    def _response_encoding(self, size: int = None) -> str:
+        """Work out how to compress the current response.
+
+        Args:
+            size (int, optional): The size of the body, if known. Unknown means a stream.
+
+        Returns:
+            str: The encoding, or None for no compression.
+        """
+
+        threshold = self.server.compression_threshold
+
+        if threshold < 0 or (size is not None and size < threshold):
+            return None
+
+        return negotiate(self.headers.get("Accept-Encoding"))
+
+
+    @property
+    def negotiable(self) -> bool:
+        """Whether responses depend on Accept-Encoding at all, and so need `Vary: Accept-Encoding`."""
+
+        return self.server.compression_threshold >= 0
+
+
+    def finish_response(self):
+        """Send a deferred response with its Content-Length. Answers with 204 if nothing was sent at all."""
+
+        match self._response_state:
+
+            case "idle":
+                self.send_response(204)
+                self.end_headers()
+
+            case "headers":
+                self.end_headers()
+
+        if self._response_state == "deferred":
+            body = self.wfile.getvalue()
+            self.wfile = self._real_wfile
+            self._real_wfile = None
+
+            if encoding := self._response_encoding(len(body)):
+                body = compress(body, encoding)
+                super().send_header("Content-Encoding", encoding)
+
+                for index, line in enumerate(self._headers_buffer):
+                    if line[:5].lower() == b"etag:" and not line[5:].lstrip().startswith(b"W/"):
+                        self._headers_buffer[index] = b"ETag: W/" + line[5:].lstrip()
+
+            if self.negotiable:
+                super().send_header("Vary", "Accept-Encoding")
+
+            super().send_header("Content-Length", str(len(body)))
+            self._headers_buffer.append(b"\r\n")
+
+            # Headers and body in one write.
+            self.wfile.write(b"".join(self._headers_buffer) + body)
+            self._headers_buffer = []
+
+        self.wfile.flush()
+        self._response_state = "done"
+
+
+    def send_bytes(self, body: bytes, code: int = 200, content_type: str = "application/json", headers: dict = None):
+        """Send a whole response: status line, headers (with Content-Length) and body, in a single write.
+        Large enough bodies are compressed, if the client accepts it.
+
+        Args:
+            body (bytes): The body.
+            code (int, optional): The status code. Defaults to 200.
+            content_type (str, optional): The content type, or None for none. Defaults to "application/json".
+            headers (dict, optional): Extra headers. Defaults to None.
+        """
+
+        has_body = content_type and code >= 200 and code not in (204, 304)
+
+        if self.negotiable and not self.response_started and (has_body or code == 304):
+            headers = (headers or {}) | {"Vary": "Accept-Encoding"}
+
+            # A 304 stands in for whatever the client would get now, compressed or not.
+            encoding = negotiate(self.headers.get("Accept-Encoding")) if code == 304 \
+                else self._response_encoding(len(body))
+
+            if encoding and code != 304:
+                body = compress(body, encoding)
+                headers["Content-Encoding"] = encoding
+
+            if encoding and "ETag" in headers:
+                headers["ETag"] = weak_etag(headers["ETag"])
+
+        self.send_response(code)
+
+        if content_type:
+            self.send_header("Content-Type", content_type)
+
+        for keyword, value in (headers or {}).items():
+            self.send_header(keyword, value)
+
+        if code >= 200 and code not in (204, 304):
+            self.send_header("Content-Length", str(len(body)))
+
+        if self._response_state != "headers":
+            # Somebody already answered (see `send_response`); just get it out there.
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self._headers_buffer.append(b"\r\n")
+        self.wfile.write(b"".join(self._headers_buffer) + body)
+        self._headers_buffer = []
+        self.wfile.flush()
+        self._response_state = "done"
+
+
+    def send_json(self, obj, code: int = 200, headers: dict = None):
+        """Send a JSON response. See `src.lib.util.fastjson.dumps`.
+
+        Args:
+            obj: The object to send.
+            code (int, optional): The status code. Defaults to 200.
+            headers (dict, optional): Extra headers. Defaults to None.
+        """
+
+        self.send_bytes(dumps(obj) + b"\n", code, headers=headers)
+
+
+    def send_error_json(self, code: int, message: str, headers: dict = None):
+        """Send a small JSON error, {"error": message}.
+
+        Args:
+            code (int): The status code.
+            message (str): The error message.
+            headers (dict, optional): Extra headers. Defaults to None.
+        """
+
+        self.send_bytes(error_body(message), code, headers=headers)
+
+
+    def send_empty(self, code: int = 200, headers: dict = None):
+        """Send a response without a body.
+
+        Args:
+            code (int, optional): The status code. Defaults to 200.
+            headers (dict, optional): Extra headers. Defaults to None.
+        """
+
+        self.send_bytes(b"", code, content_type=None, headers=headers)
+
+
+    def start_chunked(self, code: int = 200, content_type: str = "application/json"):
+        """Start a streamed response. HTTP/1.1 clients get chunked framing; HTTP/1.0 clients get the raw stream,
+        terminated by closing the connection. The stream is compressed if the client accepts it; every piece is
+        flushed through the compressor, so it can be decoded as soon as it arrives.
+
+        Args:
+            code (int, optional): The status code. Defaults to 200.
+            content_type (str, optional): The content type. Defaults to "application/json".
+        """
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+
+        if encoding := self._response_encoding():
+            self.send_header("Content-Encoding", encoding)
+            self._stream_compressor = StreamCompressor(encoding)
+
+        if self.negotiable:
+            self.send_header("Vary", "Accept-Encoding")
+
+        if self.request_version >= "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+
+        else:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+            self._response_framed = True
+
+        self.end_headers()
+
+
+    def write_chunk(self, data: bytes):
+        """Write a piece of a streamed response, framed as a single chunk.
+
+        Args:
+            data (bytes): The data. Empty data is skipped, as an empty chunk would end the stream.
+        """
+
+        if self._stream_compressor and data:
+            data = self._stream_compressor.compress(data)
+
+        if not data:
+            return
+
+        if self._response_chunked:
+            self.wfile.write(b"%x\r\n%b\r\n" % (len(data), data))
+
+        else:
+            self.wfile.write(data)
+
+        self.wfile.flush()
+
+
+    def end_chunked(self, data: bytes = b""):
+        """End a streamed response.
+
+        Args:
+            data (bytes, optional): A last piece to send along with the terminator, in the same write.
+        """
+
+        if self._stream_compressor:
+            data = self._stream_compressor.finish(data)
+            self._stream_compressor = None
+
+        if self._response_chunked:
+            self.wfile.write((b"%x\r\n%b\r\n" % (len(data), data) if data else b"") + b"0\r\n\r\n")
+
+        elif data:
+            self.wfile.write(data)
+
+        self.wfile.flush()
+        self._response_state = "done"
+
+
+    @property
+    def response_started(self) -> bool:
+        """Whether a response has been started for the current request."""
+
+        return self._response_state != "idle"
+
+
+
+
+
+class StreamCoalescer:
+    """Buffers the pieces of a streamed response (usually one small JSON line per token) and writes them out as one chunk
+    once enough bytes have piled up, or once the oldest of them has waited long enough.
+
+    The first piece is always written right away, so time-to-first-token doesn't suffer. A deadline is set as soon as
+    something is buffered, so a piece never waits longer than the time limit, even if the model pauses. On the asyncio
+    backend, that's a `call_later`; on the threaded ones, every stream has a flusher thread of its own, so a client that
+    doesn't keep up only ever holds up its own stream.
+    """
+
+    def __init__(self, request: HollowRequestMixin, max_bytes: int = STREAM_FLUSH_BYTES, max_ms: float = STREAM_FLUSH_MS,
+                 content_type: str = "application/json"):
+        """A coalescing writer for a streamed response. The response is started with the first write.
+
+        Args:
+            request (HollowRequestMixin): The request to respond to.
+            max_bytes (int, optional): Flush once this many bytes are buffered. 0 flushes every piece.
+            max_ms (float, optional): Flush once the oldest buffered piece is this many milliseconds old.
+            content_type (str, optional): The content type. Defaults to "application/json".
+        """
+
+        self.request = request
+        self.max_bytes = max_bytes
+        self.max_delay = max_ms / 1000
+        self.content_type = content_type
+
+        self.started = False
+        self.buffer = bytearray()
+        self.buffered_since = 0.0
+        self.deadline = None # asyncio: flushes the buffer once the oldest piece in it has waited long enough.
+        self.condition = threading.Condition(threading.Lock()) # Threaded: wakes up the flusher.
+        self.flusher: threading.Thread = None # Threaded: flushes the buffer on time. See `_flush_on_time`.
+        self.closed = False
+
+        self.writes = 0 # Chunks actually written, for the curious.
+
+
+    def start(self):
+        """Start the response, if it hasn't been already."""
+
+        if not self.started:
+            self.request.start_chunked(200, self.content_type)
+            self.started = True
+
+
+    def write(self, data: bytes) -> bool:
+        """Write a piece of the response.
+
+        Args:
+            data (bytes): The piece.
+
+        Returns:
+            bool: Whether anything was actually written out (asyncio callers should drain when it was).
+        """
+
+        with self.condition:
+            if not self.started:
+                self.start()
+                self.request.write_chunk(data)
+                self.writes += 1
+                return True
+
+            now = time.monotonic()
+
+            if not self.buffer:
+                self.buffered_since = now
+
+            self.buffer += data
+
+            if len(self.buffer) >= self.max_bytes or now - self.buffered_since >= self.max_delay:
+                self._flush()
+                return True
+
+            if self.request.is_async:
+                if self.deadline is None:
+                    self.deadline = asyncio.get_running_loop().call_later(self.buffered_since + self.max_delay - now, self._on_deadline)
+
+            elif self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_on_time, name="Hollowserver-Flush", daemon=True)
+                self.flusher.start()
+
+            elif len(self.buffer) == len(data):
+                self.condition.notify() # It was waiting for something to be buffered.
+
+            return False
+
+
+    def _on_deadline(self):
+        self.deadline = None
+
+        try:
+            self._flush()
+
+        except (OSError, ValueError): # The client is gone; the next write finds out on its own.
+            pass
+
+
+    def _flush_on_time(self):
+        """The flusher of a threaded stream: writes the buffer out once the oldest piece in it has waited long enough.
+        Leaves once the stream is closed, or nothing was buffered for a while."""
+
+        with self.condition:
+            while not self.closed:
+                if not self.buffer:
+                    if not self.condition.wait(FLUSHER_IDLE_TIMEOUT) and not self.buffer:
+                        break
+
+                    continue
+
+                delay = self.buffered_since + self.max_delay - time.monotonic()
+
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                try:
+                    self._flush()
+
+                except (OSError, ValueError): # The client is gone; the next write finds out on its own.
+                    break
+
+            self.flusher = None
+
+
+    def flush(self):
+        """Write out whatever is buffered, as a single chunk."""
+
+        with self.condition:
+            self._flush()
+
+
+    def _flush(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+        if self.buffer:
+            self.request.write_chunk(bytes(self.buffer))
+            self.writes += 1
+            self.buffer.clear()
+
+
+    def close(self, data: bytes = b""):
+        """Write out whatever is buffered and end the response, in a single write.
+
+        Args:
+            data (bytes, optional): A last piece to send.
+        """
+
+        with self.condition:
+            if self.deadline is not None:
+                self.deadline.cancel()
+                self.deadline = None
+
+            self.closed = True
+            self.condition.notify()
+
+            self.start()
+            self.buffer += data
+            self.request.end_chunked(bytes(self.buffer))
+            self.buffer.clear()
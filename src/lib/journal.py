@@ -0,0 +1,410 @@
+# journal.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Crash-safe persistence for conversations. Every change is appended to a per-conversation journal (JSON lines) as it
+happens, so a write costs about as much as the message it records. Once the journal grows long enough, it's compacted
+into a snapshot of the whole conversation. On startup, the snapshot is loaded and the journal replayed on top of it.
+Writes are normally left to a `PersistenceWorker`, which batches bursts of changes and keeps disk I/O off request threads.
+
+Files, for a conversation "abc" (IDs are percent-encoded to be safe as file names):
+
+>>> abc.snapshot.json # {"generation": 3, "messages": [...]}
+>>> abc.journal.jsonl # {"generation": 3}, then one change per line.
+
+A journal only applies to the snapshot of the same generation. A compaction writes the new snapshot first and the new
+journal second, so a crash in between leaves an old journal behind, which is then ignored.
+"""
+
+
+
+# Imports: Built-in/Standard
+import os                               # Used for file manipulation.
+import json                             # Used to parse snapshots and journals.
+import logging                          # Used for logging.
+import threading                        # Used to guard buffered changes.
+import traceback                        # Used to get information about exceptions.
+import typing                           # Used to avoid a circular import.
+from urllib.parse import quote, unquote # Used to turn conversation IDs into file names and back.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.util.fastjson import dumps # Used to encode changes and snapshots.
+
+if typing.TYPE_CHECKING:
+    from src.lib.persistence import PersistenceWorker
+
+
+
+# Constants
+
+SNAPSHOT_SUFFIX = ".snapshot.json"
+JOURNAL_SUFFIX = ".journal.jsonl"
+
+COMPACT_RECORDS = 1000   # The journal is compacted once it has this many changes...
+COMPACT_BYTES = 8 << 20  # ...or once it's this large, whichever comes first.
+
+
+
+# Functions
+
+def journaled_conversations(directory: str) -> list[str]:
+    """List the conversations that have something on disk.
+
+    Args:
+        directory (str): The journal directory.
+
+    Returns:
+        list[str]: The conversation IDs.
+    """
+
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted(unquote(name.removesuffix(SNAPSHOT_SUFFIX)) for name in os.listdir(directory) if name.endswith(SNAPSHOT_SUFFIX))
+
+
+
+
+
+def apply_change(messages: list[dict], change: dict):
+    """Apply a journaled change to a conversation.
+
+    Args:
+        messages (list[dict]): The conversation. Changed in place.
+        change (dict): The change.
+    """
+
+    match change["op"]:
+
+        case "append":
+            messages.append(change["message"])
+
+        case "set":
+            messages[change["index"]] = change["message"]
+
+        case "delete":
+            del messages[change["index"]]
+
+        case "overwrite":
+            for i, message in enumerate(change["messages"]):
+                messages[change["index"] + i] = message
+
+        case "replace":
+            messages[:] = change["messages"]
+
+        case _:
+            raise ValueError(f"Unknown journal op \'{change['op']}\'.")
+
+
+
+# Classes
+
+
+
+class ConversationJournal:
+    """The journal of a single conversation.
+
+    Changes are encoded and buffered by `record` (with the conversation's lock held), and written out by `flush`. Without a
+    persistence worker, `record` flushes right away; with one, the worker flushes a burst of changes in a single write,
+    off the request's thread. Compactions are likewise only scheduled by `schedule_compaction`, and done by `flush`.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 conversation_id: str,
+                 logger: logging.Logger,
+                 fsync: bool = False,
+                 compact_records: int = COMPACT_RECORDS,
+                 compact_bytes: int = COMPACT_BYTES,
+                 worker: "PersistenceWorker" = None,
+                 ):
+        """A conversation journal. Nothing is opened until `replay` or `compact` is called.
+
+        Args:
+            directory (str): The journal directory. Created if needed.
+            conversation_id (str): The ID of the conversation.
+            logger (logging.Logger): The logger to use.
+            fsync (bool, optional): Whether to fsync every flush, to survive power loss and not just crashes. Defaults to False.
+            compact_records (int, optional): How many changes before the journal is compacted. Defaults to 1000.
+            compact_bytes (int, optional): How large the journal gets before it's compacted. Defaults to 8 MiB.
+            worker (PersistenceWorker, optional): The worker that flushes the journal. Defaults to None (flushed on every change).
+        """
+
+        self.directory = directory
+        self.conversation_id = conversation_id
+        self.logger = logger
+        self.fsync = fsync
+        self.compact_records = compact_records
+        self.compact_bytes = compact_bytes
+        self.worker = worker
+
+        name = quote(conversation_id, safe="")
+        self.snapshot_path = os.path.join(directory, name + SNAPSHOT_SUFFIX)
+        self.journal_path = os.path.join(directory, name + JOURNAL_SUFFIX)
+
+        self.generation = 0
+        self.records = 0       # Changes since the last snapshot, written or not.
+        self.size = 0          # Bytes of changes since the last snapshot, written or not.
+        self.file = None
+        self.damaged = False   # A failed write couldn't be cut back off the journal; the next change asks for a compaction.
+
+        self.lock = threading.Lock()        # Guards the buffer.
+        self.flush_lock = threading.Lock()  # Only one flush at a time.
+        self.buffer: list[bytes] = []       # Encoded changes that haven't been written yet.
+        self.snapshot: list[dict] = None    # A compaction that hasn't been done yet.
+
+
+    def replay(self) -> list[dict]:
+        """Load the conversation from disk and open the journal for writing.
+
+        Returns:
+            list[dict]: The conversation, or None if there's nothing on disk (call `compact` to start one).
+        """
+
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                snapshot = json.load(f)
+
+        except FileNotFoundError:
+            return None
+
+        self.generation = snapshot["generation"]
+        messages = snapshot["messages"]
+        good_size = 0 # Everything past this is a torn write from a crash, or a journal of another generation.
+
+        try:
+            with open(self.journal_path, "rb") as f:
+                for number, line in enumerate(f):
+                    try:
+                        record = json.loads(line)
+
+                        if number == 0:
+                            if record.get("generation") != self.generation:
+                                self.logger.info(f"Ignored a stale journal for \'{self.conversation_id}\'.")
+                                break
+
+                        else:
+                            apply_change(messages, record)
+                            self.records += 1
+
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        self.logger.warning(f"Journal of \'{self.conversation_id}\' ends with a damaged change; dropped it.")
+                        break
+
+                    good_size += len(line)
+
+        except FileNotFoundError:
+            pass
+
+        if good_size:
+            self.file = open(self.journal_path, "r+b") # pylint: disable=consider-using-with
+            self.file.truncate(good_size)
+            self.file.seek(good_size)
+            self.size = good_size
+
+        else:
+            self._start_journal()
+
+        self.logger.debug(f"Replayed {self.records} change(s) for \'{self.conversation_id}\'.")
+
+        return messages
+
+
+    def _start_journal(self):
+        """Start an empty journal for the current generation."""
+
+        if self.file:
+            self.file.close()
+
+        self.file = open(self.journal_path, "wb") # pylint: disable=consider-using-with
+        self._write(dumps({"generation": self.generation}) + b"\n")
+        self.damaged = False
+
+
+    def _write(self, data: bytes):
+        if self.file is None:
+            raise OSError(f"Journal of \'{self.conversation_id}\' is damaged; waiting for a compaction.")
+
+        start = self.file.tell() # Every write is flushed, so nothing is still buffered.
+
+        try:
+            self.file.write(data)
+            self.file.flush()
+
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+        except OSError:
+            self._rewind(start)
+            raise
+
+
+    def _rewind(self, size: int):
+        """Cut a failed write, which may have been written in part, back off the journal. Otherwise retrying it would leave
+        a torn change, with the same changes again behind it, and replaying stops at the torn one. If even that fails, the
+        journal is given up on until the next compaction starts a new one.
+
+        Args:
+            size (int): The size of the journal before the write.
+        """
+
+        try:
+            try:
+                self.file.close() # Also throws away whatever of the write it still had buffered.
+
+            except OSError:
+                pass
+
+            self.file = open(self.journal_path, "r+b") # pylint: disable=consider-using-with
+            self.file.truncate(size)
+            self.file.seek(size)
+
+        except OSError:
+            self.logger.error(f"Failed to undo a failed write to the journal of \'{self.conversation_id}\'; "
+                              "it will be compacted.")
+            self.logger.debug(traceback.format_exc())
+            self.file = None
+            self.damaged = True
+
+
+    def _written(self):
+        """Hand the journal to the worker to be written out, or write it out right away if there's no worker."""
+
+        if self.worker is None:
+            self.flush()
+
+        else:
+            self.worker.mark_dirty(self)
+
+
+    def record(self, change: dict) -> bool:
+        """Record a change.
+
+        Args:
+            change (dict): The change. See `apply_change`.
+
+        Returns:
+            bool: Whether the journal is due for compaction (see `schedule_compaction`).
+        """
+
+        data = dumps(change) + b"\n"
+
+        with self.lock:
+            self.buffer.append(data)
+            self.records += 1
+            self.size += len(data)
+            due = self.damaged or self.records >= self.compact_records or self.size >= self.compact_bytes
+
+        self._written()
+
+        return due
+
+
+    def schedule_compaction(self, messages: list[dict]):
+        """Replace everything recorded so far with a snapshot of the conversation.
+
+        Args:
+            messages (list[dict]): The whole conversation. Must not change afterwards; pass a copy of the list.
+            Messages themselves are never changed in place, so a shallow copy will do.
+        """
+
+        with self.lock:
+            self.snapshot = messages
+            self.buffer = [] # All in the snapshot.
+            self.records = 0
+            self.size = 0
+
+        self._written()
+
+
+    def compact(self, messages: list[dict]):
+        """Write a snapshot of the conversation and start a new, empty journal, right away.
+
+        Args:
+            messages (list[dict]): The whole conversation.
+        """
+
+        with self.lock:
+            self.snapshot = messages
+            self.buffer = []
+            self.records = 0
+            self.size = 0
+
+        self.flush()
+
+
+    def flush(self):
+        """Write out whatever was recorded or scheduled since the last flush.
+
+        Raises:
+            OSError: If writing failed. Nothing is lost; it's retried on the next flush.
+        """
+
+        with self.flush_lock:
+            with self.lock:
+                snapshot, buffer = self.snapshot, self.buffer
+                self.snapshot, self.buffer = None, []
+
+            if snapshot is None and not buffer:
+                return
+
+            try:
+                if snapshot is not None:
+                    self._write_snapshot(snapshot)
+
+                if buffer:
+                    self._write(b"".join(buffer))
+
+            except OSError:
+                with self.lock: # Put it back, behind anything recorded since, unless a newer snapshot replaced it all.
+                    if self.snapshot is None:
+                        self.snapshot = snapshot
+                        self.buffer = buffer + self.buffer
+
+                raise
+
+
+    def _write_snapshot(self, messages: list[dict]):
+        """Write a snapshot of the next generation, then start its journal. Called with `flush_lock` held."""
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        generation = self.generation + 1
+        temporary_path = self.snapshot_path + ".tmp"
+
+        with open(temporary_path, "wb") as f:
+            f.write(dumps({"generation": generation, "messages": messages}))
+            f.flush()
+
+            if self.fsync:
+                os.fsync(f.fileno())
+
+        os.replace(temporary_path, self.snapshot_path)
+
+        self.generation = generation
+        self._start_journal()
+
+
+    @property
+    def dirty(self) -> bool:
+        """Whether there's anything that hasn't been written out yet."""
+
+        with self.lock:
+            return self.snapshot is not None or bool(self.buffer)
+
+
+    def close(self):
+        """Write out anything left, and close the journal."""
+
+        self.flush()
+
+        with self.flush_lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,338 @@
+# memfile.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""A compact binary format for saved conversations (".hfm"), made to be memory-mapped and read lazily.
+
+Messages are stored as length-prefixed JSON records, grouped into blocks of about 64 KiB. Each block is zstd-compressed
+if the `zstandard` package is installed and it actually helps. An index of the blocks sits at the end of the file:
+
+>>> b"HFMEM\\x01"                                     # Header.
+>>> block, block, ...                                  # [u32 length, JSON] * n, maybe compressed.
+>>> (u64 offset, u32 size, u32 messages, u8 codec) * n # The index.
+>>> u64 index offset, u32 blocks, u32 messages, b"HFMEM\\x01"
+
+Loading a file only reads the index; single messages and ranges are decoded on demand, a block at a time.
+"""
+
+
+
+# Imports: Built-in/Standard
+import os                      # Used to replace files atomically.
+import mmap                    # Used to map files instead of reading them.
+import json                    # Used to decode messages.
+import struct                  # Used to pack and unpack records and the index.
+import bisect                  # Used to find the block a message is in.
+from copy import deepcopy      # Used to copy lazy conversations.
+from collections.abc import MutableSequence # Lazy conversations are list-like.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.compression import zstd_is_available      # Blocks are only compressed if zstd is around.
+from src.lib.util.fastjson import dumps, register_type # Used to encode messages, and lazy conversations.
+from src.lib.message import Message                    # Messages are decoded into these.
+
+if zstd_is_available:
+    import zstandard
+
+
+
+# Constants
+
+MAGIC = b"HFMEM\x01"
+SUFFIX = ".hfm" # Saves to files with this extension use the binary format.
+BLOCK_BYTES = 1 << 16 # Blocks are closed once they're at least this large, uncompressed.
+ZSTD_LEVEL = 3
+
+CODEC_NONE = 0
+CODEC_ZSTD = 1
+
+RECORD_LENGTH = struct.Struct("<I")
+INDEX_ENTRY = struct.Struct("<QIIB")
+FOOTER = struct.Struct(f"<QII{len(MAGIC)}s")
+
+
+
+# Functions
+
+def is_memory_file(path: str) -> bool:
+    """Check whether a file is in the binary format.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        bool: Whether it starts with the magic bytes.
+    """
+
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+
+
+
+def write_memory_file(path: str, messages, compress: bool = True):
+    """Write a conversation in the binary format. The file is replaced atomically, so anyone who has the old one mapped
+    keeps seeing the old one.
+
+    Args:
+        path (str): The path of the file.
+        messages: The conversation. Any iterable of messages.
+        compress (bool, optional): Whether to compress blocks, if zstd is available. Defaults to True.
+    """
+
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if compress and zstd_is_available else None
+    temporary_path = path + ".tmp"
+
+    index = []
+    total = 0
+
+    with open(temporary_path, "wb") as f:
+        f.write(MAGIC)
+
+        block, block_size, block_count = [], 0, 0
+
+        def write_block():
+            data = b"".join(block)
+            codec = CODEC_NONE
+
+            if compressor is not None:
+                compressed = compressor.compress(data)
+
+                if len(compressed) < len(data):
+                    data, codec = compressed, CODEC_ZSTD
+
+            index.append(INDEX_ENTRY.pack(f.tell(), len(data), block_count, codec))
+            f.write(data)
+
+        for message in messages:
+            record = dumps(message)
+            block.append(RECORD_LENGTH.pack(len(record)))
+            block.append(record)
+            block_size += RECORD_LENGTH.size + len(record)
+            block_count += 1
+            total += 1
+
+            if block_size >= BLOCK_BYTES:
+                write_block()
+                block, block_size, block_count = [], 0, 0
+
+        if block:
+            write_block()
+
+        index_offset = f.tell()
+        f.write(b"".join(index))
+        f.write(FOOTER.pack(index_offset, len(index), total, MAGIC))
+
+    os.replace(temporary_path, path)
+
+
+
+# Classes
+
+
+
+class MemoryFile:
+    """A conversation in the binary format, memory-mapped. Immutable, and safe to share between threads."""
+
+    def __init__(self, path: str):
+        """Map a file and read its index.
+
+        Args:
+            path (str): The path of the file.
+
+        Raises:
+            ValueError: If the file isn't in the binary format, or uses compression we can't decode.
+        """
+
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) # Stays valid after the file is closed.
+
+        if len(self.map) < len(MAGIC) + FOOTER.size or self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a Hollowfire memory file.")
+
+        index_offset, block_count, self.count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+
+        if magic != MAGIC:
+            raise ValueError("Memory file is truncated.")
+
+        self.blocks: list[tuple[int, int, int, int]] = [] # (offset, size, messages, codec)
+        self.starts: list[int] = []                       # Index of the first message of every block.
+        start = 0
+
+        for i in range(block_count):
+            entry = INDEX_ENTRY.unpack_from(self.map, index_offset + i * INDEX_ENTRY.size)
+
+            if entry[3] == CODEC_ZSTD and not zstd_is_available:
+                raise ValueError("Memory file is zstd-compressed, but zstandard is not installed.")
+
+            self.blocks.append(entry)
+            self.starts.append(start)
+            start += entry[2]
+
+
+    def __len__(self) -> int:
+        return self.count
+
+
+    def block_of(self, index: int) -> int:
+        """Find the block a message is in.
+
+        Args:
+            index (int): The index of the message. Must be in range.
+
+        Returns:
+            int: The index of the block.
+        """
+
+        return bisect.bisect_right(self.starts, index) - 1
+
+
+    def read_block(self, block: int) -> list[bytes]:
+        """Read the records of a block, still encoded.
+
+        Args:
+            block (int): The index of the block.
+
+        Returns:
+            list[bytes]: The JSON of each message of the block.
+        """
+
+        offset, size, count, codec = self.blocks[block]
+        data = self.map[offset:offset + size]
+
+        if codec == CODEC_ZSTD:
+            data = zstandard.ZstdDecompressor().decompress(data)
+
+        records = []
+        position = 0
+
+        for _ in range(count):
+            (length,) = RECORD_LENGTH.unpack_from(data, position)
+            position += RECORD_LENGTH.size
+            records.append(data[position:position + length])
+            position += length
+
+        return records
+
+
+
+
+
+class LazyConversation(MutableSequence):
+    """A conversation backed by a `MemoryFile`. Reads decode only the blocks they touch; the first change decodes the
+    whole thing into a plain list, which is used from then on."""
+
+    def __init__(self, memory_file: MemoryFile):
+        """A lazy conversation.
+
+        Args:
+            memory_file (MemoryFile): The file.
+        """
+
+        self.file = memory_file
+        self.items: list[Message] = None # Set once materialized.
+        self._cached_block = (-1, None) # (block, decoded records); usually the next read is from the same one.
+
+
+    def materialize(self) -> list[Message]:
+        """Decode every message into a plain list, if that wasn't done yet.
+
+        Returns:
+            list[Message]: The messages.
+        """
+
+        if self.items is None:
+            self.items = list(self)
+            self.file = None
+            self._cached_block = (-1, None)
+
+        return self.items
+
+
+    def _block(self, block: int) -> list[bytes]:
+        if self._cached_block[0] != block:
+            self._cached_block = (block, self.file.read_block(block))
+
+        return self._cached_block[1]
+
+
+    def _message(self, index: int) -> Message:
+        block = self.file.block_of(index)
+        return Message.from_wire(json.loads(self._block(block)[index - self.file.starts[block]]))
+
+
+    def __len__(self) -> int:
+        return len(self.items) if self.items is not None else len(self.file)
+
+
+    def __getitem__(self, index):
+        if self.items is not None:
+            return self.items[index]
+
+        if isinstance(index, slice):
+            return [self._message(i) for i in range(*index.indices(len(self.file)))]
+
+        return self._message(range(len(self.file))[index])
+
+
+    def __iter__(self):
+        if self.items is not None:
+            yield from self.items
+            return
+
+        for block in range(len(self.file.blocks)):
+            for record in self.file.read_block(block):
+                yield Message.from_wire(json.loads(record))
+
+
+    def __setitem__(self, index, value):
+        self.materialize()[index] = value
+
+
+    def __delitem__(self, index):
+        del self.materialize()[index]
+
+
+    def insert(self, index, value):
+        self.materialize().insert(index, value)
+
+
+    def append(self, value):
+        self.materialize().append(value)
+
+
+    def copy(self):
+        """A shallow copy. Cheap while nothing's been decoded; the file itself is never copied."""
+
+        if self.items is not None:
+            return list(self.items)
+
+        return LazyConversation(self.file)
+
+
+    def __deepcopy__(self, memo) -> list[Message]:
+        return deepcopy(list(self), memo)
+
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+
+    def __repr__(self) -> str:
+        if self.items is not None:
+            return repr(self.items)
+
+        return f"<LazyConversation of {len(self.file)} message(s)>"
+
+
+
+
+
+register_type(LazyConversation, LazyConversation.materialize)
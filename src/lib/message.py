@@ -0,0 +1,283 @@
+# message.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""The compact, immutable message type conversations are stored as.
+
+A message on the wire is a dict (`{"role": "user", "content": "..."}`, sometimes with more keys, like "images"). Kept as
+such, every message pays for a dict, and every conversation for its own copy of "user" and "assistant". A `Message` is a
+slotted object with an interned role instead, and can't be changed, so it can be shared (between conversations, forks,
+snapshots...) and never has to be copied.
+
+Messages are converted from the wire format as they come into a conversation (`Message.from_wire`), and back only where
+they leave Hollowfire: responses (`dumps` knows the type) and the payloads sent to the model (`OutgoingMessages`).
+"""
+
+
+
+# Imports: Built-in/Standard
+import sys                           # Used to intern roles.
+from collections.abc import Sequence # Outgoing messages are list-like.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.util.fastjson import register_type # Messages are encoded straight into responses.
+
+
+
+# Functions
+
+def to_messages(messages) -> list:
+    """Convert a whole conversation from the wire format.
+
+    Args:
+        messages: Any iterable of messages.
+
+    Returns:
+        list: A new list of messages. See `Message.from_wire`.
+    """
+
+    return [Message.from_wire(message) for message in messages]
+
+
+
+
+
+def wire_messages(messages) -> list:
+    """Convert a whole conversation to the wire format, e.g. to save it. To send it to the model, see `OutgoingMessages`.
+
+    Args:
+        messages: Any iterable of messages.
+
+    Returns:
+        list: A new list of new dicts (see `Message.to_wire`). Messages that weren't converted are passed through as they are.
+    """
+
+    return [message.to_wire() if type(message) is Message else message for message in messages] # pylint: disable=unidiomatic-typecheck
+
+
+
+# Classes
+
+
+
+class Message:
+    """A single message of a conversation. Immutable; to change a message, replace it with another one."""
+
+    __slots__ = ("role", "content", "extra")
+
+    def __init__(self, role: str, content: str, extra: tuple[tuple[str, object], ...] = ()):
+        """A message.
+
+        Args:
+            role (str): The role ("system", "user", "assistant", "tool"...). Interned.
+            content (str): The text of the message.
+            extra (tuple[tuple[str, object], ...], optional): Any other keys of the message, as (key, value) pairs, in order.
+            Their values must not be changed in place either. Defaults to ().
+        """
+
+        object.__setattr__(self, "role", sys.intern(role))
+        object.__setattr__(self, "content", content)
+        object.__setattr__(self, "extra", extra)
+
+
+    @classmethod
+    def from_wire(cls, message):
+        """Convert a message from the wire format.
+
+        Args:
+            message: The message, usually a dict. Already converted messages are returned as they are.
+
+        Returns:
+            Message: The message. Anything that isn't a dict with a string role and content is returned as it is; we let
+            clients shoot themselves in the foot if they get the format wrong.
+        """
+
+        if type(message) is not dict: # pylint: disable=unidiomatic-typecheck # Fast path for the common case.
+            return message
+
+        role = message.get("role")
+        content = message.get("content")
+
+        if not isinstance(role, str) or not isinstance(content, str):
+            return message
+
+        if len(message) == 2:
+            return cls(role, content)
+
+        return cls(role, content, tuple((key, value) for key, value in message.items() if key not in ("role", "content")))
+
+
+    def to_wire(self) -> dict:
+        """Convert the message to the wire format.
+
+        Returns:
+            dict: A new dict, the caller's to change. Values of extra keys are shared, so don't change those in place.
+        """
+
+        wire = {"role": self.role, "content": self.content}
+
+        if self.extra:
+            wire.update(self.extra)
+
+        return wire
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Messages can't be changed; replace them instead.")
+
+
+    def __delattr__(self, name):
+        raise AttributeError("Messages can't be changed; replace them instead.")
+
+
+    def __copy__(self):
+        return self
+
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+    def __getitem__(self, key: str):
+        """Read a key like the message was still a dict."""
+
+        if key == "role":
+            return self.role
+
+        if key == "content":
+            return self.content
+
+        for extra_key, value in self.extra:
+            if extra_key == key:
+                return value
+
+        raise KeyError(key)
+
+
+    def get(self, key: str, default=None):
+        """Read a key like the message was still a dict."""
+
+        try:
+            return self[key]
+
+        except KeyError:
+            return default
+
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Message):
+            return self.role == other.role and self.content == other.content and self.extra == other.extra
+
+        if isinstance(other, dict):
+            return self.to_wire() == other
+
+        return NotImplemented
+
+
+    def __hash__(self) -> int:
+        return hash((self.role, self.content))
+
+
+    def __repr__(self) -> str:
+        return f"Message({self.to_wire()!r})"
+
+
+    def __reduce__(self):
+        return (Message, (self.role, self.content, self.extra))
+
+
+
+
+
+register_type(Message, Message.to_wire)
+
+
+
+
+
+class OutgoingMessages(Sequence):
+    """The messages of a single completion, as they're sent to the model: a view of the stored messages, plus messages
+    inserted for this completion only (e.g. FAISS context). Nothing is copied to build one, so it costs the same however
+    long the conversation is; messages are converted to the wire format one by one, as the client reads them.
+
+    The stored messages must not change while the view is in use; build it and send it with the conversation's lock held.
+    """
+
+    def __init__(self, messages):
+        """A view of stored messages.
+
+        Args:
+            messages: The messages. Any sequence of them: a conversation, a list of wire dicts...
+        """
+
+        self.messages = messages
+        self.segments: list = [range(len(messages))] # Indices into `messages`, and lists of inserted messages, in order.
+
+
+    def insert(self, index: int, message):
+        """Insert a message into the view, like `list.insert`. The stored messages are left alone.
+
+        Args:
+            index (int): The index to insert it before. Negative indices count from the end.
+            message: The message.
+        """
+
+        length = len(self)
+        index = min(max(index + length if index < 0 else index, 0), length)
+
+        for i, segment in enumerate(self.segments):
+            if index <= len(segment):
+                if isinstance(segment, list):
+                    segment.insert(index, message)
+
+                else:
+                    self.segments[i:i + 1] = [segment[:index], [message], segment[index:]]
+
+                return
+
+            index -= len(segment)
+
+
+    def _wire(self, message):
+        return message.to_wire() if type(message) is Message else message # pylint: disable=unidiomatic-typecheck
+
+
+    def __len__(self) -> int:
+        return sum(map(len, self.segments))
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        index = range(len(self))[index]
+
+        for segment in self.segments:
+            if index < len(segment):
+                return self._wire(segment[index] if isinstance(segment, list) else self.messages[segment[index]])
+
+            index -= len(segment)
+
+        raise IndexError(index) # Unreachable; `range` already checked it.
+
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, list):
+                yield from map(self._wire, segment)
+
+            elif len(segment) == len(self.messages):
+                yield from map(self._wire, self.messages)
+
+            else:
+                yield from map(self._wire, (self.messages[i] for i in segment))
+
+
+    def __repr__(self) -> str:
+        return f"<OutgoingMessages: {len(self)} message(s)>" # The parameters are logged; don't dump the whole conversation.
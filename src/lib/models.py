@@ -0,0 +1,424 @@
+# models.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Model residency. Loading a model into the backend takes seconds (far longer than most completions), and the backend
+unloads models it hasn't used in a while (after their `keep_alive`). A `ModelKeeper` preloads models in the background at
+startup, decides the `keep_alive` sent with every completion, and pins models that should never be unloaded:
+
+>>> keeper.warmup(["qwen3"])  # Returns right away; the model loads in the background.
+>>> keeper.keep_alive("qwen3") # "5m", or -1 once pinned.
+>>> keeper.pin("qwen3")        # Loaded, and kept loaded, until unpinned.
+
+It also watches for reloads: the backend reloads a model whenever a completion asks for a different context window
+(`num_ctx`) than the model was loaded with. Every reload is logged and reported (`stats`), along with which conversations
+use which context window, so whatever keeps asking for another one can be found.
+"""
+
+
+
+# Imports: Built-in/Standard
+import re        # Used to parse durations.
+import time      # Used to time loads, and to tell when a model was last used.
+import logging   # Used for logging.
+import threading # Used to guard the model table.
+import traceback # Used to get information about exceptions.
+from collections import deque # Used for the log of recent reloads.
+from concurrent.futures import ThreadPoolExecutor # Loads run in the background.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+# ...
+
+
+
+# Constants
+
+DEFAULT_KEEP_ALIVE = "5m" # The backend's own default.
+PINNED = -1               # Keeps a model loaded until told otherwise.
+DEFAULT_NUM_CTX = 4096    # What models are loaded with, unless we know better.
+RELOAD_LOG_SIZE = 32      # How many of the most recent reloads are reported.
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+
+# Functions
+
+def parse_keep_alive(value):
+    """Read a `keep_alive` the way the backend takes it: a number of seconds, or a duration ("5m", "1h30m").
+
+    Args:
+        value: The value. Strings that are numbers become numbers.
+
+    Returns:
+        int | float | str: The value to send.
+
+    Raises:
+        ValueError: If it's neither.
+    """
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+
+    if isinstance(value, str):
+        try:
+            number = float(value)
+            return int(number) if number.is_integer() else number
+
+        except ValueError:
+            if keep_alive_seconds(value) is not None:
+                return value
+
+    raise ValueError(f"\'{value}\' is not a valid keep_alive; use a number of seconds or a duration like \"5m\".")
+
+
+
+
+
+def keep_alive_seconds(value) -> float:
+    """Convert a `keep_alive` to seconds.
+
+    Args:
+        value: The value, as `parse_keep_alive` gives it.
+
+    Returns:
+        float: The seconds. Negative means forever. None if it isn't a duration.
+    """
+
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+
+    if not isinstance(value, str):
+        return None
+
+    sign = -1.0 if value.startswith("-") else 1.0
+    text = value.lstrip("-")
+    parts = _DURATION.findall(text)
+
+    if not parts or "".join(number + unit for number, unit in parts) != text:
+        return None
+
+    return sign * sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+
+# Classes
+
+
+
+class ModelKeeper:
+    """Keeps track of which models are (probably) loaded into the backend, loads them ahead of time, and decides how long
+    the backend keeps them around. Loads run one at a time, on a background thread, since models loaded at once only
+    compete for the same memory. Call `stop` on shutdown."""
+
+    def __init__(self,
+                 logger: logging.Logger,
+                 load: callable,
+                 default_keep_alive=DEFAULT_KEEP_ALIVE,
+                 pinned: list[str] = None,
+                 num_ctx: int = DEFAULT_NUM_CTX,
+                 ):
+        """A model keeper.
+
+        Args:
+            logger (logging.Logger): The logger to use.
+            load (callable): Loads a model into the backend: `load(model, keep_alive, num_ctx)`. Blocks until it's loaded,
+            and raises if it couldn't be. Also used to change the `keep_alive` of a model that's already loaded.
+            default_keep_alive (optional): How long the backend keeps a model it isn't using. See `parse_keep_alive`.
+            Defaults to "5m".
+            pinned (list[str], optional): Models that are never unloaded. They aren't loaded until `warmup` or a completion
+            asks for them. Defaults to None.
+            num_ctx (int, optional): The context window models are loaded with, until a completion uses another one.
+            Should be what most conversations use. Defaults to 4096.
+        """
+
+        self.logger = logger
+        self.load = load
+        self.default_keep_alive = parse_keep_alive(default_keep_alive)
+        self.num_ctx = num_ctx
+
+        self.lock = threading.Lock()
+        self.models: dict[str, dict] = {} # Model -> what we know of it; see `_model`.
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="Hollowfire-Models")
+
+        self.placements: dict[str, tuple[str, int]] = {} # Conversation ID -> (model, num_ctx) of its last completion.
+        self.reloads = deque(maxlen=RELOAD_LOG_SIZE)
+        self.total_reloads = 0
+
+        for model in pinned or []:
+            self._model(model)["keep_alive"] = PINNED
+
+
+    def _model(self, model: str) -> dict:
+        """What we know of a model, added if it's new. Call it with the lock held."""
+
+        if model not in self.models:
+            self.models[model] = {
+                "keep_alive": None, # Ours; None for the default.
+                "state": "unloaded", # "unloaded", "loading", "loaded" or "failed".
+                "last_used": None,   # time.monotonic() of the last completion or load.
+                "load_ms": None,     # How long the last load took.
+                "loads": 0,
+                "num_ctx": None,     # The context window it was (last) loaded with.
+                "reloads": 0,
+            }
+
+        return self.models[model]
+
+
+    def keep_alive(self, model: str):
+        """How long the backend should keep a model around after it's used. Sent with every completion.
+
+        Args:
+            model (str): The model.
+
+        Returns:
+            int | float | str: The keep_alive.
+        """
+
+        with self.lock:
+            info = self.models.get(model)
+            keep_alive = info["keep_alive"] if info is not None else None
+
+        return self.default_keep_alive if keep_alive is None else keep_alive
+
+
+    def used(self, model: str, num_ctx: int = None, conversation: str = None):
+        """Note that a completion was sent to a model, which (re)loads it and restarts its keep_alive. A model that's still
+        loaded, with a different context window, is reloaded by the backend; that's logged and counted.
+
+        Args:
+            model (str): The model.
+            num_ctx (int, optional): The context window of the completion. Defaults to None (not known).
+            conversation (str, optional): The ID of the conversation it's for. Defaults to None.
+        """
+
+        with self.lock:
+            info = self._model(model)
+            reloaded_from = info["num_ctx"] if num_ctx is not None and info["num_ctx"] not in (None, num_ctx) and self._resident(info) else None
+
+            info["last_used"] = time.monotonic()
+            info["num_ctx"] = num_ctx if num_ctx is not None else info["num_ctx"]
+
+            if info["state"] != "loading":
+                info["state"] = "loaded"
+
+            if conversation is not None and num_ctx is not None:
+                self.placements[conversation] = (model, num_ctx)
+
+            if reloaded_from is not None:
+                info["reloads"] += 1
+                self.total_reloads += 1
+                self.reloads.append({
+                    "model": model,
+                    "from_num_ctx": reloaded_from,
+                    "to_num_ctx": num_ctx,
+                    "conversation": conversation,
+                    "at": time.time(),
+                })
+
+        if reloaded_from is not None:
+            self.logger.warning(f"Model '{model}' is being reloaded: num_ctx {reloaded_from} -> {num_ctx}, "
+                                f"for conversation '{conversation}'.")
+
+
+    def forget(self, conversation: str):
+        """Stop counting a conversation towards its model's context window, e.g. once it's spilled or reset. Its next
+        completion counts it again.
+
+        Args:
+            conversation (str): The ID of the conversation.
+        """
+
+        with self.lock:
+            self.placements.pop(conversation, None)
+
+
+    def warmup(self, models: list[str]):
+        """Load models in the background, so the first completion doesn't wait for them. Returns right away.
+
+        Args:
+            models (list[str]): The models. Models already loaded or loading are skipped.
+        """
+
+        for model in dict.fromkeys(models): # Drop duplicates, keep the order.
+            with self.lock:
+                if self._resident(self._model(model)):
+                    continue
+
+                self.models[model]["state"] = "loading"
+                self.models[model]["num_ctx"] = self.models[model]["num_ctx"] or self.num_ctx
+
+            self.executor.submit(self._load, model)
+
+
+    def pin(self, model: str) -> dict:
+        """Keep a model loaded until it's unpinned, loading it in the background if needed. Returns right away.
+
+        Args:
+            model (str): The model.
+
+        Returns:
+            dict: What we know of the model now. See `stats`.
+        """
+
+        with self.lock:
+            info = self._model(model)
+            info["keep_alive"] = PINNED
+            info["state"] = "loading" if info["state"] != "loaded" else info["state"]
+            info["num_ctx"] = info["num_ctx"] or self.num_ctx
+
+        # Even if it's loaded, the backend only learns of the new keep_alive with a request.
+        self.executor.submit(self._load, model)
+        self.logger.info(f"Pinned model \'{model}\'.")
+
+        return self.model_stats(model)
+
+
+    def unpin(self, model: str) -> dict:
+        """Let the backend unload a model again, once it's been unused for the default keep_alive.
+
+        Args:
+            model (str): The model.
+
+        Returns:
+            dict: What we know of the model now, or None if it wasn't pinned.
+        """
+
+        with self.lock:
+            info = self.models.get(model)
+
+            if info is None or info["keep_alive"] != PINNED:
+                return None
+
+            info["keep_alive"] = None
+            loaded = self._resident(info)
+
+        if loaded: # Otherwise there's nothing the backend would keep around anyway.
+            self.executor.submit(self._load, model)
+
+        self.logger.info(f"Unpinned model \'{model}\'.")
+
+        return self.model_stats(model)
+
+
+    def _resident(self, info: dict) -> bool:
+        """Whether a model is loaded (or loading), as far as we can tell. Call it with the lock held."""
+
+        if info["state"] == "loading":
+            return True
+
+        if info["state"] != "loaded":
+            return False
+
+        keep_alive = self.default_keep_alive if info["keep_alive"] is None else info["keep_alive"]
+        seconds = keep_alive_seconds(keep_alive)
+
+        return seconds is None or seconds < 0 or time.monotonic() - info["last_used"] < seconds
+
+
+    def _load(self, model: str):
+        """Load a model, on the background thread."""
+
+        keep_alive = self.keep_alive(model)
+
+        with self.lock: # Whatever it's loaded with by now; loading it with anything else would be a reload.
+            num_ctx = self.models[model]["num_ctx"] or self.num_ctx
+
+        started = time.perf_counter()
+
+        try:
+            self.load(model, keep_alive, num_ctx)
+
+        except: # pylint: disable=bare-except
+            self.logger.warning(f"Failed to load model \'{model}\'. The first completion using it will load it instead.")
+            self.logger.debug(traceback.format_exc())
+
+            with self.lock:
+                self.models[model]["state"] = "failed"
+
+            return
+
+        elapsed = (time.perf_counter() - started) * 1000
+
+        with self.lock:
+            info = self.models[model]
+            info["state"] = "loaded"
+            info["last_used"] = time.monotonic()
+            info["load_ms"] = round(elapsed, 1)
+            info["loads"] += 1
+
+        self.logger.info(f"Model \'{model}\' is loaded (keep_alive {keep_alive}, took {elapsed:.0f}ms).")
+
+
+    def model_stats(self, model: str) -> dict:
+        """Report what we know of a single model.
+
+        Args:
+            model (str): The model.
+
+        Returns:
+            dict: Its state, keep_alive, whether it's pinned, and how long its last load took. None if we don't know it.
+        """
+
+        with self.lock:
+            info = self.models.get(model)
+
+            if info is None:
+                return None
+
+            keep_alive = self.default_keep_alive if info["keep_alive"] is None else info["keep_alive"]
+            state = info["state"]
+
+            if state == "loaded" and not self._resident(info):
+                state = "expired" # Unused for longer than its keep_alive; the backend has most likely unloaded it.
+
+            return {
+                "model": model,
+                "state": state,
+                "pinned": info["keep_alive"] == PINNED,
+                "keep_alive": keep_alive,
+                "num_ctx": info["num_ctx"],
+                "load_ms": info["load_ms"],
+                "loads": info["loads"],
+                "reloads": info["reloads"],
+            }
+
+
+    def stats(self) -> dict:
+        """Report what we know of every model.
+
+        Returns:
+            dict: The default keep_alive; every model's `model_stats`; how many conversations use each context window of
+            each model; and the most recent reloads.
+        """
+
+        with self.lock:
+            models = list(self.models)
+            buckets: dict[str, dict[int, int]] = {}
+
+            for model, num_ctx in self.placements.values():
+                buckets.setdefault(model, {}).setdefault(num_ctx, 0)
+                buckets[model][num_ctx] += 1
+
+            reloads = {"total": self.total_reloads, "recent": list(self.reloads)}
+
+        return {
+            "default_keep_alive": self.default_keep_alive,
+            "models": [self.model_stats(model) for model in models],
+            "conversations_by_num_ctx": buckets,
+            "reloads": reloads,
+        }
+
+
+    def stop(self):
+        """Stop loading models. Loads that haven't started yet are dropped."""
+
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,173 @@
+# persistence.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Background persistence for conversations. Requests only record their changes in memory; a single worker thread writes
+out the journals of dirty conversations a short while later. A burst of changes then costs one write (and one fsync),
+and request threads never wait on the disk."""
+
+
+
+# Imports: Built-in/Standard
+import time      # Used to time flushes.
+import logging   # Used for logging.
+import threading # Used for the worker.
+import traceback # Used to get information about exceptions.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.journal import ConversationJournal # The journals being written out.
+
+
+
+# Constants
+
+AUTOSAVE_INTERVAL = 0.2 # Seconds. How long changes are collected before they're written out.
+RETRY_BACKOFF = 1.0 # Seconds. How long a journal that failed to be written out waits before it's retried, doubling every time.
+MAX_RETRY_BACKOFF = 60.0 # Seconds. The longest it waits.
+
+
+
+# Classes
+
+
+
+class PersistenceWorker:
+    """Writes out dirty journals in the background. Call `stop` on shutdown to write out everything that's left."""
+
+    def __init__(self, logger: logging.Logger, interval: float = AUTOSAVE_INTERVAL):
+        """A persistence worker. Starts right away.
+
+        Args:
+            logger (logging.Logger): The logger to use.
+            interval (float, optional): How long changes are collected before they're written out, in seconds. Defaults to 0.2.
+        """
+
+        self.logger = logger
+        self.interval = max(0.0, interval)
+
+        self.condition = threading.Condition(threading.Lock())
+        # Journals with unwritten changes -> (when they're due, failed attempts so far). Keyed by the journal itself, not its
+        # conversation: a conversation spilled and rehydrated in the meantime has a new journal, and both need writing out.
+        self.dirty: dict[ConversationJournal, tuple[float, int]] = {}
+        self.stopping = False
+
+        self.flushes = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+
+        self.thread = threading.Thread(target=self._work, name="Hollowfire-Persistence", daemon=True)
+        self.thread.start()
+
+
+    def mark_dirty(self, journal: ConversationJournal):
+        """Note that a journal has unwritten changes. Cheap; called on every change.
+
+        Args:
+            journal (ConversationJournal): The journal.
+        """
+
+        with self.condition:
+            if journal not in self.dirty: # One that's failing keeps waiting out its backoff.
+                self.dirty[journal] = (0.0, 0)
+                self.condition.notify()
+
+
+    def _work(self):
+        """Wait for changes, let them pile up for a moment, then write out the ones that are due."""
+
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    due = min((due for due, _ in self.dirty.values()), default=None)
+
+                    if due is not None and due <= time.monotonic():
+                        break
+
+                    self.condition.wait(None if due is None else due - time.monotonic())
+
+                if self.stopping:
+                    return
+
+            time.sleep(self.interval) # Debounce; whatever else changes in the meantime goes out with this batch.
+
+            self.flush(due_only=True)
+
+
+    def flush(self, due_only: bool = False):
+        """Write out dirty journals, right now. Thread-safe.
+
+        Args:
+            due_only (bool, optional): Leave the ones that failed recently alone until their backoff is over. Defaults to
+            False (write out all of them).
+        """
+
+        now = time.monotonic()
+
+        with self.condition:
+            journals = {journal: state for journal, state in self.dirty.items() if not due_only or state[0] <= now}
+
+            for journal in journals:
+                del self.dirty[journal]
+
+        if not journals:
+            return
+
+        started = time.perf_counter()
+
+        for journal, (_, attempts) in journals.items():
+            try:
+                journal.flush()
+
+            except OSError:
+                self.failures += 1
+                backoff = min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** attempts)
+
+                self.logger.error(f"Failed to write out conversation \'{journal.conversation_id}\'; will retry in {backoff:g}s.")
+                self.logger.debug(traceback.format_exc())
+
+                with self.condition: # Replaces the entry it got if it was changed in the meantime, so the backoff sticks.
+                    self.dirty[journal] = (time.monotonic() + backoff, attempts + 1)
+                    self.condition.notify()
+
+        self.flushes += 1
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+
+    def stop(self):
+        """Stop the worker and write out everything that's left. Blocking call."""
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+        self.thread.join()
+        self.flush()
+
+        self.logger.info("Conversations written out.")
+
+
+    def stats(self) -> dict:
+        """The live state of the worker.
+
+        Returns:
+            dict: Counters and the amount of journals waiting to be written out, and retried after failing.
+        """
+
+        with self.condition:
+            dirty = len(self.dirty)
+            retrying = sum(1 for _, attempts in self.dirty.values() if attempts)
+
+        return {
+            "dirty": dirty,
+            "retrying": retrying,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "interval_ms": self.interval * 1000,
+        }
@@ -15,7 +15,10 @@
 import os                      # Used for path manipulation, among other things.
 import json                    # Used to parse JSON files.
 import logging                 # Used for logging.
+import secrets                 # Used to tell ETags from different runs apart.
+import threading               # Used to guard the rendered startout cache.
 from copy import deepcopy      # Used for deep copying objects.
+from collections import deque  # Used for the log of recent changes.
 import traceback               # Used to get information about exceptions.
 
 from abc import abstractmethod # Used for abstract methods.
@@ -26,6 +29,89 @@ from abc import abstractmethod # Used for abstract methods.
 
 # Imports: Local/source
 from src.lib.util.locateutils import locate_attribute # Utility functions for finding files, directories, things within lists, etc.
+from src.lib.util.fastjson import dumps               # Used to serialize the conversation for responses.
+from src.lib.httpio import etag_matches               # Used for conditional requests.
+from src.lib.journal import ConversationJournal       # Used to persist every change as it happens.
+from src.lib.memfile import SUFFIX as MEMORY_FILE_SUFFIX, LazyConversation, MemoryFile, is_memory_file, write_memory_file # Binary saves.
+from src.lib.convcache import message_size, conversation_size # Used to keep track of how much memory we take up.
+from src.lib.message import Message, to_messages, wire_messages # Messages are stored compactly, and converted at the edges.
+from src.lib.forks import SharedConversation         # Forks share their messages.
+from src.lib.context import CONTEXT_POLICIES, DEFAULT_CONTEXT_POLICY, NUM_CTX_BUCKETS, context_budget, conversation_tokens, message_tokens, select_context, snap_num_ctx
+from src.lib.models import DEFAULT_NUM_CTX, ModelKeeper # Decides how long models stay loaded.
+from src.lib.completioncache import CompletionCache  # Deterministic completions are replayed.
+
+
+
+# Constants
+
+DEFAULT_MODEL = "qwen3" # Unless --model says otherwise.
+
+CHANGE_LOG_SIZE = 256 # How many versions back delta reads (`?since_version=`) can go before falling back to everything.
+RANGE_PARAMETERS = ("since_version", "since", "last", "start", "end")
+
+# What's kept of a conversation besides its messages when it's spilled to disk (see src/lib/convcache.py).
+STATE_ATTRIBUTES = (
+    "model", "temperature", "top_p", "top_k", "repeat_penalty", "stop", "think", "num_ctx",
+    "system_replacements", "reset_point", "startout_configuration", "memory_dir", "profile_dir",
+    "version", "version_epoch", "context_policy",
+)
+
+# What /set-default may change.
+DEFAULT_KEYS = ("model", "temperature", "top_p", "top_k", "repeat_penalty", "stop", "think", "num_ctx", "context_policy")
+
+
+
+RENDERED_STARTOUT_CACHE_SIZE = 64 # How many (startout, replacements) renderings are kept around.
+
+_rendered_startouts: dict[tuple, tuple[list, tuple[Message, ...]]] = {} # (id(startout), replacements) -> (startout, rendering)
+_rendered_startouts_lock = threading.Lock()
+
+
+
+# Functions
+
+def render_startout(startout: list[dict[str, str]], replacements: dict[str, str]) -> tuple[Message, ...]:
+    """Apply the system replacements to a startout. Renderings are cached and shared by every conversation using them,
+    which is fine as messages can't be changed in place (a conversation that edits one replaces it).
+
+    Args:
+        startout (list[dict[str, str]]): The startout. Must not be changed afterwards.
+        replacements (dict[str, str]): A map of strings in the startout to replace with other strings.
+
+    Returns:
+        tuple[Message, ...]: The rendered messages.
+    """
+
+    try:
+        cache_key = (id(startout), tuple(replacements.items()))
+        hash(cache_key)
+
+    except TypeError: # Someone put something unhashable in the replacements (a persona, probably). Don't cache it.
+        cache_key = None
+
+    if cache_key is not None:
+        with _rendered_startouts_lock:
+            cached = _rendered_startouts.get(cache_key)
+
+            if cached is not None and cached[0] is startout: # Holding on to the startout keeps its id from being reused.
+                return cached[1]
+
+    rendered = deepcopy(startout)
+
+    for key, value in replacements.items():
+        for message in rendered:
+            message["content"] = message["content"].replace(key, value)
+
+    rendered = tuple(to_messages(rendered))
+
+    if cache_key is not None:
+        with _rendered_startouts_lock:
+            if len(_rendered_startouts) >= RENDERED_STARTOUT_CACHE_SIZE:
+                del _rendered_startouts[next(iter(_rendered_startouts))]
+
+            _rendered_startouts[cache_key] = (startout, rendered)
+
+    return rendered
 
 
 
@@ -87,14 +173,29 @@ class BaseAIProvider:
         self.startout_configuration = startout_configuration
 
         # default AI configurations
-        self.model = "qwen3"
+        self.model = getattr(cli_args, "model", None) or DEFAULT_MODEL
         self.temperature = 0.65
         self.top_p = 0.95
         self.top_k = 20
         self.repeat_penalty = 1.3
         self.stop = []
         self.think = True
-        self.num_ctx = 4096 # WHY????
+        self.num_ctx = DEFAULT_NUM_CTX # WHY????
+        self.context_policy = getattr(cli_args, "context_policy", DEFAULT_CONTEXT_POLICY) # See src/lib/context.py.
+        self.num_ctx_buckets = tuple(sorted(set(getattr(cli_args, "num_ctx_buckets", NUM_CTX_BUCKETS)))) # Same.
+
+        # Every change to the conversation bumps its version, which clients see as the ETag.
+        # Changes go through the `conversation` setter or the mutation helpers below, never straight into the list.
+        self.version = 0
+        self.version_epoch = secrets.token_hex(4) # So an ETag from before a restart never matches.
+        self._conversation = []
+        self._serialized = None # (version, the conversation as a response body)
+        self.changes = deque(maxlen=CHANGE_LOG_SIZE) # (version, index of the first message it changed), for delta reads.
+        self.journal: ConversationJournal = None # Set with `attach_journal`; every change is recorded to it.
+        self.message_bytes = 0 # Estimated memory taken up by the messages.
+        self.tokens = 0 # Estimated tokens of the messages; None while a lazy conversation hasn't been counted yet.
+        self.models: ModelKeeper = None # Set by the client; decides the keep_alive of completions.
+        self.completion_cache: CompletionCache = None # Set by the client, if completions are cached.
 
         # Now, instead of having multiple conversations, this class *itself* is a conversation.
         self.conversation = self.update_reset_point()
@@ -109,153 +210,504 @@ class BaseAIProvider:
         """Updates the reset point based on the current state of self.system_replacements.
 
         Returns:
-            list[dict[str, str]]: The updated reset point. This function does not act upon the original reset point.
+            list[Message]: The updated reset point. This function does not act upon the original reset point.
+            The list is ours to change, but its messages are shared with other conversations (see `render_startout`).
         """
 
-        new_srep = deepcopy(self.reset_point)
+        return list(render_startout(self.reset_point, self.system_replacements))
 
-        for key, value in self.system_replacements.items():
-            for message in new_srep:
-                #print(message)
-                message["content"] = message["content"].replace(key, value)
 
-        return new_srep
 
 
 
+    @property
+    def conversation(self) -> list[Message]:
+        """The conversation. Don't change it in place; use the mutation helpers, so the version is bumped.
+        Messages are stored as `Message`s; set it to messages in the wire format, and they're converted."""
 
+        return self._conversation
 
-                            # In this case, json_data probably isn't going to be used in a way that could be dangerous.
-    def memory_update(self, # pylint: disable=dangerous-default-value
-                      request,
-                      #action: Literal["GET", "POST", "PUT", "DELETE", "PATCH"],
-                      ):#json_data: dict = {}):
-        """Update the memory of the AI provider/conversation.
+
+    @conversation.setter
+    def conversation(self, messages: list[dict]):
+        if isinstance(messages, list): # A lazy conversation decodes its messages as `Message`s already.
+            messages = to_messages(messages)
+
+        self._conversation = messages
+        self.message_bytes = conversation_size(messages)
+        self.tokens = None if self._is_lazy() else conversation_tokens(messages)
+        self.touch()
+
+        if self.journal is not None: # Everything changed; a snapshot is as cheap as recording it.
+            self._record(None)
+
+
+    def attach_journal(self, journal: ConversationJournal):
+        """Persist the conversation through a journal from now on. If the journal has a conversation on disk, it's
+        restored; otherwise, the journal starts out with the current one.
 
         Args:
-            action (Literal["GET", "POST", "PUT", "DELETE", "PATCH"]): The action to perform.
-            json_data (dict, optional): JSON data to use if applicable. Defaults to {}.
+            journal (ConversationJournal): The journal.
+        """
+
+        messages = journal.replay()
+
+        if messages is None:
+            journal.compact(self._conversation)
+
+        else:
+            self._conversation = messages = to_messages(messages)
+            self.message_bytes = conversation_size(messages)
+            self.tokens = conversation_tokens(messages)
+            self.touch()
+
+        self.journal = journal
+
+
+    def export_state(self) -> dict:
+        """Everything about the conversation but its messages, to be brought back with `import_state`.
+
+        Returns:
+            dict: The state. JSON-serializable.
+        """
+
+        return {attribute: getattr(self, attribute) for attribute in STATE_ATTRIBUTES}
+
+
+    def import_state(self, state: dict):
+        """Bring back what `export_state` gave. The version carries over, so clients' ETags stay valid.
+
+        Args:
+            state (dict): The state.
+        """
+
+        self.__dict__.update({attribute: state[attribute] for attribute in STATE_ATTRIBUTES if attribute in state})
+        self.changes.clear() # Delta reads from before can't be served anymore; they'll get everything.
+        self._serialized = None
+
+
+    def _resized(self, was_lazy: bool, delta: int, token_delta: int):
+        """Keep `message_bytes` and `tokens` up to date after a change.
+
+        Args:
+            was_lazy (bool): Whether the conversation was lazy (not decoded yet, or still shared) before the change.
+            delta (int): How much the change added, in bytes.
+            token_delta (int): How much the change added, in tokens.
+        """
+
+        if was_lazy and not self._is_lazy(): # The change decoded it all, or copied what it shared.
+            self.message_bytes = conversation_size(self._conversation)
+            self.tokens = conversation_tokens(self._conversation)
+
+        else:
+            self.message_bytes += delta
+
+            if self.tokens is not None:
+                self.tokens += token_delta
+
+
+    @property
+    def token_count(self) -> int:
+        """The estimated tokens of the whole conversation. Kept up to date as it changes, so this is free."""
+
+        if self.tokens is None: # Lazy, and not counted yet; reading it doesn't decode it for good.
+            self.tokens = conversation_tokens(self._conversation)
+
+        return self.tokens
+
+
+    def context_size(self, options: dict = None) -> int:
+        """The context window (`num_ctx`) of a completion, snapped to a bucket. See `snap_num_ctx`.
+
+        Args:
+            options (dict, optional): The model options of the completion, if they're not ours. Defaults to None.
+
+        Returns:
+            int: The context window.
+        """
+
+        num_ctx = options.get("num_ctx") if isinstance(options, dict) else None
+
+        return snap_num_ctx(num_ctx or self.num_ctx, self.num_ctx_buckets)
+
+
+    def context_messages(self, options: dict = None) -> tuple[list, int]:
+        """Pick the messages to send to the model, so that they fit its context window. See src/lib/context.py.
+
+        Args:
+            options (dict, optional): The model options of the completion, if they're not ours (for "num_ctx" and
+            "num_predict"). Defaults to None.
+
+        Returns:
+            tuple[list, int]: The messages (don't change the list; it may be the conversation itself), and how many were left out.
         """
 
-        path_used = ""
+        num_ctx = self.context_size(options)
+        options = options if isinstance(options, dict) else {}
+        budget = context_budget(num_ctx, options.get("num_predict"))
+
+        messages, left_out = select_context(
+            self._conversation, self.token_count, budget, len(self.reset_point), self.context_policy
+        )
+
+        if left_out:
+            self.logger.debug(f"Left {left_out} of {len(self._conversation)} message(s) of '{self.conversation_id}' out "
+                              f"of the prompt, to fit a budget of {budget} tokens ({self.context_policy}).")
+
+        return messages, left_out
+
+
+    def _is_lazy(self) -> bool:
+        return isinstance(self._conversation, (LazyConversation, SharedConversation)) and self._conversation.items is None
+
+
+    def share_messages(self, length: int) -> SharedConversation:
+        """Share the first messages of the conversation with a fork, without copying them. See src/lib/forks.py.
+        Our own messages are frozen from then on; the conversation itself becomes a view of them, and only copies them
+        if one of them changes. `message_bytes` still counts them; the fork only counts what it adds.
+
+        Args:
+            length (int): How many messages to share. At most the length of the conversation.
+
+        Returns:
+            SharedConversation: The messages of the fork.
+        """
 
+        if isinstance(self._conversation, SharedConversation):
+            shared = self._conversation.fork(length)
+
+            if shared is not None: # Already frozen; no need to freeze anything again.
+                return shared
+
+        frozen = self._conversation
+        self._conversation = SharedConversation(frozen, len(frozen)) # Same messages, so the version stays.
+
+        return SharedConversation(frozen, length)
+
+
+    def _record(self, change: dict):
+        """Record a change to the journal, if there is one, compacting it when it's due.
+
+        Args:
+            change (dict): The change. See `src.lib.journal.apply_change`. None to snapshot the whole conversation instead.
+        """
+
+        if self.journal is None:
+            return
 
         try:
-            path_used = request.path.removeprefix("/memory/")
+            if change is None or self.journal.record(change):
+                # A shallow copy is enough; messages are replaced, never changed in place.
+                self.journal.schedule_compaction(self._conversation.copy())
+
+        except OSError:
+            # The change itself went through; only its persistence didn't. Not worth failing the request over.
+            self.logger.error(f"Failed to journal a change to '{self.conversation_id}'.")
+            self.logger.debug(traceback.format_exc())
+
+
+    def touch(self, first_changed: int = 0):
+        """Note that the conversation changed.
+
+        Args:
+            first_changed (int, optional): The index of the first message that changed. Defaults to 0 (possibly all of them).
+        """
+
+        self.version += 1
+        self._serialized = None
+        self.changes.append((self.version, first_changed))
 
-        except: # pylint: disable=bare-except
-            self.logger.warning("Failed to obtain the path for a memory update; Could cause issues.")
 
-        json_data = None
+    def first_changed_since(self, version: int) -> int:
+        """Find out which part of the conversation changed after a version.
+
+        Args:
+            version (int): The version the client has.
+
+        Returns:
+            int: The index of the first message that changed; the length of the conversation if nothing did.
+            0 if the version is too old (or not one of ours) to tell.
+        """
+
+        if version == self.version:
+            return len(self._conversation)
+
+        if version > self.version or not self.changes or self.changes[0][0] > version + 1:
+            return 0
+
+        return min((index for changed, index in self.changes if changed > version), default=len(self._conversation))
+
+
+    @property
+    def etag(self) -> str:
+        """The ETag of the current version of the conversation."""
+
+        return f"\"{self.version_epoch}-{self.version}\""
+
+
+    def append_message(self, message: dict):
+        """Append a message to the conversation.
+
+        Args:
+            message (dict): The message. Not validated; let them shoot themself in the foot if they get the format wrong.
+        """
+
+        message = Message.from_wire(message)
+        was_lazy = self._is_lazy()
+        self._conversation.append(message)
+        self._resized(was_lazy, message_size(message), message_tokens(message))
+        self.touch(len(self._conversation) - 1)
+        self._record({"op": "append", "message": message})
+
+
+    def set_message(self, index: int, message: dict):
+        """Replace a message of the conversation.
+
+        Args:
+            index (int): The index of the message.
+            message (dict): The new message.
+        """
+
+        message = Message.from_wire(message)
+        index = range(len(self._conversation))[index] # Negative indices count from the end; out of range ones raise.
+        was_lazy = self._is_lazy()
+        old = self._conversation[index]
+        self._conversation[index] = message
+        self._resized(was_lazy, message_size(message) - message_size(old), message_tokens(message) - message_tokens(old))
+        self.touch(index)
+        self._record({"op": "set", "index": index, "message": message})
+
+
+    def delete_message(self, index: int):
+        """Delete a message from the conversation.
+
+        Args:
+            index (int): The index of the message.
+        """
+
+        index = range(len(self._conversation))[index]
+        was_lazy = self._is_lazy()
+        old = self._conversation[index]
+        del self._conversation[index]
+        self._resized(was_lazy, -message_size(old), -message_tokens(old))
+        self.touch(index)
+        self._record({"op": "delete", "index": index})
+
+
+    def reset_conversation(self):
+        """Reset the conversation back to its startout. Every kind of reset (GET /reset, batches...) goes through here."""
+
+        self.conversation = self.update_reset_point()
+
+        if self.models is not None: # It's not using any context window until its next completion.
+            self.models.forget(self.conversation_id)
+
+
+    def overwrite_messages(self, index: int, messages: list[dict]):
+        """Overwrite consecutive messages of the conversation.
+
+        Args:
+            index (int): The index of the first message to overwrite.
+            messages (list[dict]): The new messages.
+
+        Raises:
+            IndexError: If the conversation isn't long enough. Nothing is overwritten then.
+        """
+
+        if not 0 <= index <= index + len(messages) <= len(self._conversation):
+            raise IndexError("Conversation is too short to overwrite those messages.")
+
+        messages = to_messages(messages)
+        was_lazy = self._is_lazy()
+        old = self._conversation[index:index + len(messages)]
+        self._conversation[index:index + len(messages)] = messages
+        self._resized(was_lazy, conversation_size(messages) - conversation_size(old),
+                      conversation_tokens(messages) - conversation_tokens(old))
+        self.touch(index)
+        self._record({"op": "overwrite", "index": index, "messages": messages})
+
+
+    def send_conversation(self, request):
+        """Send the conversation, with its ETag. It's only serialized once per version.
+
+        Args:
+            request: The request.
+        """
+
+        if self._serialized is None or self._serialized[0] != self.version:
+            self._serialized = (self.version, dumps(self._conversation) + b"\n")
+
+        request.send_bytes(self._serialized[1], headers={"ETag": self.etag})
+
+
+    def _parse_version(self, value: str) -> int:
+        """Parse the version a client has, either as one of our ETags or as a bare version number.
+
+        Args:
+            value (str): The value.
+
+        Returns:
+            int: The version, or -1 if it's an ETag from another run.
+
+        Raises:
+            ValueError: If it's neither.
+        """
+
+        value = value.strip().removeprefix("W/").strip("\"")
+        epoch, _, version = value.rpartition("-")
+
+        if epoch and epoch != self.version_epoch:
+            return -1
+
+        return int(version)
+
+
+    def send_range(self, request):
+        """Send part of the conversation, as asked for by the query string:
+
+        >>> ?since_version=<ETag or version> # Everything from the first message that changed after that version.
+        >>> ?since=<index>                   # Everything from that index on.
+        >>> ?last=<count>                    # The last few messages.
+        >>> ?start=<index>&end=<index>       # A slice. Negative indices count from the end, like in Python.
+
+        Only the part that's sent is serialized. The X-Memory-Start and X-Memory-Total headers tell where it starts and how long
+        the whole conversation is; the ETag is the current version, to pass as `since_version` next time.
+
+        Args:
+            request: The request.
+        """
+
+        query = request.query
+        total = len(self._conversation)
 
         try:
-            json_data = json.loads(request.rfile.read(int(request.headers["Content-Length"])).decode("utf-8"))
+            if "since_version" in query:
+                start, end = self.first_changed_since(self._parse_version(query["since_version"])), total
 
-        except ValueError:
-            # 411, content length required
-            request.send_response(411)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(json.dumps({"error": "Content length is required."}).encode("utf-8") + b"\n")
+            elif "since" in query:
+                start, end = min(max(int(query["since"]), 0), total), total
+
+            elif "last" in query:
+                start, end = max(total - max(int(query["last"]), 0), 0), total
+
+            else:
+                start, end, _ = slice(
+                    int(query["start"]) if query.get("start") else None,
+                    int(query["end"]) if query.get("end") else None,
+                ).indices(total)
+                end = max(start, end)
 
+        except ValueError:
+            request.send_error_json(400, "Invalid range.")
             return
 
-        except: # pylint: disable=bare-except
-            pass
+        request.send_bytes(dumps(self._conversation[start:end]) + b"\n", headers={
+            "ETag": self.etag,
+            "X-Memory-Start": str(start),
+            "X-Memory-Total": str(total),
+        })
 
 
+    def precondition_failed(self, request) -> bool:
+        """Check the If-Match header of a request that changes the conversation, answering with a 412 if it doesn't match.
+
+        Args:
+            request: The request.
+
+        Returns:
+            bool: Whether the request was answered (and must not go through).
+        """
+
+        if_match = request.headers.get("If-Match")
+
+        if if_match is None or etag_matches(if_match, self.etag):
+            return False
+
+        self.logger.info(f"Refused a change to \'{self.conversation_id}\': it changed in the meantime.")
+        request.send_error_json(412, "Conversation changed since it was last read.", headers={"ETag": self.etag})
+
+        return True
+
+
+
+
+
+                            # In this case, json_data probably isn't going to be used in a way that could be dangerous.
+    def memory_update(self, # pylint: disable=dangerous-default-value
+                      request,
+                      #action: Literal["GET", "POST", "PUT", "DELETE", "PATCH"],
+                      ):#json_data: dict = {}):
+        """Update the memory of the AI provider/conversation.
+
+        Args:
+            action (Literal["GET", "POST", "PUT", "DELETE", "PATCH"]): The action to perform.
+            json_data (dict, optional): JSON data to use if applicable. Defaults to {}.
+        """
+
+        index = request.params.get("index") # Only present for /memory/<conv>/<index>.
+
+        if request.command != "GET" and self.precondition_failed(request):
+            return
+
+        # Bodies are read by the cases that need them; bad ones are answered by the server (see `BodyError`).
         match request.command:
 
             case "GET": # Return the current conversation.
 
-                request.send_response(200)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(json.dumps(self.conversation).encode("utf-8") + b"\n")
+                if etag_matches(request.headers.get("If-None-Match"), self.etag):
+                    request.send_empty(304, headers={"ETag": self.etag})
+                    return
+
+                if any(parameter in request.query for parameter in RANGE_PARAMETERS):
+                    self.send_range(request)
+                    return
+
+                self.send_conversation(request)
 
 
             case "POST": # Append to the current conversation.
 
                 # Let the user have absolute control over conversation. Let them shoot themself in the foot if they get the format wrong.
-                self.conversation.append(json_data)
-                request.send_response(200)
-                request.end_headers()
+                self.append_message(request.read_json())
+                request.send_empty(headers={"ETag": self.etag})
                 # No need to write anything now.
 
 
             case "PUT": # Use as the new conversation.
 
-                # Again, let them shoot themselves in the foot.
-                self.conversation = json_data
-                request.send_response(200)
-                request.end_headers()
+                # Again, let them shoot themselves in the foot. It does have to be a list, though.
+                # Parsed message by message straight off the connection, so we never hold the raw upload in memory.
+                # If the upload turns out to be bad halfway through, the old conversation is kept.
+                self.conversation = list(request.iter_json_array())
+                request.send_empty(headers={"ETag": self.etag})
                 # No need to write anything now.
 
 
             case "DELETE":
-                try:
-                    index = int(path_used.split("/")[-1])
-
-                    abs_index = abs(index)
-                    abs_index -= 1 if index < 0 else 0 # Balance it out; -1 is equivalent to 0 in reverse.
-
-                    if index > len(self.conversation):
-                        raise IndexError("Index out of range.")
-
-                except: # pylint: disable=bare-except
+                if index is None or not -len(self.conversation) <= index < len(self.conversation):
 
                     self.logger.error("DELETE request to memory did not have the proper parameters.")
-                    self.logger.debug(traceback.format_exc())
-                    request.send_response(400)
-                    request.send_header("Content-Type", "application/json")
-                    request.end_headers()
-                    request.wfile.write(
-                        json.dumps({"error": "Request did not have a valid index."}).encode("utf-8") + b"\n"
-                    )
-
-                del self.conversation[index]
-                request.send_response(200)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
+                    request.send_error_json(400, "Request did not have a valid index.")
+                    return
+
+                self.delete_message(index)
                 # I suppose we might as well send the updated conversation back.
-                request.wfile.write(json.dumps(self.conversation).encode("utf-8") + b"\n")
+                self.send_conversation(request)
 
 
             case "PATCH":
-                try:
-                    index = int(path_used.split("/")[-1])
-
-                    abs_index = abs(index)
-                    abs_index -= 1 if index < 0 else 0 # Balance it out; -1 is equivalent to 0 in reverse.
-
-                    if index > len(self.conversation):
-                        raise IndexError("Index out of range.")
-
-                except: # pylint: disable=bare-except
+                if index is None or not -len(self.conversation) <= index < len(self.conversation):
 
                     self.logger.error("PATCH request to memory did not have the proper parameters.")
-                    self.logger.debug(traceback.format_exc())
-                    request.send_response(400)
-                    request.send_header("Content-Type", "application/json")
-                    request.end_headers()
-                    request.wfile.write(
-                        json.dumps({"error": "Request did not have a valid index."}).encode("utf-8") + b"\n"
-                    )
+                    request.send_error_json(400, "Request did not have a valid index.")
+                    return
 
-                self.conversation[index] = json_data
-                request.send_response(200)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(json.dumps(self.conversation).encode("utf-8") + b"\n")
+                self.set_message(index, request.read_json())
+                self.send_conversation(request)
 
 
             case _:
-                request.send_response(400)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Invalid request. How did you get this error?"}).encode("utf-8") + b"\n"
-                )
+                request.send_error_json(400, "Invalid request. How did you get this error?")
 
         self.logger.debug("Memory updated.")
 
@@ -269,40 +721,33 @@ class BaseAIProvider:
         Args:
             request: The request."""
 
-        try:
-            path_used = request.path.removeprefix("/save/")
+        path_used = request.params.get("file")
 
-        except: # pylint: disable=bare-except
+        if not path_used:
             self.logger.error("Memory saving request did not have a path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Request did not have a valid path/file name."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Request did not have a valid path/file name.")
             return
 
         # Save the file to memory_dir/filename.
 
         try:
-            with open(os.path.join(self.memory_dir, path_used), "w", encoding="utf-8") as f:
-                f.write(json.dumps(self.conversation, indent=4))
+            file_path = os.path.join(self.memory_dir, path_used)
+
+            if file_path.endswith(MEMORY_FILE_SUFFIX): # Compact binary format; see src/lib/memfile.py.
+                write_memory_file(file_path, self.conversation)
+
+            else:
+                with open(file_path, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(wire_messages(self.conversation), indent=4))
 
         except: # pylint: disable=bare-except
             self.logger.error("Failed to save memory to disk.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to save memory to disk."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(500, "Failed to save memory to disk.")
             return
 
         self.logger.info("Memory saved.")
-        request.send_response(200)
-        request.end_headers()
+        request.send_empty()
 
 
 
@@ -314,18 +759,11 @@ class BaseAIProvider:
         Args:
             request: The request."""
 
-        try:
-            path_used = request.path.removeprefix("/load/")
+        path_used = request.params.get("file")
 
-        except: # pylint: disable=bare-except
+        if not path_used:
             self.logger.error("Memory loading request did not have a path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Request did not have a valid path/file name."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Request did not have a valid path/file name.")
             return
 
         # SANITY CHECKS: Does path even exist?
@@ -333,45 +771,36 @@ class BaseAIProvider:
 
         if not os.path.exists(file_path):
             self.logger.error("Failed to load memory from disk: File does not exist.")
-            request.send_response(404)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "File does not exist."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(404, "File does not exist.")
             return
 
         # Is it a file?
         if not os.path.isfile(file_path):
             self.logger.error("Failed to load memory from disk: Path is not a file.")
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Path is not a file."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Path is not a file.")
             return
 
         # Cool, go ahead then.
 
+        if self.precondition_failed(request):
+            return
+
         try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                self.conversation = json.load(f)
+            if is_memory_file(file_path): # Only the index is read; messages are decoded when they're needed.
+                self.conversation = LazyConversation(MemoryFile(file_path))
+
+            else:
+                with open(file_path, "r", encoding="utf-8") as f:
+                    self.conversation = json.load(f)
 
         except: # pylint: disable=bare-except
             self.logger.error("Failed to load memory from disk.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to load memory from disk."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(500, "Failed to load memory from disk.")
             return
 
         self.logger.info("Memory loaded from disk.")
-        request.send_response(200)
-        request.end_headers()
+        request.send_empty(headers={"ETag": self.etag})
 
 
 
@@ -383,10 +812,12 @@ class BaseAIProvider:
         Args:
             request: The request."""
 
+        if self.precondition_failed(request):
+            return
+
         self.logger.info("Memory reset.")
-        self.conversation = self.update_reset_point()
-        request.send_response(200)
-        request.end_headers()
+        self.reset_conversation()
+        request.send_empty(headers={"ETag": self.etag})
 
 
 
@@ -399,18 +830,11 @@ class BaseAIProvider:
             request: The request.
         """
 
-        try:
-            path_used = request.path.removeprefix("/search_set_startout/")
+        path_used = request.params.get("startout")
 
-        except: # pylint: disable=bare-except
+        if not path_used:
             self.logger.error("Startout search didn't have a valid path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Request was invalid."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Request was invalid.")
             return
 
         method = request.command
@@ -427,29 +851,22 @@ class BaseAIProvider:
 
         if not new_startout:
             self.logger.error(f"Failed to find startout \'{path_used}\'.")
-            request.send_response(404)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": f"Failed to find startout \'{path_used}\'."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(404, f"Failed to find startout \'{path_used}\'.")
             return
 
 
+        if method == "POST" and self.precondition_failed(request):
+            return
+
         self.reset_point = new_startout
 
         if method == "POST":
-            fixed_startout = self.update_reset_point()
-
-            for i in range(len(fixed_startout)): # pylint: disable=consider-using-enumerate # why would you use enumerate
-                self.conversation[i] = fixed_startout[i] # Overwrite the start of the conversation with the new startout.
+            # Overwrite the start of the conversation with the new startout.
+            self.overwrite_messages(0, self.update_reset_point())
 
         self.logger.info(f"Changed startout to \'{path_used}\'.")
 
-        request.send_response(200)
-        request.send_header("Content-Type", "application/json")
-        request.end_headers()
-        request.wfile.write(json.dumps(self.conversation).encode("utf-8") + b"\n")
+        self.send_conversation(request)
 
 
 
@@ -462,17 +879,11 @@ class BaseAIProvider:
             request: The request.
         """
 
-        try:
-            path_used = request.path.removeprefix("/change_startout_configuration/")
+        path_used = request.params.get("configuration")
 
-        except: # pylint: disable=bare-except
+        if path_used is None:
             self.logger.error("Startout search didn't have a valid path.")
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Request was invalid."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Request was invalid.")
             return
 
 
@@ -484,19 +895,11 @@ class BaseAIProvider:
         except: # pylint: disable=bare-except
             self.logger.error("Failed to change startout configuration.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to change startout configuration. Was the configuration an integer?"}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Failed to change startout configuration. Was the configuration an integer?")
             return
 
 
-        request.send_response(200)
-        request.send_header("Content-Type", "application/json")
-        request.end_headers()
-        request.wfile.write(json.dumps(self.conversation).encode("utf-8") + b"\n")
+        self.send_conversation(request)
 
         self.logger.info(f"Changed startout configuration to {self.startout_configuration}.")
 
@@ -527,6 +930,56 @@ class BaseAIProvider:
         """
 
 
+    @abstractmethod
+    async def acompletion(self, model: str, configuration: dict): # pylint: disable=unused-argument # Abstract.
+        """Generate a completion from the AI, asynchronously. Used by the asyncio backend.
+
+        Args:
+            configuration (dict): The configuration to pass to the AI chat.
+        """
+
+
+    @abstractmethod
+    def iter_completion(self, data: dict): # pylint: disable=unused-argument # Abstract.
+        """Generate a completion outside of any web-request, yielding chunks as they come in. Used by WebSocket sessions.
+
+        Args:
+            data (dict): The same body as a completion request.
+
+        Yields:
+            dict: The chunks, as they would be sent to a client.
+        """
+
+
+    @staticmethod
+    def load_model(model: str, keep_alive, num_ctx: int = DEFAULT_NUM_CTX): # pylint: disable=unused-argument # Abstract.
+        """Load a model into the backend without generating anything, and set how long it's kept there. Used by the
+        `ModelKeeper` (src/lib/models.py) to warm models up and pin them. Blocks until the model is loaded.
+
+        Args:
+            model (str): The model.
+            keep_alive: How long the backend keeps the model around once it's unused. See `parse_keep_alive`.
+            num_ctx (int, optional): The context window to load it with. Loading it with a different one than completions
+            use only makes the backend load it again. Defaults to 4096.
+        """
+
+        raise NotImplementedError
+
+
+    async def acompletion_request(self, request):
+        """Request a completion from the AI with a web-request, asynchronously. Used by the asyncio backend.
+
+        Providers without a native async implementation fall back to `completion_request`, which works, but blocks the
+        event loop for the whole generation. Override this.
+
+        Args:
+            request (AsyncHollowRequest): The request.
+        """
+
+        self.logger.warning(f"{type(self).__name__} has no async completion; blocking the event loop.")
+        self.completion_request(request)
+
+
 
 
 
@@ -536,18 +989,11 @@ class BaseAIProvider:
         Args:
             request: The request."""
 
-        try:
-            path_used = request.path.removeprefix("/save-persona/")
+        path_used = request.params.get("file")
 
-        except: # pylint: disable=bare-except
+        if not path_used:
             self.logger.error("Persona saving request did not have a path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Request did not have a valid path/file name."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Request did not have a valid path/file name.")
             return
 
         # Save the file to memory_dir/filename.
@@ -577,17 +1023,11 @@ class BaseAIProvider:
         except: # pylint: disable=bare-except
             self.logger.error("Failed to save memory to disk.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to save memory to disk."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(500, "Failed to save memory to disk.")
             return
 
         self.logger.info("Memory saved.")
-        request.send_response(200)
-        request.end_headers()
+        request.send_empty()
 
 
 
@@ -599,18 +1039,11 @@ class BaseAIProvider:
         Args:
             request: The request."""
 
-        try:
-            path_used = request.path.removeprefix("/load-persona/")
+        path_used = request.params.get("file")
 
-        except: # pylint: disable=bare-except
+        if not path_used:
             self.logger.error("Persona loading request did not have a path.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Request did not have a valid path/file name."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Request did not have a valid path/file name.")
             return
 
         # SANITY CHECKS: Does path even exist?
@@ -618,23 +1051,13 @@ class BaseAIProvider:
 
         if not os.path.exists(file_path):
             self.logger.error("Failed to load persona from disk: File does not exist.")
-            request.send_response(404)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "File does not exist."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(404, "File does not exist.")
             return
 
         # Is it a file?
         if not os.path.isfile(file_path):
             self.logger.error("Failed to load persona from disk: Path is not a file.")
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Path is not a file."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(400, "Path is not a file.")
             return
 
         # Cool, go ahead then.
@@ -646,17 +1069,11 @@ class BaseAIProvider:
         except: # pylint: disable=bare-except
             self.logger.error("Failed to load memory from disk.")
             self.logger.debug(traceback.format_exc())
-            request.send_response(500)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to load memory from disk."}).encode("utf-8") + b"\n"
-            )
+            request.send_error_json(500, "Failed to load memory from disk.")
             return
 
         self.logger.info("Memory loaded from disk.")
-        request.send_response(200)
-        request.end_headers()
+        request.send_empty()
 
 
 
@@ -670,54 +1087,53 @@ class BaseAIProvider:
 
         # POST only
 
-        val = None
-
         try:
-            val = json.loads(request.rfile.read(int(request.headers["Content-Length"])).decode("utf-8"))
+            self.update_defaults(request.read_json())
 
-        except ValueError:
-            # 411, content length required
-            request.send_response(411)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Content length required."}).encode("utf-8") + b"\n"
-            )
+        except ValueError as error:
+            request.send_error_json(400, str(error))
             return
 
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to set default.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Bad request."}).encode("utf-8") + b"\n"
-            )
-            return
+        request.send_empty()
+
+
+
+
+
+    def update_defaults(self, values: dict):
+        """Change the configuration of the conversation: the model, its options, the context policy...
+
+        Args:
+            values (dict): The new values, by name. See `DEFAULT_KEYS`.
 
-        if not isinstance(val, dict):
+        Raises:
+            ValueError: If it's not a dict, or has anything in it that can't be changed. Nothing is changed then.
+        """
+
+        if not isinstance(values, dict):
             self.logger.error("Failed to set default: Not a dictionary.")
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Bad request."}).encode("utf-8") + b"\n"
-            )
-            return
+            raise ValueError("Bad request.")
 
-        for key in list(val.keys()):
-            if key not in ["model", "temperature", "top_p", "top_k", "repeat_penalty", "stop", "think", "num_ctx"]:
+        for key in values:
+            if key not in DEFAULT_KEYS:
                 self.logger.error("Set default request did not have a valid path.")
-                request.send_response(400)
-                request.send_header("Content-Type", "application/json")
-                request.end_headers()
-                request.wfile.write(
-                    json.dumps({"error": "Request did not have a valid path."}).encode("utf-8") + b"\n"
-                )
-                return
-
-        self.__dict__.update(val)
-
-        request.send_response(200)
-        request.end_headers()
+                raise ValueError("Request did not have a valid path.")
+
+        if "context_policy" in values and values["context_policy"] not in CONTEXT_POLICIES:
+            self.logger.error(f"Set default request had an unknown context policy: '{values['context_policy']}'.")
+            raise ValueError(f"Context policy must be one of {', '.join(CONTEXT_POLICIES)}.")
+
+        if "num_ctx" in values:
+            num_ctx = values["num_ctx"]
+
+            if not isinstance(num_ctx, int) or isinstance(num_ctx, bool) or num_ctx <= 0:
+                self.logger.error(f"Set default request had an invalid num_ctx: '{num_ctx}'.")
+                raise ValueError("num_ctx must be a positive integer.")
+
+            # Every other size would make the backend reload the model; see src/lib/context.py.
+            values = values | {"num_ctx": snap_num_ctx(num_ctx, self.num_ctx_buckets)}
+
+            if values["num_ctx"] != num_ctx:
+                self.logger.info(f"Snapped num_ctx {num_ctx} of '{self.conversation_id}' to {values['num_ctx']}.")
+
+        self.__dict__.update(values)
@@ -14,11 +14,10 @@
 # Imports: Built-in/Standard
 #import os                      # Used for path manipulation, among other things.
 #import sys                     # Provides important information about the operating system, interpreter, etc. Also handles path & exit.
-import json                    # Used to parse JSON files.
 #import logging                 # Used for logging.
 #from copy import deepcopy      # Used for deep copying objects.
 import traceback               # Used to get information about exceptions.
-from copy import deepcopy
+import asyncio                 # Used for the async variants.
 
 # Imports: Third-party
 #import pydantic # Used for data validation.
@@ -38,13 +37,39 @@ except ImportError:
 # Imports: Local/source
 
 #from src.lib.util.locateutils import locate_attribute # Utility functions for finding files, directories, things within lists, etc.
-from src.lib.providers.base import BaseAIProvider     # Base AI provider class.
+from src.lib.providers.base import BaseAIProvider, DEFAULT_NUM_CTX # Base AI provider class.
 from src.lib.util.colorclass import print # pylint: disable=redefined-builtin #FM
+from src.lib.httpio import StreamCoalescer, BodyError, flush_policy # Coalesced streaming and request bodies.
+from src.lib.util.fastjson import dumps, error_body                 # Response encoding.
+from src.lib.message import OutgoingMessages                        # What's sent of the conversation.
+from src.lib.completioncache import areplay, is_deterministic, payload_key, replay # Cached completions.
+
+
+
+# Globals
+_async_client: tuple[asyncio.AbstractEventLoop, ollama.AsyncClient] = (None, None) # pylint: disable=invalid-name
 
 
 
 # Functions
 
+def async_client() -> ollama.AsyncClient:
+    """Get the shared async Ollama client for the running event loop, creating it if needed.
+    The client's connection pool is tied to the loop it was first used on, so it is recreated if the loop changes."""
+
+    global _async_client # pylint: disable=global-statement
+
+    loop = asyncio.get_running_loop()
+
+    if _async_client[0] is not loop:
+        _async_client = (loop, ollama.AsyncClient())
+
+    return _async_client[1]
+
+
+
+
+
 def embed_text(text: str) -> np.ndarray:
     """Return a 1-D numpy array (float32) using Ollama's embedding endpoint."""
 
@@ -113,46 +138,61 @@ class OllamaAIProvider(BaseAIProvider):
 
 
 
-    def completion(self, model: str, configuration: dict, faiss_information: dict = None):
-        """Generate a completion from the AI.
+    def _faiss_context(self, faiss_information: dict) -> dict:
+        """Run the FAISS search described by the request, and build the ephemeral context message for it.
 
         Args:
-            configuration (dict): The configuration to pass to the AI chat.
+            faiss_information (dict): The "faiss_data" of the request. Results are written back into it.
+
+        Returns:
+            dict: The context message.
         """
 
-        # Let the caller do errors.
-        messages = deepcopy(configuration.pop("messages", self.conversation))
+        docs = faiss_information.get("data", ["a"])
 
-        if faiss_information is not None:
+        # do faiss stuffs
+        if getattr(self, "index", None) is None:
+            self.index = create_index(docs, # pylint: disable=attribute-defined-outside-init
+                                      faiss_information.get("faiss_type", "IndexFlatL2"))
+        else:
+            self.index.reset()
 
-            docs = faiss_information.get("data", ["a"])
 
-            # do faiss stuffs
-            if getattr(self, "index", None) is None:
-                self.index = create_index(docs, # pylint: disable=attribute-defined-outside-init
-                                          faiss_information.get("faiss_type", "IndexFlatL2"))
-            else:
-                self.index.reset()
+        self.index.add(np.vstack([embed_text(d) for d in docs])) # pylint: disable=no-value-for-parameter
 
+        # search...
 
-            self.index.add(np.vstack([embed_text(d) for d in docs])) # pylint: disable=no-value-for-parameter
+        query = faiss_information.get("query", "a")
+        k = faiss_information.get("k", 5)
 
-            # search...
+        faiss_information["results"] = retrieve(docs, query, self.index, k)
 
-            query = faiss_information.get("query", "a")
-            k = faiss_information.get("k", 5)
+        return {
+            "role": "system",
+            "content": f"Context...\n{"\n\n".join(faiss_information['results'])}",
+        }
 
-            faiss_information["results"] = retrieve(docs, query, self.index, k)
 
-            # insert right before the last index... but conveniently never saving it to the real conversation!
-            messages.insert(-1, {
-                "role": "system",
-                "content": f"Context...\n{"\n\n".join(faiss_information['results'])}",
-            })
 
 
+
+    def _chat_arguments(self, model: str, configuration: dict, messages: list) -> dict:
+        """Build the keyword arguments for `ollama.chat` out of a configuration and our defaults.
+
+        Args:
+            model (str): The model to use. Falls back to our default if empty.
+            configuration (dict): The configuration to pass to the AI chat. Consumed.
+            messages (list): The messages to send.
+
+        Returns:
+            dict: The arguments.
+        """
+
+        model = configuration.pop("model", model or self.model)
+        keep_alive = configuration.pop("keep_alive", None)
+
         passed_model_config = {
-            "model": configuration.pop("model", model or self.model),
+            "model": model,
             "messages": messages,
             "stream": configuration.pop("stream", True),
             "think": configuration.pop("think", self.think),
@@ -166,66 +206,213 @@ class OllamaAIProvider(BaseAIProvider):
             }), # Now I know: temperature can be set here and stuff I think.
         }
 
+        num_ctx = self.context_size(passed_model_config["options"])
+
+        if isinstance(passed_model_config["options"], dict):
+            # Always sent, snapped; leaving it out would have Ollama use its own default, and reload the model for it.
+            passed_model_config["options"] = passed_model_config["options"] | {"num_ctx": num_ctx}
+
+        if self.models is not None and keep_alive is None:
+            keep_alive = self.models.keep_alive(model)
+
+        if keep_alive is not None:
+            passed_model_config["keep_alive"] = keep_alive
+
         passed_model_config = passed_model_config | configuration
 
         self.logger.debug(f"\nParameters:\n{passed_model_config}\n")
 
-        return ollama.chat(**passed_model_config)
+        return passed_model_config
 
 
 
 
 
-    def completion_request(self, request):
-        """Request a completion from the AI with a web-request.
+    @staticmethod
+    def load_model(model: str, keep_alive, num_ctx: int = DEFAULT_NUM_CTX):
+        """Load a model into Ollama without generating anything (an empty prompt), and set how long it's kept there.
+
+        Args:
+            model (str): The model.
+            keep_alive: How long Ollama keeps the model around once it's unused.
+            num_ctx (int, optional): The context window to load it with. Defaults to 4096.
+        """
+
+        ollama.generate(model=model, prompt="", keep_alive=keep_alive, options={"num_ctx": num_ctx})
+
+
+
+
+
+    def _cache_key(self, arguments: dict, use_cache: bool = True) -> str:
+        """Get the key a completion is cached under, if it's cached at all: there's a completion cache, the completion is
+        deterministic (see src/lib/completioncache.py), and the caller didn't ask for a fresh one ("cache": false).
+
+        Args:
+            arguments (dict): The arguments for `ollama.chat`.
+            use_cache (bool, optional): Whether the caller allows a cached completion. Defaults to True.
+
+        Returns:
+            str: The key, or None if it isn't cached.
+        """
+
+        if self.completion_cache is None or use_cache is False or not arguments.get("stream") or not is_deterministic(arguments):
+            return None
+
+        return payload_key(arguments)
+
+
+
+
+
+    def _sending(self, arguments: dict):
+        """Note that a completion is actually being sent to Ollama (and not replayed), for the model keeper.
+
+        Args:
+            arguments (dict): The arguments for `ollama.chat`.
+        """
+
+        if self.models is not None:
+            options = arguments.get("options")
+            self.models.used(arguments["model"], options.get("num_ctx") if isinstance(options, dict) else None, self.conversation_id)
+
+
+
+
+
+    def _outgoing_messages(self, configuration: dict) -> OutgoingMessages:
+        """Get the messages to send to Ollama: the ones passed in the configuration, if any, or as much of the conversation
+        as fits the context window (see `context_messages`).
+
+        Args:
+            configuration (dict): The configuration to pass to the AI chat. "messages" is consumed.
+
+        Returns:
+            OutgoingMessages: A view of the messages. Insert into it all you like; what it's a view of is left alone.
+        """
+
+        messages = configuration.pop("messages", None)
+
+        if messages is None:
+            messages, _ = self.context_messages(configuration.get("options"))
+
+        return OutgoingMessages(messages)
+
+
+
+
+
+    def completion(self, model: str, configuration: dict, faiss_information: dict = None):
+        """Generate a completion from the AI.
+
+        Args:
+            configuration (dict): The configuration to pass to the AI chat.
+        """
+
+        # Let the caller do errors.
+        use_cache = configuration.pop("cache", True)
+        messages = self._outgoing_messages(configuration)
+
+        if faiss_information is not None:
+            # insert right before the last index... but conveniently never saving it to the real conversation!
+            messages.insert(-1, self._faiss_context(faiss_information))
+
+        arguments = self._chat_arguments(model, configuration, messages)
+        key = self._cache_key(arguments, use_cache)
+
+        if key is None:
+            self._sending(arguments)
+            return ollama.chat(**arguments)
+
+        cached = self.completion_cache.get(key)
+
+        if cached is not None:
+            self.logger.info(f"Replaying a cached completion ({key[:12]}).")
+            return replay(cached)
+
+        self._sending(arguments)
+
+        return self.completion_cache.record(key, ollama.chat(**arguments))
+
+
+
+
+
+    async def acompletion(self, model: str, configuration: dict, faiss_information: dict = None):
+        """Generate a completion from the AI, asynchronously, with Ollama's async client.
+
+        Args:
+            configuration (dict): The configuration to pass to the AI chat.
+        """
+
+        use_cache = configuration.pop("cache", True)
+        messages = self._outgoing_messages(configuration)
+
+        if faiss_information is not None:
+            # Embedding is done with the blocking client; keep it off of the event loop.
+            messages.insert(-1, await asyncio.to_thread(self._faiss_context, faiss_information))
+
+        arguments = self._chat_arguments(model, configuration, messages)
+        key = self._cache_key(arguments, use_cache)
+
+        if key is None:
+            self._sending(arguments)
+            return await async_client().chat(**arguments)
+
+        if self.completion_cache.directory: # The disk tier is kept off of the event loop as well.
+            cached = await asyncio.to_thread(self.completion_cache.get, key)
+
+        else:
+            cached = self.completion_cache.get(key)
+
+        if cached is not None:
+            self.logger.info(f"Replaying a cached completion ({key[:12]}).")
+            return areplay(cached)
+
+        self._sending(arguments)
+
+        return self.completion_cache.arecord(key, await async_client().chat(**arguments))
+
+
+
+
+
+    def _read_completion_request(self, request) -> dict:
+        """Read and parse the body of a completion request.
 
         Args:
             request: The request.
+
+        Returns:
+            dict: The body.
+
+        Raises:
+            BodyError: If the body is missing, too large, or not a JSON object. The server answers the request.
         """
 
-        # Must be a POST now.
-        try:
-            # read based on conlen
-            data = request.rfile.read(int(request.headers["Content-Length"])).decode("utf-8")
-
-        except KeyError:
-            self.logger.error("Failed to read request (no Content-Length).")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(411)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Content length is required."}).encode("utf-8") + b"\n"
-            )
-            return
+        data = request.read_json()
+
+        if not isinstance(data, dict):
+            raise BodyError(400, "Failed to parse request, not a JSON object.")
+
+        return data
 
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to read request.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to read request."}).encode("utf-8") + b"\n"
-            )
-            return
 
 
-        try:
-            data: dict = json.loads(data)
-
-        except: # pylint: disable=bare-except
-            self.logger.error("Failed to parse request.")
-            self.logger.debug(traceback.format_exc())
-            request.send_response(400)
-            request.send_header("Content-Type", "application/json")
-            request.end_headers()
-            request.wfile.write(
-                json.dumps({"error": "Failed to parse request, not JSON."}).encode("utf-8") + b"\n"
-            )
-            return
+
+
+    def _prepare_completion(self, data: dict) -> tuple[dict, bool, dict, dict]:
+        """Split a completion request's body into what goes to Ollama and what's for us.
+
+        Args:
+            data (dict): The body. Consumed.
+
+        Returns:
+            tuple[dict, bool, dict, dict]: (data, do_streaming, tools_provided, faiss_data)
+        """
 
         do_streaming = data.pop("stream", False)
+        data.pop("stream_flush", None) # Only means something to Hollowserver.
         tools = data.pop("tools", []) # Tools that are currently available to the AI.
 
 
@@ -258,130 +445,285 @@ class OllamaAIProvider(BaseAIProvider):
         # We will always internally stream the response, but it's up to the user if they want Hollowserver itself to stream it.
         data["stream"] = True
 
-        result = []
-        _count = 1
-        sent_headers_so_fuck_off = False
+        return data, do_streaming, tools_provided, faiss_data
+
+
+
+
+
+    def _process_chunk(self, chunk, tools_provided: dict) -> dict:
+        """Turn a chunk from Ollama into what we send to the client, running any tools it called.
+
+        Args:
+            chunk (ollama.ChatResponse): The chunk.
+            tools_provided (dict): The tools the AI is allowed to use, by name.
+
+        Returns:
+            dict: The chunk to send.
+        """
+
+        chunk_message = chunk.message
+
+        chunk_content = getattr(chunk_message, "content", None)
+        chunk_tools = getattr(chunk_message, "tool_calls", None)
+        chunk_thinking = getattr(chunk_message, "thinking", None)
+
+        #if chunk_tools:
+        #    used_tools += chunk_tools
+
+        #print(do_streaming, chunk_content, chunk_tools)
+
+        send_json = {
+            "content": chunk_content,
+            "tool_calls": [tool.function.name for tool in chunk_tools] if chunk_tools else [],
+            "thinking": chunk_thinking
+        }
+
+        tool_responses = {}
+
+        if chunk_tools:
+            for tool in chunk_tools:
+                tool_fn = tool.function
+                self.logger.info(f"Tool used: {tool_fn.name}")
+
+                try:
+                    tool_responses[tool_fn.name] = \
+                        f"{tool_fn.name} returned:\n{tools_provided.get(tool_fn.name)(**tool_fn.arguments)}"
+
+                except AttributeError:
+                    tool_responses[tool_fn.name] = f"invalid tool: {tool_fn.name}"
+
+                except: # pylint: disable=bare-except
+                    tool_responses[tool_fn.name] = f"{tool_fn.name} errored during execution:\n{traceback.format_exc()}"
+
+                # NOTE: better way to do this???
+
+        if tool_responses:
+            send_json["tool_responses"] = tool_responses
+            #print(send_json)
+
+        print(send_json["content"] or send_json["thinking"] or "", end="", flush=True, reset_color=False)
+
+        return send_json
+
+
+
+
+
+    def iter_completion(self, data: dict):
+        """Generate a completion outside of any web-request, yielding chunks as they come in.
+        Failed attempts are retried, as long as nothing was yielded yet.
+
+        Args:
+            data (dict): The same body as a completion request. Consumed.
+
+        Yields:
+            dict: The chunks, as they would be sent to a client.
+
+        Raises:
+            RuntimeError: If generation failed.
+        """
+
+        data, _, tools_provided, faiss_data = self._prepare_completion(data)
 
         self.logger.info("Generating response...")
         #self.logger.debug(f"\nParameters:\n{data}\n")
 
-        while _count < 5:
+        for _count in range(1, 5):
             self.logger.debug(f"Attempt {_count}.")
 
+            started = False
+
             try:
-                #if do_streaming:
-                #print(f"{FM.debug} ", end="", flush=True, reset_color=False)
-                #print("here")
-                completion: ollama.ChatResponse = self.completion("", data,
+                completion: ollama.ChatResponse = self.completion("", dict(data),
                                                                   faiss_information=faiss_data)
-                #print("there")
 
                 if not completion:
                     self.logger.error("Blank result.")
-                    _count += 1
                     continue
 
-                #print("everywhere")
+                for chunk in completion:
+                    started = True
+                    yield self._process_chunk(chunk, tools_provided)
 
-                #used_tools = []
+                print() # Add extra newline and reset colors.
+                return
 
-                for chunk in completion:
+            except RuntimeError:
+                if started: # Can't take back what was already yielded.
+                    raise
 
-                    #print('nowhere', chunk)
+        raise RuntimeError("Failed to generate response.")
 
-                    chunk_message = chunk.message
 
-                    chunk_content = getattr(chunk_message, "content", None)
-                    chunk_tools = getattr(chunk_message, "tool_calls", None)
-                    chunk_thinking = getattr(chunk_message, "thinking", None)
 
-                    #if chunk_tools:
-                    #    used_tools += chunk_tools
 
-                    #print(do_streaming, chunk_content, chunk_tools)
 
-                    send_json = {
-                        "content": chunk_content,
-                        "tool_calls": [tool.function.name for tool in chunk_tools] if chunk_tools else [],
-                        "thinking": chunk_thinking
-                    }
+    async def aiter_completion(self, data: dict):
+        """The async counterpart of `iter_completion`.
 
-                    tool_responses = {}
+        Args:
+            data (dict): The same body as a completion request. Consumed.
 
-                    if chunk_tools:
-                        for tool in chunk_tools:
-                            tool_fn = tool.function
-                            self.logger.info(f"Tool used: {tool_fn.name}")
+        Yields:
+            dict: The chunks, as they would be sent to a client.
 
-                            try:
-                                tool_responses[tool_fn.name] = \
-                                    f"{tool_fn.name} returned:\n{tools_provided.get(tool_fn.name)(**tool_fn.arguments)}"
+        Raises:
+            RuntimeError: If generation failed.
+        """
 
-                            except AttributeError:
-                                tool_responses[tool_fn.name] = f"invalid tool: {tool_fn.name}"
+        data, _, tools_provided, faiss_data = self._prepare_completion(data)
 
-                            except: # pylint: disable=bare-except
-                                tool_responses[tool_fn.name] = f"{tool_fn.name} errored during execution:\n{traceback.format_exc()}"
+        self.logger.info("Generating response... (async)")
 
-                            # NOTE: better way to do this???
+        for _count in range(1, 5):
+            self.logger.debug(f"Attempt {_count}.")
 
-                    if tool_responses:
-                        send_json["tool_responses"] = tool_responses
-                        #print(send_json)
+            started = False
 
-                    result.append(send_json)
-                    print(send_json["content"] or send_json["thinking"] or "", end="", flush=True, reset_color=False)
+            try:
+                completion = await self.acompletion("", dict(data), faiss_information=faiss_data)
 
-                    if do_streaming:
+                if not completion:
+                    self.logger.error("Blank result.")
+                    continue
 
-                        # Send chunked.
-                        if _count <= 1 and not sent_headers_so_fuck_off: # for fucks sake...
-                            request.send_response(200)
-                            request.send_header("Content-Type", "application/json")
-                            request.send_header("Transfer-Encoding", "chunked")
-                            request.end_headers()
-                            sent_headers_so_fuck_off = True
+                async for chunk in completion:
+                    started = True
+                    yield self._process_chunk(chunk, tools_provided)
 
+                print() # Add extra newline and reset colors.
+                return
 
-                        #print(f"DBG!: {send_json}, {result}")
-                        encoded_send_json = json.dumps(send_json).encode("utf-8") + b"\n"
+            except RuntimeError:
+                if started:
+                    raise
 
-                        request.wfile.write(
-                            f"{len(encoded_send_json):x}\r\n".encode("utf-8")
-                        )
+        raise RuntimeError("Failed to generate response.")
 
-                        request.wfile.write(encoded_send_json + b"\r\n")
 
-                        request.wfile.flush()
 
-                print() # Add extra newline and reset colors.
 
-                if do_streaming:
-                    request.wfile.write(b"0\r\n\r\n") # EOF.
 
-                elif not sent_headers_so_fuck_off:
-                    request.send_response(200)
-                    request.send_header("Content-Type", "application/json")
-                    request.end_headers()
-                    request.wfile.write(json.dumps(result).encode("utf-8") + b"\n")
-                    sent_headers_so_fuck_off = True
-                    # oh this was already configured for not being a string
+    def _stream_writer(self, request, data: dict) -> StreamCoalescer:
+        """Make the writer for a streamed completion, honoring the client's "stream_flush" option.
 
-                self.logger.info("".join([c["content"] for c in result]))
+        Args:
+            request: The request.
+            data (dict): The body. "stream_flush" is removed from it.
 
-                return
+        Returns:
+            StreamCoalescer: The writer.
+        """
+
+        max_bytes, max_ms = flush_policy(
+            data.pop("stream_flush", None),
+            request.server.stream_flush_bytes,
+            request.server.stream_flush_ms,
+        )
 
-            except RuntimeError: # pylint: disable=bare-except
+        return StreamCoalescer(request, max_bytes, max_ms)
 
-                # better hope you have error handling if you're trying to stream it :)
-                _count += 1
 
-        # We're only going to break out of the loop in case of an error scenario. Send relevant headers and information.
 
-        request.send_response(500)
-        request.send_header("Content-Type", "application/json")
-        request.end_headers()
-        request.wfile.write(
-            json.dumps({"error": "Failed to generate response."}).encode("utf-8") + b"\n"
-        )
-        return
+
+
+    def _finish_completion(self, request, result: list[dict], writer: StreamCoalescer):
+        """Finish up a successful completion.
+
+        Args:
+            request: The request.
+            result (list[dict]): Every chunk that was generated.
+            writer (StreamCoalescer): The writer, if the client asked for streaming.
+        """
+
+        if writer:
+            writer.close() # EOF. Nothing generated at all still gets a proper (empty) stream.
+            self.logger.debug(f"Streamed {len(result)} chunks in {writer.writes + 1} writes.")
+
+        else:
+            request.send_json(result)
+            # oh this was already configured for not being a string
+
+        self.logger.info("".join([c["content"] or "" for c in result]))
+
+
+
+
+
+    def _fail_completion(self, request, writer: StreamCoalescer):
+        """Let the client know that we failed to generate anything.
+
+        Args:
+            request: The request.
+            writer (StreamCoalescer): The writer, if the client asked for streaming.
+        """
+
+        if writer and writer.started:
+            # The status line is long gone; end the stream with an error chunk so the connection stays usable.
+            writer.close(error_body("Failed to generate response."))
+            return
+
+        request.send_error_json(500, "Failed to generate response.")
+
+
+
+
+
+    def completion_request(self, request):
+        """Request a completion from the AI with a web-request.
+
+        Args:
+            request: The request.
+        """
+
+        data = self._read_completion_request(request)
+
+        # Whether Hollowserver itself should stream; see _prepare_completion.
+        writer = self._stream_writer(request, data) if data.get("stream", False) else None
+
+        result = []
+
+        try:
+            for send_json in self.iter_completion(data):
+                result.append(send_json)
+
+                if writer:
+                    writer.write(dumps(send_json) + b"\n")
+
+        except RuntimeError:
+            # We're only going to end up here in case of an error scenario. Send relevant headers and information.
+            self._fail_completion(request, writer)
+            return
+
+        self._finish_completion(request, result, writer)
+
+
+
+
+
+    async def acompletion_request(self, request):
+        """Request a completion from the AI with a web-request, on the asyncio backend.
+
+        Args:
+            request (AsyncHollowRequest): The request.
+        """
+
+        data = self._read_completion_request(request)
+
+        writer = self._stream_writer(request, data) if data.get("stream", False) else None
+
+        result = []
+
+        try:
+            async for send_json in self.aiter_completion(data):
+                result.append(send_json)
+
+                if writer and writer.write(dumps(send_json) + b"\n"):
+                    await request.drain()
+
+        except RuntimeError:
+            self._fail_completion(request, writer)
+            return
+
+        self._finish_completion(request, result, writer)
@@ -0,0 +1,291 @@
+# router.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Request routing for Hollowserver. Paths are compiled into a segment trie when they're registered, so dispatch doesn't
+have to look at every endpoint on every request."""
+
+# pylint: disable=too-few-public-methods
+
+
+
+# Imports: Built-in/Standard
+from urllib.parse import unquote, parse_qsl # Used to decode path segments and query strings.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+# ...
+
+
+
+# Constants
+
+# Converters for typed path parameters. `{name:path}` is special cased, as it swallows the rest of the path.
+CONVERTERS = {
+    "str": str,
+    "int": int,
+}
+
+
+
+# Functions
+
+def split_path(path: str) -> tuple[list[str], dict[str, str]]:
+    """Split a request path into decoded segments and a query dictionary. Empty segments are dropped.
+
+    Args:
+        path (str): The raw request path, including the query string if there is one.
+
+    Returns:
+        tuple[list[str], dict[str, str]]: The segments, then the query. Repeated query keys keep their last value.
+    """
+
+    path, _, query = path.partition("?")
+
+    if "%" in path:
+        segments = [unquote(segment) for segment in path.split("/") if segment]
+
+    else:
+        segments = [segment for segment in path.split("/") if segment]
+
+    return segments, dict(parse_qsl(query, keep_blank_values=True)) if query else {}
+
+
+
+
+
+def _parse_pattern(pattern: str) -> list[tuple[str, str, str]]:
+    """Parse a route pattern such as `/memory/{conv}/{index:int}` into its segments.
+
+    Args:
+        pattern (str): The pattern.
+
+    Returns:
+        list[tuple[str, str, str]]: A list of (kind, name/literal, converter) tuples. Kind is "literal" or "param".
+
+    Raises:
+        ValueError: If the pattern is malformed.
+    """
+
+    parsed = []
+    segments = [segment for segment in pattern.split("/") if segment]
+
+    for i, segment in enumerate(segments):
+
+        if segment.startswith("{") and segment.endswith("}"):
+            name, _, converter = segment[1:-1].partition(":")
+            converter = converter or "str"
+
+            if not name.isidentifier():
+                raise ValueError(f"Bad parameter name '{name}' in route '{pattern}'.")
+
+            if converter != "path" and converter not in CONVERTERS:
+                raise ValueError(f"Unknown converter '{converter}' in route '{pattern}'.")
+
+            if converter == "path" and i != len(segments) - 1:
+                raise ValueError(f"A path parameter must be the last segment of route '{pattern}'.")
+
+            parsed.append(("param", name, converter))
+
+        else:
+            parsed.append(("literal", segment, ""))
+
+    return parsed
+
+
+
+# Classes
+
+
+
+class RouteMatch:
+    """The result of a successful route lookup."""
+
+    __slots__ = ("callbacks", "params", "rest", "pattern")
+
+    def __init__(self, callbacks: list[callable], params: dict, rest: list[str], pattern: str):
+        self.callbacks = callbacks
+        self.params = params
+        self.rest = rest
+        self.pattern = pattern
+
+
+
+
+
+class _RouteNode:
+    """A single node of the segment trie."""
+
+    __slots__ = ("literals", "params", "path_param", "exact", "prefix", "exact_pattern", "prefix_pattern")
+
+    def __init__(self):
+        self.literals: dict[str, _RouteNode] = {}
+        self.params: list[tuple[str, callable, _RouteNode]] = [] # (name, converter, child)
+        self.path_param: tuple[str, _RouteNode] = None           # (name, child)
+        self.exact: list[callable] = []
+        self.prefix: list[callable] = []
+        self.exact_pattern = ""
+        self.prefix_pattern = ""
+
+
+
+
+
+class Router:
+    """A per-method router. Routes are patterns made up of literal segments and typed parameters:
+
+    >>> router.add("/memory/{conv}/{index:int}", callback)
+    >>> router.add("/save/{conv}/{file:path}", callback)
+
+    Matching is done per segment, so `/save` no longer catches `/save-persona`. Literal segments win over parameters,
+    and an exact match wins over a prefix match. Among prefix matches, the deepest one wins.
+    """
+
+    def __init__(self):
+        self.root = _RouteNode()
+        self.route_count = 0
+
+
+    def add(self, pattern: str, callback: callable, prefix: bool = False):
+        """Register a callback for a route pattern.
+
+        Args:
+            pattern (str): The pattern to register.
+            callback (callable): The callback. Multiple callbacks on the same pattern are all called, in order.
+            prefix (bool, optional): Whether the route should also match any path below it. Defaults to False.
+        """
+
+        node = self.root
+
+        for kind, name, converter in _parse_pattern(pattern):
+
+            if kind == "literal":
+                node = node.literals.setdefault(name, _RouteNode())
+
+            elif converter == "path":
+                if node.path_param is None:
+                    node.path_param = (name, _RouteNode())
+
+                node = node.path_param[1]
+
+            else:
+                for param_name, param_converter, child in node.params:
+                    if param_name == name and param_converter is CONVERTERS[converter]:
+                        node = child
+                        break
+
+                else:
+                    child = _RouteNode()
+                    node.params.append((name, CONVERTERS[converter], child))
+                    # Stricter converters first, so `{index:int}` gets a chance before `{name}`.
+                    node.params.sort(key=lambda param: param[1] is str)
+                    node = child
+
+        if prefix:
+            node.prefix.append(callback)
+            node.prefix_pattern = pattern
+
+        else:
+            node.exact.append(callback)
+            node.exact_pattern = pattern
+
+        self.route_count += 1
+
+
+    def match(self, segments: list[str]) -> RouteMatch:
+        """Find the best route for a list of path segments.
+
+        Args:
+            segments (list[str]): The decoded path segments, as returned by `split_path`.
+
+        Returns:
+            RouteMatch: The match, or None if nothing matched.
+        """
+
+        best = self._walk(self.root, segments, 0, {})
+
+        if best is None:
+            return None
+
+        node, params, depth, exact = best
+
+        if exact:
+            return RouteMatch(node.exact, params, [], node.exact_pattern)
+
+        return RouteMatch(node.prefix, params, segments[depth:], node.prefix_pattern)
+
+
+    def _walk(self, node: _RouteNode, segments: list[str], depth: int, params: dict):
+        """Depth-first search for the best match below a node. Literal children are tried before parameters.
+
+        Returns:
+            tuple | None: (node, params, depth, exact) of the best match found, or None.
+        """
+
+        best = None
+        segment_count = len(segments)
+
+        # Fast path: follow literal-only nodes without recursing.
+        while True:
+
+            if depth == segment_count:
+                if node.exact:
+                    return node, params, depth, True
+
+                return (node, params, depth, False) if node.prefix else best
+
+            if node.prefix:
+                best = (node, params, depth, False)
+
+            if node.params or node.path_param is not None:
+                break
+
+            node = node.literals.get(segments[depth])
+
+            if node is None:
+                return best
+
+            depth += 1
+
+        segment = segments[depth]
+
+        literal = node.literals.get(segment)
+
+        if literal is not None:
+            found = self._walk(literal, segments, depth + 1, params)
+
+            if found is not None:
+                if found[3]:
+                    return found
+
+                if best is None or found[2] > best[2]:
+                    best = found
+
+        for name, converter, child in node.params:
+            try:
+                value = converter(segment)
+
+            except ValueError:
+                continue
+
+            found = self._walk(child, segments, depth + 1, params | {name: value})
+
+            if found is not None:
+                if found[3]:
+                    return found
+
+                if best is None or found[2] > best[2]:
+                    best = found
+
+        if node.path_param is not None:
+            name, child = node.path_param
+
+            if child.exact or child.prefix:
+                return child, params | {name: "/".join(segments[depth:])}, segment_count, bool(child.exact)
+
+        return best
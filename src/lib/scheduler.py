@@ -0,0 +1,241 @@
+# scheduler.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Admission control for completions. There's usually a single Ollama backend behind every conversation, so only a few
+completions run at once, only so many may wait, and everything beyond that is turned away right away (429) with a
+Retry-After instead of timing out."""
+
+
+
+# Imports: Built-in/Standard
+import math      # Used to round Retry-After up.
+import time      # Used to time completions.
+import asyncio   # Used for the asyncio backend's slots.
+import threading # Used to guard the counters.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.util.concurrency import FifoSemaphore # Used for the threaded backends' slots.
+
+
+
+# Constants
+
+INITIAL_DURATION_GUESS = 5.0 # Seconds. What we assume a completion takes before we've timed any.
+DURATION_SMOOTHING = 0.2     # Weight of the newest completion in the running average.
+
+
+
+# Classes
+
+
+
+class SchedulerFull(Exception):
+    """Thrown when a completion can't even be queued."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+
+
+
+class CompletionTicket:
+    """A completion that was admitted. Wait for a slot with `with ticket:` (or `async with ticket:` on the asyncio
+    backend), once the conversation's lock is held. `release` must always be called, even if the completion never ran;
+    it may be called more than once."""
+
+    def __init__(self, scheduler: "CompletionScheduler", key: str):
+        self.scheduler = scheduler
+        self.key = key
+        self.started = 0.0
+        self.slot = None # Whichever semaphore we got our slot from.
+        self.running = False
+        self.released = False
+
+
+    def __enter__(self):
+        self.scheduler.slots.acquire()
+        self.slot = self.scheduler.slots
+        self.scheduler._started(self) # pylint: disable=protected-access
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+    async def __aenter__(self):
+        await self.scheduler.async_slots().acquire()
+        self.slot = self.scheduler.async_slots()
+        self.scheduler._started(self) # pylint: disable=protected-access
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+    def release(self):
+        """Give back the slot (if one was taken) and the spot in the queue."""
+
+        self.scheduler._finished(self) # pylint: disable=protected-access
+
+
+
+
+
+class CompletionScheduler:
+    """Keeps track of every admitted completion.
+
+    A completion is admitted if its conversation has fewer than `max_per_conversation` completions pending (queued or
+    running; they run one at a time anyway, as they hold the conversation's lock), and fewer than `max_active` +
+    `max_queued` completions are pending overall. At most `max_active` of them run at once, first come, first served.
+    """
+
+    def __init__(self, max_active: int = 4, max_queued: int = 32, max_per_conversation: int = 4):
+        """A completion scheduler.
+
+        Args:
+            max_active (int, optional): The maximum amount of completions running at once. Defaults to 4.
+            max_queued (int, optional): The maximum amount of completions waiting for a slot, overall. Defaults to 32.
+            max_per_conversation (int, optional): The maximum amount of pending completions per conversation. Defaults to 4.
+        """
+
+        self.max_active = max(1, max_active)
+        self.max_queued = max(0, max_queued)
+        self.max_per_conversation = max(1, max_per_conversation)
+
+        self.slots = FifoSemaphore(self.max_active)
+        self._async_slots: asyncio.Semaphore = None
+
+        self.lock = threading.Lock()
+        self.pending: dict[str, int] = {} # Conversation ID -> queued or running completions.
+        self.total_pending = 0
+        self.active = 0
+
+        self.admitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.average_duration = INITIAL_DURATION_GUESS
+
+
+    def async_slots(self) -> asyncio.Semaphore:
+        """The slots of the asyncio backend. Only one backend runs at a time, so it gets its own semaphore."""
+
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_active)
+
+        return self._async_slots
+
+
+    def _retry_after(self, ahead: int) -> int:
+        """Guess how long until there's room again.
+
+        Args:
+            ahead (int): How many completions have to finish first.
+
+        Returns:
+            int: Seconds, at least 1.
+        """
+
+        return max(1, math.ceil(self.average_duration * ahead / self.max_active))
+
+
+    def admit(self, key: str) -> CompletionTicket:
+        """Admit a completion, or turn it away.
+
+        Args:
+            key (str): The conversation ID.
+
+        Returns:
+            CompletionTicket: The ticket.
+
+        Raises:
+            SchedulerFull: If there's no room.
+        """
+
+        with self.lock:
+            pending = self.pending.get(key, 0)
+
+            if pending >= self.max_per_conversation:
+                self.rejected += 1
+                raise SchedulerFull(
+                    "Too many completions queued for this conversation.",
+                    # They run one after another, not max_active at a time.
+                    max(1, math.ceil(self.average_duration * pending))
+                )
+
+            if self.total_pending >= self.max_active + self.max_queued:
+                self.rejected += 1
+                raise SchedulerFull("Too many completions queued.", self._retry_after(self.total_pending - self.max_active + 1))
+
+            self.pending[key] = pending + 1
+            self.total_pending += 1
+            self.admitted += 1
+
+        return CompletionTicket(self, key)
+
+
+    def _started(self, ticket: CompletionTicket):
+        with self.lock:
+            self.active += 1
+
+        ticket.running = True
+        ticket.started = time.monotonic()
+
+
+    def _finished(self, ticket: CompletionTicket):
+        with self.lock:
+            if ticket.released:
+                return
+
+            ticket.released = True
+
+            self.total_pending -= 1
+            self.pending[ticket.key] -= 1
+
+            if not self.pending[ticket.key]:
+                del self.pending[ticket.key]
+
+            if ticket.running:
+                self.active -= 1
+                self.completed += 1
+                duration = time.monotonic() - ticket.started
+                self.average_duration += (duration - self.average_duration) * DURATION_SMOOTHING
+
+        if ticket.running:
+            ticket.running = False
+            ticket.slot.release()
+
+
+    def stats(self) -> dict:
+        """The live state of the scheduler.
+
+        Returns:
+            dict: Counters, limits and per-conversation queue depths.
+        """
+
+        with self.lock:
+            return {
+                "active": self.active,
+                "queued": self.total_pending - self.active,
+                "per_conversation": dict(self.pending),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "average_seconds": round(self.average_duration, 3),
+                "limits": {
+                    "max_active": self.max_active,
+                    "max_queued": self.max_queued,
+                    "max_per_conversation": self.max_per_conversation,
+                },
+            }
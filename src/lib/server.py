@@ -15,9 +15,14 @@
 #import http                # Used for the HTTP server.
 import http.server         # Used for the HTTP server.
 import logging             # Used for logging.
-import json                # Used to parse JSON files.
+import asyncio             # Used for the asyncio backend.
+import socket              # Used to wake up the idle connection watcher.
+import selectors           # Used to watch idle keep-alive connections.
+import threading           # Used for the idle connection watcher.
+import time                # Used to expire idle keep-alive connections.
 
 from typing import Literal # Used for type hints.
+from concurrent.futures import ThreadPoolExecutor # Used for the bounded worker pool.
 
 # Imports: Third-party
 # ...
@@ -25,6 +30,19 @@ from typing import Literal # Used for type hints.
 # Imports: Local/source
 from src.lib.util.colorclass import print, FM # pylint: disable=redefined-builtin
 from src.lib.firepanic import panic           # Error handling system.
+from src.lib.router import Router, split_path # Request routing.
+from src.lib.httpio import HollowRequestMixin, BodyError, flush_policy # HTTP/1.1 framing and request bodies.
+from src.lib.httpio import STREAM_FLUSH_BYTES, STREAM_FLUSH_MS, MAX_BODY_SIZE, MAX_HISTORY_SIZE
+from src.lib.compression import COMPRESSION_THRESHOLD
+from src.lib.websocket import WebSocket, accept_key # WebSocket upgrades.
+from src.lib.util.concurrency import KeyedLocks, Turn # Keeping requests in the order they came in.
+
+
+
+# Constants
+
+REQUEST_LINE_PEEK = 8192 # The most of a new request looked at to find its request line, and reserve its turn.
+DETACHED_JOIN_TIMEOUT = 5.0 # How long closing the server waits for each detached connection (session) to wind down.
 
 
 
@@ -37,6 +55,148 @@ class NoSuchConversation(Exception):
 
 
 
+class IdleConnections:
+    """Keep-alive connections between requests, all watched by a single thread instead of each occupying a worker.
+
+    A worker that is done with a request parks its connection here and moves on. Once the client sends its next request,
+    the connection is handed to `on_ready`; if it doesn't within the timeout, it's handed to `on_expired` to be closed.
+    New connections start out here as well, so a client that connects and says nothing doesn't hold a worker either.
+    """
+
+    def __init__(self, timeout: float, on_ready: callable, on_expired: callable):
+        """Start watching.
+
+        Args:
+            timeout (float): How long a connection may sit idle, in seconds.
+            on_ready (callable): Called with (connection, client address) once a connection can be read from.
+            on_expired (callable): Called with a connection that timed out, or is still parked once we're closed.
+        """
+
+        self.timeout = timeout
+        self.on_ready = on_ready
+        self.on_expired = on_expired
+
+        self.lock = threading.Lock()
+        self.incoming: list[tuple] = [] # (connection, client address), waiting for the watcher to pick them up.
+        self.closed = False
+
+        self.selector = selectors.DefaultSelector()
+        self.deadlines = {} # Connection -> when it expires. Only touched by the watcher.
+
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self.selector.register(self._wakeup, selectors.EVENT_READ)
+
+        self.thread = threading.Thread(target=self._watch, name="Hollowserver-Idle", daemon=True)
+        self.thread.start()
+
+
+    def park(self, connection, client_address):
+        """Watch a connection until it has a request for us.
+
+        Args:
+            connection: The connection's socket.
+            client_address: The address of the client.
+        """
+
+        with self.lock:
+            if not self.closed:
+                self.incoming.append((connection, client_address))
+                connection = None
+
+        if connection is not None:
+            self.on_expired(connection)
+            return
+
+        self._wake()
+
+
+    def _wake(self):
+        try:
+            self._waker.send(b"\0")
+
+        except OSError: # Its buffer is full, so the watcher is bound to wake up anyway.
+            pass
+
+
+    def _watch(self):
+        """Hand out connections as they become readable, and expire the ones that stay idle for too long."""
+
+        while True:
+            with self.lock:
+                if self.closed:
+                    break
+
+                incoming, self.incoming = self.incoming, []
+
+            now = time.monotonic()
+
+            for connection, client_address in incoming:
+                try:
+                    self.selector.register(connection, selectors.EVENT_READ, client_address)
+
+                except (ValueError, OSError): # Already closed.
+                    self.on_expired(connection)
+                    continue
+
+                self.deadlines[connection] = now + self.timeout
+
+            timeout = max(0.0, min(self.deadlines.values()) - now) if self.deadlines else None
+
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self._wakeup:
+                    try:
+                        while self._wakeup.recv(4096):
+                            pass
+
+                    except OSError:
+                        pass
+
+                    continue
+
+                self._forget(key.fileobj)
+                self.on_ready(key.fileobj, key.data)
+
+            now = time.monotonic()
+
+            for connection in [connection for connection, deadline in self.deadlines.items() if deadline <= now]:
+                self._forget(connection)
+                self.on_expired(connection)
+
+        for connection in list(self.deadlines):
+            self._forget(connection)
+            self.on_expired(connection)
+
+        with self.lock:
+            incoming, self.incoming = self.incoming, []
+
+        for connection, _ in incoming:
+            self.on_expired(connection)
+
+        self.selector.close()
+        self._wakeup.close()
+        self._waker.close()
+
+
+    def _forget(self, connection):
+        self.selector.unregister(connection)
+        del self.deadlines[connection]
+
+
+    def close(self):
+        """Stop watching, and close every connection that's still idle."""
+
+        with self.lock:
+            self.closed = True
+
+        self._wake()
+        self.thread.join()
+
+
+
+
+
 class HollowCoreCustomHTTP(http.server.HTTPServer):
     """See __init__ docstring."""
 
@@ -47,7 +207,15 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
                  stream_handler: logging.StreamHandler,
                  logger_exit: callable,
                  cli_args,
-                 root_dir: str = None):
+                 root_dir: str = None,
+                 concurrency: Literal["single", "threadpool", "asyncio"] = "single",
+                 max_workers: int = 16,
+                 keepalive_timeout: float = 5.0,
+                 stream_flush_bytes: int = STREAM_FLUSH_BYTES,
+                 stream_flush_ms: float = STREAM_FLUSH_MS,
+                 max_body_size: int = MAX_BODY_SIZE,
+                 max_history_size: int = MAX_HISTORY_SIZE,
+                 compression_threshold: int = COMPRESSION_THRESHOLD):
         """A customized HTTP server for Hollowfire.
 
         Args:
@@ -58,6 +226,19 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
             cli_args (_type_): CLI arguments.
             interface (str, optional): The interface or IP address to host the HTTP server on. Defaults to "localhost".
             root_dir (str, optional): The root directory to serve files from. Defaults to None.
+            concurrency (Literal["single", "threadpool", "asyncio"], optional): How requests are served. "single" handles one request
+            at a time, "threadpool" hands each connection to a bounded pool of worker threads, and "asyncio" serves every connection
+            as a coroutine on a single event loop (see src/lib/asyncserver.py). Defaults to "single".
+            max_workers (int, optional): The maximum amount of worker threads in "threadpool" mode. Defaults to 16.
+            keepalive_timeout (float, optional): How long an idle keep-alive connection is held open, in seconds. In "threadpool"
+            mode, idle connections are watched by a single thread (see `IdleConnections`), not by a worker each. Defaults to 5.
+            stream_flush_bytes (int, optional): The default amount of bytes a streamed response buffers before it's written out.
+            stream_flush_ms (float, optional): The default amount of milliseconds a streamed response buffers before it's written out.
+            Clients can override both per request.
+            max_body_size (int, optional): The largest request body accepted, in bytes. Defaults to 8 MiB.
+            max_history_size (int, optional): The largest whole conversation accepted (PUT /memory), in bytes. Defaults to 64 MiB.
+            compression_threshold (int, optional): Responses at least this large are compressed, if the client accepts it.
+            Streams are always compressed if the client accepts it. Negative disables compression. Defaults to 1 KiB.
         """
 
         self.port = port
@@ -67,14 +248,45 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
         self.cli_args = cli_args
         self.interface = "localhost"
         #self.request_queue = Queue()
-        self.callbacks = {
-            "GET": {},
-            "POST": {},
-            "PUT": {},
-            "DELETE": {},
-            "PATCH": {}
+        self.routers = {
+            "GET": Router(),
+            "POST": Router(),
+            "PUT": Router(),
+            "DELETE": Router(),
+            "PATCH": Router()
         }
         self.root_dir = root_dir
+        self.concurrency = concurrency
+        self.max_workers = max(1, max_workers)
+        self.executor: ThreadPoolExecutor = None
+        self.idle: IdleConnections = None
+        self.keepalive_timeout = keepalive_timeout
+        self.stream_flush_bytes, self.stream_flush_ms = flush_policy({"bytes": stream_flush_bytes, "ms": stream_flush_ms})
+        self.max_body_size = max_body_size
+        self.max_history_size = max_history_size
+        self.compression_threshold = compression_threshold
+        self.shutdown_callbacks: list[callable] = [] # Run once the server stops, whichever way it stops.
+        self.ordered_by: tuple[str, KeyedLocks] = None # See `order_requests`.
+        self.body_limits: dict[tuple[str, str], int] = {} # (method, route pattern) -> the largest body the route accepts.
+        self.turns: dict = {} # Connection -> the turn reserved for the request waiting on it, until a worker picks it up.
+        self.detached: dict = {} # Connection -> the thread serving it, outside the pool. See `run_detached`.
+        self.detached_lock = threading.Lock()
+        self.closing = False
+
+        if self.concurrency not in ("single", "threadpool", "asyncio"):
+            panic(
+                f"Unknown concurrency mode \'{self.concurrency}\'.",
+                self.root_dir,
+                self.logger,
+                1, # 1: User error
+                self.stream_handler,
+                error_type="Bad Concurrency Mode",
+                dedicated_exit_function=self.logger_exit
+            )
+
+        if self.concurrency == "threadpool":
+            # Let more connections wait in the listen backlog, as we can now actually get to them in a timely manner.
+            self.request_queue_size = max(self.request_queue_size, self.max_workers * 4)
 
         if self.interface != "localhost":
             panic(
@@ -92,6 +304,11 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
 
         super().__init__(("localhost", port), self.HollowserverRequestHandler)
 
+        if self.concurrency == "threadpool":
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="Hollowserver-Worker")
+            self.idle = IdleConnections(self.keepalive_timeout, self.dispatch_connection, self.shutdown_request)
+            self.logger.info(f"Serving requests with a pool of up to {self.max_workers} worker threads.")
+
         self.logger.info("Complete.")
         #print(f"{FM.success} Complete.")
 
@@ -101,232 +318,521 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
 
 
 
-    class HollowserverRequestHandler(http.server.BaseHTTPRequestHandler): # pylint: disable=missing-class-docstring # Absolutely don't need a docstring...
+    class HollowserverRequestHandler(HollowRequestMixin, http.server.BaseHTTPRequestHandler): # pylint: disable=missing-class-docstring # Absolutely don't need a docstring...
+
+        is_async = False # See src/lib/asyncserver.py for the asyncio counterpart.
+        protocol_version = "HTTP/1.1" # Keep connections alive. See src/lib/httpio.py for how responses are framed.
 
 
         def __init__(self, *args, **kwargs):
 
+            # Filled in by the router on every request.
+            self.params = {}
+            self.query = {}
+            self.route_rest = []
+
+            self.keep_alive = False # Whether the connection is left open and idle once we're done, to be parked.
+            self.detached = False # Whether the connection was handed off to its own thread. See `detach`.
+            self.turn: Turn = None # The turn reserved for the first request as it arrived. See `take_turn`.
+
             super().__init__(*args, **kwargs)
-            #self.server.rqueue = getattr(self.server, "request_queue", Queue())
-            self.server.callbacks = getattr(self.server, "callbacks", {"GET": {}, "POST": {}, "PUT": {}, "DELETE": {}, "PATCH": {}})
 
 
 
-        def do_GET(self): # pylint: disable=invalid-name disable=missing-function-docstring
+        def setup(self):
+            # Connections that stall for this many seconds (or, in single mode, sit idle between requests) are dropped.
+            self.timeout = self.server.keepalive_timeout
+            self.turn = self.server.turns.pop(self.request, None)
+            super().setup()
 
-            try:
 
-                get_callbacks = self.server.callbacks["GET"]
 
-                path_callbacks = []
+        def finish(self):
+            self.drop_turn() # In case the request never made it to `dispatch`.
 
-                for path, callbacks in get_callbacks.items(): # Get all callbacks registered for all paths.
+            if self.detached: # Its new owner still reads and writes through these.
+                self.wfile.flush()
+                return
 
-                    for callback in callbacks: # For every callback in this path:
+            super().finish()
 
-                        if callback[1] and self.path.startswith(path): # If it's an only_startswith (targets a parent of the current path):
-                            path_callbacks.append(callback) # Append.
 
-                        elif not callback[1] and self.path == path: # Else, if the path matches exactly:
-                            path_callbacks.append(callback)
 
-                for callback in path_callbacks:
-                    callback[0](self)
+        def take_turn(self, key: str) -> Turn:
+            """Take the turn reserved for this request when it arrived (see `HollowCoreCustomHTTP.order_requests`), to hold
+            with `KeyedLocks.hold(key, turn)`. Can only be taken once.
 
-                if not path_callbacks:
-                    self.send_response(404)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": "Path/endpoint not found (or wrong method)"}).encode("utf-8") + b"\n")
+            Args:
+                key (str): The key the turn is needed for.
+
+            Returns:
+                Turn: The turn, or None if none was reserved for this key; get in line then.
+            """
+
+            turn = self.turn
+
+            if turn is None or self.params.get(self.server.ordered_by[0]) != key:
+                return None
+
+            self.turn = None
+            return turn
+
+
+
+        def drop_turn(self):
+            """Give up the turn reserved for this request, if it wasn't taken."""
+
+            if self.turn is not None:
+                self.turn.cancel()
+                self.turn = None
 
-            except NoSuchConversation:
-                pass
 
-            except: # pylint: disable=bare-except
-                self.send_response(500)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to process GET request."}).encode("utf-8") + b"\n")
-                self.server.logger.error("Failed to process GET request.", exc_info=True)
 
+        def handle(self):
+            if self.server.idle is None:
+                super().handle()
+                return
 
+            # Only the requests the client already sent are handled here; after that, the connection is parked, not waited on.
+            self.handle_one_request()
 
+            while not self.close_connection:
+                if not self.request_pending():
+                    self.keep_alive = True
+                    return
 
+                self.handle_one_request()
 
-        def do_POST(self): # pylint: disable=invalid-name disable=missing-function-docstring
+
+
+        def request_pending(self) -> bool:
+            """Whether the client already sent (the start of) another request, without waiting for one.
+
+            Returns:
+                bool: Whether there is one.
+            """
+
+            self.connection.setblocking(False)
 
             try:
+                return bool(self.rfile.peek(1))
 
-                # oh i think its rfile
-                #body = self.rfile.read(int(self.headers["Content-Length"]))
-                #print(body)
+            except OSError:
+                return False
 
-                post_callbacks = self.server.callbacks["POST"]
+            finally:
+                self.connection.settimeout(self.timeout)
 
-                path_callbacks = []
 
-                for path, callbacks in post_callbacks.items(): # Get all callbacks registered for all paths.
 
-                    for callback in callbacks: # For every callback in this path:
+        def dispatch(self, method: str):
+            """Route the current request to its callbacks.
+
+            Args:
+                method (str): The HTTP method of the request.
+            """
+
+            self.begin_request()
+
+            try:
 
-                        if callback[1] and self.path.startswith(path): # If it's an only_startswith (targets a parent of the current path):
-                            path_callbacks.append(callback) # Append.
+                match, self.query = self.server.route(method, self.path)
 
-                        elif not callback[1] and self.path == path: # Else, if the path matches exactly:
-                            path_callbacks.append(callback)
+                if match is None:
+                    self.send_error_json(404, "Path/endpoint not found (or wrong method)")
+                    return
 
-                for callback in path_callbacks:
-                    callback[0](self)
+                self.params = match.params
+                self.route_rest = match.rest
 
-                if not path_callbacks:
-                    self.send_response(404)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": "Path/endpoint not found (or wrong method)"}).encode("utf-8") + b"\n")
+                for callback in match.callbacks:
+                    callback(self)
 
             except NoSuchConversation:
                 pass
 
+            except BodyError as error:
+                self.server.logger.warning(f"Rejected {method} request body: {error.message}")
+
+                if self.response_started:
+                    self.close_connection = True
+
+                else:
+                    self.send_error_json(error.code, error.message)
+
             except: # pylint: disable=bare-except
-                self.send_response(500)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to process POST request."}).encode("utf-8") + b"\n")
-                self.server.logger.error("Failed to process POST request.", exc_info=True)
+                self.server.logger.error(f"Failed to process {method} request.", exc_info=True)
 
+                if self.response_started:
+                    # Too late to change the status; the best we can do is not reuse the connection.
+                    self.close_connection = True
 
+                else:
+                    self.send_error_json(500, f"Failed to process {method} request.")
 
+            finally:
+                self.drop_turn()
+                self.end_request()
 
 
-        def do_PUT(self): # pylint: disable=invalid-name disable=missing-function-docstring
 
-            try:
+        def upgrade_websocket(self) -> WebSocket:
+            """Upgrade this connection to a WebSocket. Answers the request itself if it isn't a valid upgrade.
+            The connection is closed once the callback returns, unless it's handed off with `detach`.
 
-                put_callbacks = self.server.callbacks["PUT"]
+            Returns:
+                WebSocket: The WebSocket, or None if the upgrade failed.
+            """
 
-                path_callbacks = []
+            key = self.headers.get("Sec-WebSocket-Key")
 
-                for path, callbacks in put_callbacks.items(): # Get all callbacks registered for all paths.
+            if self.headers.get("Upgrade", "").lower() != "websocket" or "upgrade" not in self.headers.get("Connection", "").lower() \
+               or not key:
+                self.send_error_json(400, "Expected a WebSocket upgrade.")
+                return None
 
-                    for callback in callbacks: # For every callback in this path:
+            if self.headers.get("Sec-WebSocket-Version") != "13":
+                self.send_error_json(426, "Unsupported WebSocket version.", headers={"Sec-WebSocket-Version": "13"})
+                return None
 
-                        if callback[1] and self.path.startswith(path): # If it's an only_startswith (targets a parent of the current path):
-                            path_callbacks.append(callback) # Append.
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", accept_key(key))
+            self.end_headers()
 
-                        elif not callback[1] and self.path == path: # Else, if the path matches exactly:
-                            path_callbacks.append(callback)
+            self.close_connection = True
+            self.connection.settimeout(None) # Sessions idle for as long as they like; the keep-alive timeout doesn't apply.
 
-                for callback in path_callbacks:
-                    callback[0](self)
+            return WebSocket(self.rfile.raw, self.wfile)
 
-                if not path_callbacks:
-                    self.send_response(404)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": "Path/endpoint not found (or wrong method)"}).encode("utf-8") + b"\n")
 
-            except NoSuchConversation:
-                pass
 
-            except: # pylint: disable=bare-except
-                self.send_response(500)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to process PUT request."}).encode("utf-8") + b"\n")
-                self.server.logger.error("Failed to process PUT request.", exc_info=True)
+        def detach(self, target: callable, name: str) -> bool:
+            """Hand the connection off to a thread of its own, outside the worker pool, e.g. to serve a WebSocket session.
+            It's closed once `target` returns, or when the server is closed. The callback should return right after.
 
+            Args:
+                target (callable): What to run on the thread. Takes no arguments.
+                name (str): The name of the thread.
 
+            Returns:
+                bool: Whether it was handed off; it isn't if the server is closing.
+            """
 
+            self.close_connection = True
+            self.detached = self.server.run_detached(self.connection, target, name)
 
+            return self.detached
 
-        def do_DELETE(self): # pylint: disable=invalid-name disable=missing-function-docstring
-            try:
 
-                delete_callbacks = self.server.callbacks["DELETE"]
 
-                path_callbacks = []
+        # pylint: disable=invalid-name disable=missing-function-docstring
 
-                for path, callbacks in delete_callbacks.items(): # Get all callbacks registered for all paths.
+        def do_GET(self):
+            self.dispatch("GET")
 
-                    for callback in callbacks: # For every callback in this path:
+        def do_POST(self):
+            self.dispatch("POST")
 
-                        if callback[1] and self.path.startswith(path): # If it's an only_startswith (targets a parent of the current path):
-                            path_callbacks.append(callback) # Append.
+        def do_PUT(self):
+            self.dispatch("PUT")
 
-                        elif not callback[1] and self.path == path: # Else, if the path matches exactly:
-                            path_callbacks.append(callback)
+        def do_DELETE(self):
+            self.dispatch("DELETE")
 
-                for callback in path_callbacks:
-                    callback[0](self)
+        def do_PATCH(self):
+            self.dispatch("PATCH")
+
+        # pylint: enable=invalid-name enable=missing-function-docstring
 
-                if not path_callbacks:
-                    self.send_response(404)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": "Path/endpoint not found (or wrong method)"}).encode("utf-8") + b"\n")
 
-            except NoSuchConversation:
-                pass
 
-            except: # pylint: disable=bare-except
-                self.send_response(500)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to process DELETE request."}).encode("utf-8") + b"\n")
-                self.server.logger.error("Failed to process DELETE request.", exc_info=True)
 
 
+    def process_request(self, request, client_address):
+        """Wait for the connection's first request without holding a worker, or handle it right here if we're single-threaded.
 
+        Args:
+            request: The connection's socket.
+            client_address: The address of the client.
+        """
 
+        if self.executor is None:
+            super().process_request(request, client_address)
+            return
+
+        self.idle.park(request, client_address)
 
-        def do_PATCH(self): # pylint: disable=invalid-name disable=missing-function-docstring
 
-            try:
 
-                patch_callbacks = self.server.callbacks["PATCH"]
 
-                path_callbacks = []
 
-                for path, callbacks in patch_callbacks.items(): # Get all callbacks registered for all paths.
+    def dispatch_connection(self, request, client_address):
+        """Hand a connection with a request waiting on it to the worker pool, reserving the request's turn first.
 
-                    for callback in callbacks: # For every callback in this path:
+        Args:
+            request: The connection's socket.
+            client_address: The address of the client.
+        """
 
-                        if callback[1] and self.path.startswith(path): # If it's an only_startswith (targets a parent of the current path):
-                            path_callbacks.append(callback) # Append.
+        turn = self.reserve_turn(request)
 
-                        elif not callback[1] and self.path == path: # Else, if the path matches exactly:
-                            path_callbacks.append(callback)
+        if turn is not None:
+            self.turns[request] = turn
 
-                for callback in path_callbacks:
-                    callback[0](self)
+        try:
+            self.executor.submit(self.process_request_thread, request, client_address)
 
-                if not path_callbacks:
-                    self.send_response(404)
-                    self.send_header("Content-Type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"error": "Path/endpoint not found (or wrong method)"}).encode("utf-8") + b"\n")
+        except RuntimeError: # The pool was shut down.
+            self.shutdown_request(request)
 
-            except NoSuchConversation:
+
+
+
+
+    def order_requests(self, param: str, locks: KeyedLocks):
+        """Keep requests in the order they came in, per value of a route parameter: each request's turn on
+        `locks` is reserved as soon as its request line arrives, not once a worker gets to it. Callbacks take it with
+        `request.take_turn(key)`. Only applies to "threadpool" mode; "single" mode handles requests in order anyway.
+
+        Args:
+            param (str): The route parameter, e.g. "conv".
+            locks (KeyedLocks): The locks to reserve turns on.
+        """
+
+        self.ordered_by = (param, locks)
+
+
+
+
+
+    def reserve_turn(self, request) -> Turn:
+        """Reserve the turn of the request waiting on a connection, going by its request line. See `order_requests`.
+
+        Args:
+            request: The connection's socket. Must be readable; nothing is read off it.
+
+        Returns:
+            Turn: The turn, or None if the request doesn't need one, or its request line isn't all here yet.
+        """
+
+        if self.ordered_by is None:
+            return None
+
+        try:
+            head = request.recv(REQUEST_LINE_PEEK, socket.MSG_PEEK)
+
+        except OSError:
+            return None
+
+        line, found, _ = head.partition(b"\n")
+        parts = line.decode("latin-1").split()
+
+        if not found or len(parts) != 3:
+            return None # It gets in line once it's handled instead.
+
+        param, locks = self.ordered_by
+        match, _ = self.route(parts[0], parts[1])
+
+        if match is None or param not in match.params:
+            return None
+
+        return locks.reserve(match.params[param])
+
+
+
+
+
+    def process_request_thread(self, request, client_address):
+        """Same as `process_request` in `socketserver.BaseServer`, but ran on a worker thread.
+        A connection that's kept alive is parked once its requests are handled, instead of closed.
+
+        Args:
+            request: The connection's socket.
+            client_address: The address of the client.
+        """
+
+        handler = None
+
+        try:
+            handler = self.finish_request(request, client_address)
+
+        except Exception: # pylint: disable=broad-exception-caught
+            self.handle_error(request, client_address)
+
+        finally:
+            turn = self.turns.pop(request, None) # The handler never got to it.
+
+            if turn is not None:
+                turn.cancel()
+
+            if handler is not None and handler.detached:
+                pass # Its thread closes it.
+
+            elif handler is not None and handler.keep_alive:
+                self.idle.park(request, client_address)
+
+            else:
+                self.shutdown_request(request)
+
+
+
+
+
+    def finish_request(self, request, client_address):
+        """Handle the connection's requests.
+
+        Args:
+            request: The connection's socket.
+            client_address: The address of the client.
+
+        Returns:
+            HollowserverRequestHandler: The handler, done with the connection. Its `keep_alive` and `detached` tell what
+            becomes of the connection.
+        """
+
+        return self.RequestHandlerClass(request, client_address, self)
+
+
+
+
+
+    def run_detached(self, connection, target: callable, name: str) -> bool:
+        """Run something that serves a connection for a long time on a thread of its own, instead of on a worker.
+        See `HollowserverRequestHandler.detach`.
+
+        Args:
+            connection: The connection's socket. Closed once `target` returns.
+            target (callable): What to run. Takes no arguments.
+            name (str): The name of the thread.
+
+        Returns:
+            bool: Whether it's running; it isn't if the server is closing.
+        """
+
+        thread = threading.Thread(target=self._run_detached, args=(connection, target), name=name, daemon=True)
+
+        with self.detached_lock:
+            if self.closing:
+                return False
+
+            self.detached[connection] = thread
+
+        thread.start()
+
+        return True
+
+
+
+
+
+    def _run_detached(self, connection, target: callable):
+        try:
+            target()
+
+        except: # pylint: disable=bare-except
+            self.logger.error("Detached connection failed.", exc_info=True)
+
+        finally:
+            with self.detached_lock:
+                self.detached.pop(connection, None)
+
+            self.shutdown_request(connection)
+
+
+
+
+
+    def server_close(self):
+        """Close the listening socket, idle and detached connections, then wait for the worker pool to finish whatever
+        it's doing."""
+
+        super().server_close()
+
+        if self.idle is not None:
+            self.idle.close()
+
+        with self.detached_lock:
+            self.closing = True
+            detached = list(self.detached.items())
+
+        for connection, _ in detached:
+            try:
+                connection.shutdown(socket.SHUT_RDWR) # Wakes up whoever is reading from it.
+
+            except OSError:
                 pass
 
-            except: # pylint: disable=bare-except
-                self.send_response(500)
-                self.send_header("Content-Type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": "Failed to process PATCH request."}).encode("utf-8") + b"\n")
-                self.server.logger.error("Failed to process PATCH request.", exc_info=True)
+        for _, thread in detached:
+            thread.join(DETACHED_JOIN_TIMEOUT)
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+
+
+
+    def route(self, method: str, path: str):
+        """Look up the route for a request.
+
+        Args:
+            method (str): The HTTP method of the request.
+            path (str): The raw request path, including the query string.
+
+        Returns:
+            tuple[RouteMatch, dict[str, str]]: The match (None if there isn't one), and the parsed query string.
+        """
+
+        router = self.routers.get(method)
+
+        if router is None:
+            return None, {}
+
+        segments, query = split_path(path)
+
+        return router.match(segments), query
+
+
+
+
+
+    def body_limit(self, method: str, match) -> int:
+        """The largest request body a route accepts. See `request_callback`.
+
+        Args:
+            method (str): The HTTP method of the request.
+            match (RouteMatch): The route, or None if there isn't one.
+
+        Returns:
+            int: The limit, in bytes.
+        """
+
+        if match is None:
+            return self.max_body_size
+
+        return self.body_limits.get((method, match.pattern), self.max_body_size)
 
 
 
 
 
     def request_callback(self,
-                         request_type: Literal["GET", "POST", "PUT", "DELETE"],
+                         request_type: Literal["GET", "POST", "PUT", "DELETE", "PATCH"],
                          path: str,
                          callback: callable,
-                         only_startswith: bool = False):
+                         only_startswith: bool = False,
+                         max_body_size: int = None):
         """Add a callback to x request at y path. When a request of the matching type is received at that path,
-        the callback is executed with the self as the argument.
+        the callback is executed with the request handler as the argument.
+
+        Paths may contain typed parameters, which are extracted once and handed to the callback as `request.params`:
+
+        >>> server.request_callback("DELETE", "/memory/{conv}/{index:int}", callback)
+        >>> server.request_callback("GET", "/save/{conv}/{file:path}", callback) # `path` swallows the rest of the path.
+
+        The query string is available as `request.query`.
 
         We recommend using a `lambda` expression if you want to pass more arguments to the callback.
         Just make sure the lambda forwards the argument that would be passed usually.
@@ -334,19 +840,23 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
         >>> lambda req: callback(req, (your args...))
 
         Args:
-            request_type (Literal["GET", "POST", "PUT", "DELETE"]): The type of request to listen for.
-            path (str): The path to listen for the request at.
+            request_type (Literal["GET", "POST", "PUT", "DELETE", "PATCH"]): The type of request to listen for.
+            path (str): The path pattern to listen for the request at.
             callback (callable): The callback to execute when the request is received.
-            only_startswith (bool, optional): Whether to listen for requests that *start with* the path instead of an exact match.
+            only_startswith (bool, optional): Whether to also listen for requests *below* the path instead of only an exact match.
+            Matching is done per path segment, and whatever is left over is given to the callback as `request.route_rest`.
             Defaults to False.
+            max_body_size (int, optional): The largest request body the route accepts, if it's not the server's `max_body_size`.
+            The asyncio backend reads bodies before the callback, so it needs to know up front; the callback still passes the
+            same limit when it reads the body.
         """
 
         try:
 
-            if not self.callbacks[request_type].get(path, []):
-                self.callbacks[request_type][path] = []
+            self.routers[request_type].add(path, callback, only_startswith)
 
-            self.callbacks[request_type][path].append([callback, only_startswith])
+            if max_body_size is not None:
+                self.body_limits[(request_type, path)] = max_body_size
 
         except: # pylint: disable=bare-except
             panic(
@@ -364,6 +874,35 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
 
 
 
+    def on_shutdown(self, callback: callable):
+        """Run a callback once the server stops, e.g. to write out unsaved state. Callbacks run in the order they were added.
+
+        Args:
+            callback (callable): The callback. Takes no arguments.
+        """
+
+        self.shutdown_callbacks.append(callback)
+
+
+
+
+
+    def run_shutdown_callbacks(self):
+        """Run the shutdown callbacks. One failing doesn't keep the others from running."""
+
+        callbacks, self.shutdown_callbacks = self.shutdown_callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+
+            except: # pylint: disable=bare-except
+                self.logger.error("Shutdown callback failed.", exc_info=True)
+
+
+
+
+
     def run_server(self):
         """Run the server.
         Blocking call.
@@ -374,7 +913,15 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
             self.logger.info("Server is starting... (run_server called.) [Press Ctrl+C to exit.]")
             print(f"{FM.info} Server is starting... [Press Ctrl+C to exit.]")
 
-            self.serve_forever()
+            if self.concurrency == "asyncio":
+                # pylint: disable=import-outside-toplevel # Circular import; the asyncio backend needs NoSuchConversation.
+                from src.lib.asyncserver import serve_async
+                asyncio.run(serve_async(self))
+
+            else:
+                self.serve_forever()
+
+            self.run_shutdown_callbacks()
 
         except KeyboardInterrupt:
 
@@ -383,7 +930,12 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
                 print(f"{FM.info} KeyboardInterrupt received. Exiting...")
 
                 self.server_close()
-                self.shutdown()
+
+                if self.concurrency != "asyncio": # serve_forever() was never called; shutdown() would wait on it forever.
+                    self.shutdown()
+
+                self.run_shutdown_callbacks()
+
                 self.logger_exit()
 
             except: # pylint: disable=bare-except
@@ -405,7 +957,11 @@ class HollowCoreCustomHTTP(http.server.HTTPServer):
         except: # pylint: disable=bare-except
 
             self.server_close()
-            self.shutdown()
+
+            if self.concurrency != "asyncio":
+                self.shutdown()
+
+            self.run_shutdown_callbacks()
 
             panic(
                 "Unexpected server exception!",
@@ -0,0 +1,219 @@
+# session.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Long-lived WebSocket sessions bound to a single conversation.
+
+Every message is a JSON object with an "op", and optionally an "id" that is echoed back in every reply to it:
+
+>>> {"op": "append", "message": {"role": "user", "content": "Hi!"}}
+>>> {"op": "get"}
+>>> {"op": "complete", "data": {...same body as POST /completion...}}
+>>> {"op": "cancel"} # Cancels every running or queued completion, or only the one with a matching "id".
+
+Replies have a "type": "ok", "memory", "token" (one per streamed chunk), "done", "cancelled" or "error".
+Completions go through the same scheduler as POST /completion; one that can't be queued gets an "error" with a "retry_after".
+"""
+
+
+
+# Imports: Built-in/Standard
+import queue      # Used to hand operations to the session's worker.
+import contextlib # Used when there's no scheduler.
+import threading  # Used for the worker and cancellation.
+import traceback  # Used to get information about exceptions.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.websocket import WebSocket, WebSocketClosed, CLOSE_NORMAL # The WebSocket itself.
+from src.lib.util.concurrency import FifoLock                         # Per-conversation ordering.
+from src.lib.scheduler import CompletionScheduler, SchedulerFull      # Admission control for completions.
+
+
+
+# Classes
+
+
+
+class ConversationSession:
+    """A WebSocket session bound to a conversation.
+
+    The connection's own thread only reads messages. Operations run in order on a worker thread, each holding the
+    conversation's lock, so they're ordered with respect to plain HTTP requests as well. "cancel" is handled as soon as
+    it's read, so it can interrupt a completion in progress.
+    """
+
+    def __init__(self, websocket: WebSocket, conversation, lock: FifoLock, logger, scheduler: CompletionScheduler = None):
+        """A conversation session.
+
+        Args:
+            websocket (WebSocket): The WebSocket.
+            conversation (BaseAIProvider): The conversation.
+            lock (FifoLock): The conversation's lock.
+            logger (logging.Logger): The logger to use.
+            scheduler (CompletionScheduler, optional): The scheduler completions must go through. Defaults to None (no limits).
+        """
+
+        self.websocket = websocket
+        self.conversation = conversation
+        self.lock = lock
+        self.logger = logger
+        self.scheduler = scheduler
+
+        self.operations = queue.Queue()
+        self.completions: dict[int, tuple[dict, threading.Event, object]] = {} # Running or queued completions, with their tickets.
+        self.completions_lock = threading.Lock()
+
+
+    def run(self):
+        """Serve the session until either side closes it. Blocking call."""
+
+        worker = threading.Thread(target=self._work, name=f"Session-{self.conversation.conversation_id}", daemon=True)
+        worker.start()
+
+        try:
+            while True:
+                try:
+                    operation = self.websocket.receive_json()
+
+                except ValueError:
+                    self._reply({}, "error", error="Message was not valid JSON.")
+                    continue
+
+                if not isinstance(operation, dict):
+                    self._reply({}, "error", error="Message was not a JSON object.")
+                    continue
+
+                if operation.get("op") == "cancel":
+                    self._cancel(operation.get("id"))
+                    continue
+
+                if operation.get("op") == "complete":
+                    try:
+                        ticket = self.scheduler.admit(self.conversation.conversation_id) if self.scheduler else None
+
+                    except SchedulerFull as full:
+                        self._reply(operation, "error", error=full.reason, retry_after=full.retry_after)
+                        continue
+
+                    with self.completions_lock:
+                        self.completions[id(operation)] = (operation, threading.Event(), ticket)
+
+                self.operations.put(operation)
+
+        except (WebSocketClosed, OSError):
+            pass
+
+        finally:
+            self._cancel(None)
+            self.operations.put(None) # Stop the worker.
+            worker.join()
+
+            with self.completions_lock: # The worker may have bailed out before getting to some of them.
+                for _, _, ticket in self.completions.values():
+                    if ticket:
+                        ticket.release()
+            self.websocket.close(CLOSE_NORMAL)
+
+
+    def _cancel(self, operation_id):
+        """Cancel completions.
+
+        Args:
+            operation_id: Only cancel the completion with this "id". None cancels all of them.
+        """
+
+        with self.completions_lock:
+            for operation, event, _ in self.completions.values():
+                if operation_id is None or operation.get("id") == operation_id:
+                    event.set()
+
+
+    def _reply(self, operation: dict, reply_type: str, **fields):
+        """Send a reply to an operation.
+
+        Args:
+            operation (dict): The operation being replied to.
+            reply_type (str): The type of the reply.
+        """
+
+        reply = {"type": reply_type}
+
+        if "id" in operation:
+            reply["id"] = operation["id"]
+
+        self.websocket.send_json(reply | fields)
+
+
+    def _work(self):
+        """Run queued operations, in order, until told to stop."""
+
+        while (operation := self.operations.get()) is not None:
+
+            try:
+                with self.lock:
+                    self._run_operation(operation)
+
+            except (WebSocketClosed, OSError):
+                return
+
+            except: # pylint: disable=bare-except
+                self.logger.error("Session operation failed.")
+                self.logger.debug(traceback.format_exc())
+
+                try:
+                    self._reply(operation, "error", error="Operation failed.")
+
+                except (WebSocketClosed, OSError):
+                    return
+
+
+    def _run_operation(self, operation: dict):
+        """Run a single operation. Called with the conversation's lock held.
+
+        Args:
+            operation (dict): The operation.
+        """
+
+        match operation.get("op"):
+
+            case "append":
+                self.conversation.append_message(operation.get("message"))
+                self._reply(operation, "ok")
+
+            case "get":
+                self._reply(operation, "memory", messages=self.conversation.conversation)
+
+            case "complete":
+                with self.completions_lock:
+                    _, cancelled, ticket = self.completions[id(operation)]
+
+                chunks = 0
+
+                try:
+                    if not cancelled.is_set():
+                        with ticket or contextlib.nullcontext():
+                            for chunk in self.conversation.iter_completion(dict(operation.get("data") or {})):
+
+                                if cancelled.is_set():
+                                    break
+
+                                self._reply(operation, "token", chunk=chunk)
+                                chunks += 1
+
+                finally:
+                    if ticket:
+                        ticket.release()
+
+                    with self.completions_lock:
+                        del self.completions[id(operation)]
+
+                self._reply(operation, "cancelled" if cancelled.is_set() else "done", chunks=chunks)
+
+            case _:
+                self._reply(operation, "error", error=f"Unknown op \'{operation.get('op')}\'.")
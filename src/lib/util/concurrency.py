@@ -0,0 +1,273 @@
+# concurrency.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""Locking primitives used to keep concurrent requests against the same conversation in order."""
+
+
+# Imports
+import threading # Locks and conditions.
+
+
+
+# Classes
+
+
+
+class FifoLock:
+    """A non-reentrant lock that hands itself out strictly in the order it was asked for.
+
+    `threading.Lock` makes no promises about which waiter wins, so two requests against the same conversation could
+    otherwise run out of order. This is a simple ticket lock - whoever asks first, goes first.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._next_ticket = 0
+        self._now_serving = 0
+        self._cancelled: set[int] = set() # Reserved tickets that will never be used; skipped once they come up.
+
+
+    def reserve(self) -> int:
+        """Take a place in line now, to wait for it later with `acquire(ticket)`. Every reserved ticket must either be
+        acquired or cancelled, or everybody behind it waits forever.
+
+        Returns:
+            int: The ticket.
+        """
+
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            return ticket
+
+
+    def acquire(self, ticket: int = None):
+        """Wait for our turn, then take the lock.
+
+        Args:
+            ticket (int, optional): A ticket from `reserve`. Defaults to None (get in line now).
+        """
+
+        with self._condition:
+            if ticket is None:
+                ticket = self._next_ticket
+                self._next_ticket += 1
+
+            while ticket != self._now_serving:
+                self._condition.wait()
+
+
+    def release(self):
+        """Release the lock, waking up whoever is next in line."""
+
+        with self._condition:
+            self._now_serving += 1
+            self._skip_cancelled()
+            self._condition.notify_all()
+
+
+    def cancel(self, ticket: int):
+        """Give up a reserved ticket without ever acquiring it.
+
+        Args:
+            ticket (int): The ticket.
+        """
+
+        with self._condition:
+            self._cancelled.add(ticket)
+            self._skip_cancelled()
+            self._condition.notify_all()
+
+
+    def _skip_cancelled(self):
+        while self._now_serving in self._cancelled:
+            self._cancelled.remove(self._now_serving)
+            self._now_serving += 1
+
+
+    def locked(self) -> bool:
+        """Whether somebody currently holds the lock."""
+
+        with self._condition:
+            return self._next_ticket != self._now_serving
+
+
+    def depth(self) -> int:
+        """The amount of holders and waiters currently queued on this lock."""
+
+        with self._condition:
+            return self._next_ticket - self._now_serving
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+
+
+
+class Turn:
+    """A place in line on a `FifoLock`, reserved ahead of time. Used as a context manager, it waits for the lock and holds
+    it, once; `cancel` gives it up if it won't be used.
+    """
+
+    def __init__(self, lock: FifoLock):
+        self.lock = lock
+        self.ticket = lock.reserve()
+        self.used = False
+
+
+    def cancel(self):
+        """Give up our place in line, unless it's been used already."""
+
+        if not self.used:
+            self.used = True
+            self.lock.cancel(self.ticket)
+
+
+    def __enter__(self):
+        self.used = True
+        self.lock.acquire(self.ticket)
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+
+
+
+class FifoSemaphore:
+    """A semaphore that, like `FifoLock`, lets waiters in strictly in the order they arrived."""
+
+    def __init__(self, value: int = 1):
+        self._condition = threading.Condition(threading.Lock())
+        self._value = value
+        self._next_ticket = 0
+        self._released = 0
+
+
+    def acquire(self):
+        """Wait for our turn and a free slot, then take the slot."""
+
+        with self._condition:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+
+            while ticket - self._released >= self._value:
+                self._condition.wait()
+
+
+    def release(self):
+        """Give a slot back, waking up whoever is next in line."""
+
+        with self._condition:
+            self._released += 1
+            self._condition.notify_all()
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+
+
+
+class KeyedLocks:
+    """A lazily-populated map of keys (conversation IDs) to `FifoLock`s.
+
+    Pass `asyncio.Lock` as the lock class for use on an event loop; it is FIFO as well, and is used with `async with`.
+    """
+
+    def __init__(self, lock_class: type = FifoLock):
+        self._guard = threading.Lock()
+        self._lock_class = lock_class
+        self._locks: dict[str, FifoLock] = {}
+
+
+    def get(self, key: str) -> FifoLock:
+        """Get the lock for a key, creating it if it doesn't exist yet.
+
+        Args:
+            key (str): The key (usually a conversation ID).
+
+        Returns:
+            FifoLock: The lock.
+        """
+
+        with self._guard:
+            lock = self._locks.get(key)
+
+            if lock is None:
+                lock = self._locks[key] = self._lock_class()
+
+            return lock
+
+
+    def hold(self, key: str, turn: Turn = None) -> FifoLock:
+        """Shorthand for `with locks.hold(key): ...`.
+
+        Args:
+            key (str): The key (usually a conversation ID).
+            turn (Turn, optional): A place in line reserved for this key with `reserve`, to wait for instead.
+
+        Returns:
+            FifoLock: The lock (or the turn), to be used as a context manager.
+        """
+
+        return turn if turn is not None else self.get(key)
+
+
+    def reserve(self, key: str) -> Turn:
+        """Take a place in line for a key now, to wait for it later with `hold(key, turn)`. Only for `FifoLock`s.
+
+        Args:
+            key (str): The key (usually a conversation ID).
+
+        Returns:
+            Turn: The place in line. Cancel it if it won't be used.
+        """
+
+        with self._guard: # So it isn't discarded in between; a reserved ticket keeps it locked until it's used or cancelled.
+            lock = self._locks.get(key)
+
+            if lock is None:
+                lock = self._locks[key] = self._lock_class()
+
+            return Turn(lock)
+
+
+    def discard(self, key: str) -> bool:
+        """Forget the lock for a key, as long as nobody is holding or waiting on it.
+
+        Args:
+            key (str): The key (usually a conversation ID).
+
+        Returns:
+            bool: Whether the lock was discarded.
+        """
+
+        with self._guard:
+            lock = self._locks.get(key)
+
+            if lock is None:
+                return True
+
+            if lock.locked():
+                return False
+
+            del self._locks[key]
+            return True
@@ -0,0 +1,106 @@
+# fastjson.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""JSON encoding for responses. Uses orjson if it's installed (it's several times faster on big conversation dumps),
+and falls back to the standard library otherwise. Either way, `dumps` hands back UTF-8 bytes, ready to be written."""
+
+
+
+# Imports: Built-in/Standard
+import json      # The fallback encoder.
+import functools # Used to cache error bodies.
+
+
+# Imports: Third-party
+
+# pylint: disable=invalid-name
+orjson_is_available = False
+try:
+    import orjson
+    orjson_is_available = True
+except ImportError:
+    pass
+# pylint: enable=invalid-name
+
+
+# Imports: Local/source
+# ...
+
+
+
+# Constants
+
+ENCODERS: dict[type, callable] = {} # Types that neither encoder knows about -> a function that turns them into something it does.
+
+
+
+# Functions
+
+def register_type(cls: type, encoder: callable):
+    """Teach `dumps` how to encode a type.
+
+    Args:
+        cls (type): The type.
+        encoder (callable): Turns an instance into something JSON-serializable (a dict, list, str...).
+    """
+
+    ENCODERS[cls] = encoder
+
+
+
+
+
+def _default(obj):
+    """The `default` hook of both encoders."""
+
+    encoder = ENCODERS.get(type(obj))
+
+    if encoder is None:
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+    return encoder(obj)
+
+
+
+
+
+_stdlib_encoder = json.JSONEncoder(default=_default) # The defaults are what the C accelerator is fastest at.
+
+
+def dumps(obj) -> bytes:
+    """Encode an object as JSON.
+
+    Args:
+        obj: Anything JSON-serializable, or of a type registered with `register_type`.
+
+    Returns:
+        bytes: The UTF-8 encoded JSON.
+    """
+
+    if orjson_is_available:
+        try:
+            return orjson.dumps(obj, default=_default)
+
+        except TypeError: # orjson is stricter (e.g. non-string keys, huge integers); let the standard library have a go.
+            pass
+
+    return _stdlib_encoder.encode(obj).encode("utf-8")
+
+
+
+
+
+@functools.lru_cache(maxsize=256)
+def error_body(message: str) -> bytes:
+    """The body of an error response. Error messages are mostly constant, so they're only encoded once.
+
+    Args:
+        message (str): The error message.
+
+    Returns:
+        bytes: The body, newline included.
+    """
+
+    return dumps({"error": message}) + b"\n"
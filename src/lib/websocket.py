@@ -0,0 +1,288 @@
+# websocket.py
+# Hollowfire Source File
+# Author: Kalinite
+# Year: 2025
+# Description:
+"""A small, dependency-free WebSocket (RFC 6455) implementation for Hollowserver's threaded backends.
+Only what the conversation sessions need: text/binary messages, fragmentation, ping/pong and the closing handshake."""
+
+
+
+# Imports: Built-in/Standard
+import json      # Used to receive JSON messages.
+import base64    # Used for the handshake.
+import hashlib   # Used for the handshake.
+import struct    # Used to pack and unpack frame headers.
+import threading # Used to keep concurrent senders from interleaving frames.
+
+
+# Imports: Third-party
+# ...
+
+
+# Imports: Local/source
+from src.lib.util.fastjson import dumps # Used to send JSON messages.
+
+
+
+# Constants
+
+HANDSHAKE_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024 # The largest message we'll accept from a client.
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+CLOSE_NORMAL = 1000
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_TOO_BIG = 1009
+
+
+
+# Functions
+
+def accept_key(key: str) -> str:
+    """Compute the Sec-WebSocket-Accept value for a client's Sec-WebSocket-Key.
+
+    Args:
+        key (str): The client's key.
+
+    Returns:
+        str: The accept value.
+    """
+
+    return base64.b64encode(hashlib.sha1((key + HANDSHAKE_GUID).encode("ascii")).digest()).decode("ascii")
+
+
+
+
+
+def _unmask(payload: bytes, mask: bytes) -> bytes:
+    """XOR a payload with its 4-byte mask, all at once instead of byte by byte."""
+
+    if not payload:
+        return payload
+
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+
+    return (int.from_bytes(payload, "big") ^ int.from_bytes(key, "big")).to_bytes(length, "big")
+
+
+
+# Classes
+
+
+
+class WebSocketClosed(Exception):
+    """Thrown when the WebSocket has been closed, by either side."""
+
+    def __init__(self, code: int = CLOSE_NORMAL, reason: str = ""):
+        super().__init__(code, reason)
+        self.code = code
+        self.reason = reason
+
+
+
+
+
+class WebSocket:
+    """The server side of an established WebSocket connection. Sending is thread-safe; receiving is not."""
+
+    def __init__(self, rfile, wfile, max_message_size: int = MAX_MESSAGE_SIZE):
+        """A WebSocket connection.
+
+        Args:
+            rfile: The connection's input file.
+            wfile: The connection's output file.
+            max_message_size (int, optional): The largest message we'll accept. Defaults to 16 MiB.
+        """
+
+        self.rfile = rfile
+        self.wfile = wfile
+        self.max_message_size = max_message_size
+        self.closed = False
+        self._send_lock = threading.Lock()
+
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = self.rfile.read(size)
+
+        if len(data) != size:
+            self.closed = True
+            raise WebSocketClosed(CLOSE_PROTOCOL_ERROR, "Connection lost.")
+
+        return data
+
+
+    def _read_frame(self) -> tuple[bool, int, bytes]:
+        """Read a single frame.
+
+        Returns:
+            tuple[bool, int, bytes]: FIN, opcode and the unmasked payload.
+        """
+
+        first, second = self._read_exactly(2)
+
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        masked = bool(second & 0x80)
+        length = second & 0x7F
+
+        if length == 126:
+            length = struct.unpack("!H", self._read_exactly(2))[0]
+
+        elif length == 127:
+            length = struct.unpack("!Q", self._read_exactly(8))[0]
+
+        if not masked:
+            self.close(CLOSE_PROTOCOL_ERROR, "Client frames must be masked.")
+            raise WebSocketClosed(CLOSE_PROTOCOL_ERROR, "Client frames must be masked.")
+
+        if length > self.max_message_size:
+            self.close(CLOSE_TOO_BIG, "Message too big.")
+            raise WebSocketClosed(CLOSE_TOO_BIG, "Message too big.")
+
+        mask = self._read_exactly(4)
+
+        return fin, opcode, _unmask(self._read_exactly(length), mask)
+
+
+    def receive(self) -> tuple[int, bytes]:
+        """Receive the next data message, answering pings and reassembling fragments along the way.
+
+        Returns:
+            tuple[int, bytes]: The opcode (OP_TEXT or OP_BINARY) and the payload.
+
+        Raises:
+            WebSocketClosed: If the connection was closed.
+        """
+
+        message_opcode = None
+        fragments = []
+        size = 0
+
+        while True:
+            fin, opcode, payload = self._read_frame()
+
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+                continue
+
+            if opcode == OP_PONG:
+                continue
+
+            if opcode == OP_CLOSE:
+                code = struct.unpack("!H", payload[:2])[0] if len(payload) >= 2 else CLOSE_NORMAL
+                self.close(code)
+                raise WebSocketClosed(code, payload[2:].decode("utf-8", "replace"))
+
+            if opcode == OP_CONTINUATION:
+                if message_opcode is None:
+                    self.close(CLOSE_PROTOCOL_ERROR, "Unexpected continuation frame.")
+                    raise WebSocketClosed(CLOSE_PROTOCOL_ERROR, "Unexpected continuation frame.")
+
+            elif opcode in (OP_TEXT, OP_BINARY):
+                if message_opcode is not None:
+                    self.close(CLOSE_PROTOCOL_ERROR, "Expected a continuation frame.")
+                    raise WebSocketClosed(CLOSE_PROTOCOL_ERROR, "Expected a continuation frame.")
+
+                message_opcode = opcode
+
+            else:
+                self.close(CLOSE_PROTOCOL_ERROR, "Unknown opcode.")
+                raise WebSocketClosed(CLOSE_PROTOCOL_ERROR, "Unknown opcode.")
+
+            size += len(payload)
+
+            if size > self.max_message_size:
+                self.close(CLOSE_TOO_BIG, "Message too big.")
+                raise WebSocketClosed(CLOSE_TOO_BIG, "Message too big.")
+
+            fragments.append(payload)
+
+            if fin:
+                return message_opcode, b"".join(fragments)
+
+
+    def receive_json(self):
+        """Receive the next message and parse it as JSON.
+
+        Returns:
+            The parsed message.
+
+        Raises:
+            WebSocketClosed: If the connection was closed.
+            ValueError: If the message wasn't valid JSON.
+        """
+
+        _, payload = self.receive()
+
+        return json.loads(payload.decode("utf-8"))
+
+
+    def _send_frame(self, opcode: int, payload: bytes):
+        """Send a single, unfragmented, unmasked frame."""
+
+        length = len(payload)
+
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+
+        elif length < 1 << 16:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+
+        with self._send_lock:
+            if self.closed and opcode != OP_CLOSE:
+                raise WebSocketClosed(CLOSE_NORMAL, "Already closed.")
+
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+
+    def send_text(self, text: str):
+        """Send a text message.
+
+        Args:
+            text (str): The text.
+        """
+
+        self._send_frame(OP_TEXT, text.encode("utf-8"))
+
+
+    def send_json(self, obj):
+        """Send a JSON message.
+
+        Args:
+            obj: Anything JSON-serializable.
+        """
+
+        self._send_frame(OP_TEXT, dumps(obj))
+
+
+    def close(self, code: int = CLOSE_NORMAL, reason: str = ""):
+        """Send a close frame, if we haven't already.
+
+        Args:
+            code (int, optional): The close code. Defaults to CLOSE_NORMAL.
+            reason (str, optional): The reason. Defaults to "".
+        """
+
+        if self.closed:
+            return
+
+        try:
+            self._send_frame(OP_CLOSE, struct.pack("!H", code) + reason.encode("utf-8")[:123])
+
+        except OSError:
+            pass
+
+        self.closed = True